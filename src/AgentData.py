@@ -1,14 +1,30 @@
 import numpy as np
+from array import array
 from dataclasses import dataclass
 from collections import defaultdict
+from collections.abc import Mapping
+from multiprocessing import Pool
+import os
+import re
+import sys
+import time
+import warnings
 import json
 import gzip
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 
 class SocialActiveness(object):
 
     def __init__(self, filename=None, gz=False):
         self.activity = {}
+        self.segment = None
+        self.agents = None
+        self.values = None
         if filename is not None:
             self.load(filename, gz)
         if len(self.activity) > 0:
@@ -23,62 +39,543 @@ class SocialActiveness(object):
         else:
             with gzip.open(filename) as f:
                 self.activity = json.load(f)
+        self.segment = next(iter(self.activity), None)
+        self.values = None
+
+    def bind(self, agents):
+        """
+        Compile the activity of the agents into a vector (indexed by agent row) for each category
+
+        :param agents: an AgentList
+        """
+        self.agents, self.values = agents, {}
+        if self.segment not in ['age', 'gender']:
+            return
+
+        table, codes = agents.codes(self.segment)
+        for category in self.categories:
+            # values missing from the activity table are left to get_value (nan)
+            lut = np.asarray([self.activity[self.segment].get(self.__key(v), {}).get(category, np.nan)
+                              for v in table] + [np.nan], dtype=np.float64)
+            self.values[category] = lut[codes]
+
+    def __key(self, value):
+        return str(value) if self.segment == 'age' else value
 
     def get_value(self, agent, category='all'):
-        segment = list(self.activity.keys())[0]
         if category in self.categories:
-            if segment == 'age':
+            if self.values is not None and category in self.values:
+                if isinstance(agent, AgentView) and agent.agents is self.agents:
+                    row = agent.row
+                else:
+                    row = self.agents.row_of(agent.aid)
+                if row is not None and row < len(self.values[category]):
+                    value = self.values[category][row]
+                    if not np.isnan(value):
+                        return float(value)
+
+            if self.segment == 'age':
                 return self.activity['age'][str(agent.age)][category]
-            if segment == 'gender':
+            if self.segment == 'gender':
                 return self.activity['gender'][agent.gender][category]
         else:
             return 1
 
+    def get_values(self, rows, category='all'):
+        """
+        Activity of several agents at once (see bind)
+
+        :param rows: array of agent rows
+        :param category: census, work or school
+        :return: array of activity values
+        """
+        if category not in self.categories:
+            return np.ones(len(rows))
+        return self.values[category][rows]
+
+
+# Contexts key -> agent field referring to it
+CONTEXT_FIELDS = {'households': 'household', 'census': 'census', 'workplaces': 'work', 'schools': 'school'}
+
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+def iter_cells(filename, gz=False):
+    """
+    Stream the cells of a context file one at a time, without building the whole dictionary
+
+    :param filename: context file ({cell id: cell, ...})
+    :param gz: whether the file is gzipped
+    :return: a generator of (cell id, cell) pairs
+    """
+    opener = gzip.open if gz else open
+    with opener(filename, 'rt') as f:
+        text = f.read()
+
+    decoder = json.JSONDecoder()
+
+    def skip(i, expected=None):
+        i = _WHITESPACE.match(text, i).end()
+        if expected is not None:
+            if text[i:i + 1] not in expected:
+                raise ValueError(f"{filename}: expected {' or '.join(expected)} at char {i}")
+        return i
+
+    i = skip(0, ['{']) + 1
+    if text[skip(i)] == '}':
+        return
+    while True:
+        cid, i = decoder.raw_decode(text, skip(i))
+        cell, i = decoder.raw_decode(text, skip(skip(i, [':']) + 1))
+        yield cid, cell
+
+        i = skip(i, [',', '}'])
+        if text[i] == '}':
+            return
+        i += 1
+
+
+def cell_columns(cells):
+    """
+    Flatten (cell id, cell) pairs into arrays, cell references kept as ids ('' standing for None)
+
+    :param cells: iterable of (cell id, cell) pairs
+    :return: a dictionary of arrays (see ColumnarSocialContext.from_columns)
+    """
+    ids, sizes, members, category, parents, children, nchild = [], [], [], [], [], [], []
+    categories = {}
+    parent_list = False
+
+    for c, cell in cells:
+        ids.append(str(c))
+        category.append(categories.setdefault(cell['category'], len(categories)))
+
+        p = cell['parent']
+        if isinstance(p, list):
+            parent_list = True
+            p = p[0] if len(p) > 0 else None
+        parents.append('' if p is None else str(p))
+
+        ch = cell['child'] or []
+        children.extend(str(x) for x in ch)
+        nchild.append(len(ch))
+
+        ag = cell['agents'] or []
+        members.extend(ag)
+        sizes.append(len(ag))
+
+    return {
+        'ids': np.asarray(ids, dtype=str),
+        'sizes': np.asarray(sizes, dtype=np.int64),
+        'members': np.asarray(members, dtype=np.int64),
+        'category': np.asarray(category, dtype=np.int16),
+        'categories': list(categories),
+        'parent': np.asarray(parents, dtype=str),
+        'nchild': np.asarray(nchild, dtype=np.int64),
+        'children': np.asarray(children, dtype=str),
+        'parent_list': parent_list
+    }
+
+
+class ContextIndex(object):
+    """
+    Dense int32 interning of context ids.
+
+    The simulation addresses contexts by position only: the (string) ids are kept
+    to resolve user supplied cells and to report results.
+    """
+
+    def __init__(self, ids=()):
+        if isinstance(ids, np.ndarray):
+            self.ids = ids
+        else:
+            self.ids = [str(c) for c in ids]
+        self._positions = None
+
+    @property
+    def positions(self):
+        # built on first access: positional lookups do not need it
+        if self._positions is None:
+            self._positions = {str(c): i for i, c in enumerate(self.ids)}
+        return self._positions
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, cid):
+        return str(cid) in self.positions
+
+    def intern(self, cid):
+        cid = str(cid)
+        p = self.positions.get(cid)
+        if p is None:
+            if isinstance(self.ids, np.ndarray):
+                self.ids = [str(c) for c in self.ids]
+            p = len(self.ids)
+            self.ids.append(cid)
+            self.positions[cid] = p
+        return p
+
+    def position(self, cid):
+        return self.positions[str(cid)]
+
+    def get(self, cid, default=-1):
+        return self.positions.get(str(cid), default)
+
+    def id_of(self, p):
+        if p is None or p < 0:
+            return None
+        return str(self.ids[p])
+
 
 class SocialContext(object):
+    """
+    Cells of a social context (households, census, workplaces, schools).
+
+    Cells can be addressed either by their id (str) or by their position (int) in self.index.
+
+    Cell membership is also kept CSR-style (see membership): once bound to an AgentList
+    (see bind_agents) members are agent rows, translated back to agent ids through agent_ids.
+    """
 
     def __init__(self, cells=None, filename=None, gz=False):
+        self.cells = {}
+        self.index = ContextIndex()
+        self.rows = []
+        self._hierarchy = None
+        self._membership = None
+        self.agents = None
+        self.agent_ids = None
         if cells is not None:
-            self.cells = cells
+            self.add_cells(cells)
         elif filename is not None:
             self.load(filename, gz)
-        else:
-            self.cells = {}
+
+    def add_cells(self, cells):
+        """
+        Add (or replace) cells keeping the positions of the existing ones
+
+        :param cells: dictionary cell id -> cell
+        """
+        for c, cell in cells.items():
+            c = str(c)
+            # references to other cells are kept as ids
+            if cell['parent'] is not None:
+                cell['parent'] = [str(x) for x in cell['parent']] if isinstance(cell['parent'], list) \
+                    else str(cell['parent'])
+            if cell['child'] is not None:
+                cell['child'] = [str(x) for x in cell['child']]
+
+            p = self.index.intern(c)
+            self._hierarchy = None
+            self._membership = None
+            if p < len(self.rows):
+                self.rows[p] = cell
+            else:
+                self.rows.append(cell)
+            self.cells[c] = cell
+
+    def position(self, cell):
+        if isinstance(cell, (int, np.integer)):
+            return int(cell)
+        return self.index.position(cell)
 
     def update(self, filename=None, gz=False):
         if not gz:
             with open(filename) as f:
-                self.cells = json.load(f)
+                self.add_cells(json.load(f))
         else:
             with gzip.open(filename) as f:
-                self.cells = dict(self.cells, **json.load(f))
+                self.add_cells(json.load(f))
+
+    def find(self, cell):
+        """
+        :param cell: cell id or position (or None)
+        :return: the cell position, -1 if the cell is unknown
+        """
+        if cell is None:
+            return -1
+        if isinstance(cell, (int, np.integer)):
+            return int(cell)
+        return self.index.get(cell)
+
+    def membership(self):
+        """
+        CSR membership: the members of the i-th cell are members[offsets[i]:offsets[i+1]]
+
+        :return: (offsets, members), members being agent rows if bound to an AgentList, agent ids otherwise
+        """
+        if self._membership is None:
+            sizes = [len(row['agents'] or []) for row in self.rows]
+            members = np.fromiter((a for row in self.rows for a in row['agents'] or []), dtype=np.int64,
+                                  count=sum(sizes))
+            self._membership = (np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]), members)
+            self.agent_ids = None
+            if self.agents is not None:
+                self.bind_agents(self.agents)
+        return self._membership
+
+    def set_membership(self, offsets, members, agent_ids=None):
+        self._membership = (offsets, members)
+        self.agent_ids = agent_ids
+
+    def bind_agents(self, agents):
+        """
+        Express the cell members as rows of an AgentList (members missing from the population are dropped)
+
+        :param agents: an AgentList
+        """
+        offsets, members = self.membership()
+        if self.agent_ids is not None and (self.agent_ids is agents.columns['aid'] or
+                                           np.array_equal(self.agent_ids, agents.columns['aid'])):
+            # already rows of the same agent table: kept as they are (e.g., memory-mapped from a PopulationStore)
+            self.agents = agents
+            self.set_membership(offsets, members if members.dtype == np.int32 else members.astype(np.int32),
+                                agents.columns['aid'])
+            return
+
+        aids = np.asarray(members) if self.agent_ids is None else self.agent_ids[members]
+        rows = agents.rows_of(aids)
+        known = rows >= 0
+
+        if not np.all(known):
+            warnings.warn(f"{int(np.sum(~known))} cell members not found among the agents: discarded")
+            owner = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(owner[known], minlength=len(offsets) - 1))])
+            rows = rows[known]
+
+        self.agents = agents
+        self.set_membership(offsets, rows if rows.dtype == np.int32 else rows.astype(np.int32),
+                            agents.columns['aid'])
+
+    def get_agents_at(self, i):
+        offsets, members = self.membership()
+        members = members[offsets[i]:offsets[i + 1]]
+        if self.agent_ids is not None:
+            return self.agent_ids[members]
+        return np.asarray(members)
 
     def get_sample_agents(self, cell, activity=1):
-        try:
-            return np.random.choice(self.cells[cell]['agents'], int(len(self.cells[cell]['agents'])*activity))
-        except:
+        i = self.find(cell)
+        if i < 0:
             return []
+        offsets, members = self.membership()
+        members = members[offsets[i]:offsets[i + 1]]
+        sample = np.random.choice(members, int(len(members) * activity))
+        if self.agent_ids is not None:
+            return self.agent_ids[sample]
+        return sample
+
+    def sample_agents(self, cells, activities=1, rows=False):
+        """
+        Draw activity-scaled samples (with replacement) from many cells at once: int(size * activity) members
+        of each cell
+
+        :param cells: array of cell positions (-1 for none)
+        :param activities: array of activity values, one for each cell (or a single value)
+        :param rows: whether to return agent rows (requires bind_agents) instead of agent ids
+        :return: (offsets, sample): the sample of the i-th cell is sample[offsets[i]:offsets[i+1]]
+        """
+        offsets, members = self.membership()
+        if rows and self.agent_ids is None:
+            raise ValueError("Agent rows require a context bound to an AgentList (see bind_agents)")
+
+        cells = np.asarray(cells, dtype=np.int64)
+        if len(offsets) == 1:
+            # empty context: nobody to meet
+            sample = np.asarray([], dtype=members.dtype)
+            if not rows and self.agent_ids is not None:
+                sample = self.agent_ids[sample]
+            return np.zeros(len(cells) + 1, dtype=np.int64), sample
+
+        valid = cells >= 0
+        cells = np.where(valid, cells, 0)
+        start = offsets[cells]
+        sizes = np.where(valid, offsets[cells + 1] - start, 0)
+
+        n = (sizes * np.asarray(activities, dtype=np.float64)).astype(np.int64)
+        owner = np.repeat(np.arange(len(cells)), n)
+        sample = members[start[owner] + np.random.randint(0, sizes[owner])] if len(owner) > 0 else \
+            np.asarray([], dtype=members.dtype)
+
+        if not rows and self.agent_ids is not None:
+            sample = self.agent_ids[sample]
+        return np.concatenate([[0], np.cumsum(n)]), sample
+
+    def members_of(self, cells):
+        """
+        Members of many cells, as agent rows (requires bind_agents)
+
+        :param cells: array of cell positions
+        :return: (offsets, rows): the members of the i-th cell are rows[offsets[i]:offsets[i+1]]
+        """
+        offsets, members = self.membership()
+        if self.agent_ids is None:
+            raise ValueError("Agent rows require a context bound to an AgentList (see bind_agents)")
+
+        cells = np.asarray(cells, dtype=np.int64)
+        start = offsets[cells]
+        sizes = offsets[cells + 1] - start
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        idx = np.repeat(start - bounds[:-1], sizes) + np.arange(bounds[-1])
+        return bounds, np.asarray(members[idx], dtype=np.int64)
+
+    def sample_successes(self, cells, activities, weights):
+        """
+        Binomial shortcut for sample_agents followed by one Bernoulli trial per distinct sampled member: the
+        number of successes in each cell is drawn at once, and only the successful members are then picked. The
+        cost grows with the successes rather than with the cells size.
+
+        :param cells: array of cell positions (-1 for none)
+        :param activities: array of activity values, one for each cell (or a single value)
+        :param weights: success probability of each agent row (0 for agents that cannot be hit)
+        :return: (offsets, rows): the successes of the i-th cell are rows[offsets[i]:offsets[i+1]]
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        valid = cells >= 0
+        involved, where = np.unique(cells[valid], return_inverse=True)
+
+        bounds, members = self.members_of(involved)
+        cumulative = np.cumsum(weights[members], dtype=np.float64)
+        totals = np.concatenate([[0], cumulative])
+        base = totals[bounds[:-1]]
+        total = totals[bounds[1:]] - base
+        sizes = np.diff(bounds)
+
+        # a member is met at least once in int(size * activity) draws with probability 1 - (1 - 1/size)^draws
+        cell = np.full(len(cells), -1, dtype=np.int64)
+        cell[valid] = where
+        size = sizes[where]
+        draws = (size * np.broadcast_to(np.asarray(activities, dtype=np.float64), cells.shape)[valid]).astype(np.int64)
+        met = 1 - (1 - 1 / np.maximum(size, 1)) ** draws
+        n = np.zeros(len(cells), dtype=np.int64)
+        p = np.zeros(len(cells), dtype=np.float64)
+        n[valid] = size
+        p[valid] = np.minimum(met * total[where] / np.maximum(size, 1), 1)
+        k = np.random.binomial(n, p)
+
+        # successful members, proportionally to their weight
+        owner = np.repeat(cell, k)
+        x = base[owner] + np.random.random_sample(len(owner)) * total[owner]
+        idx = np.searchsorted(cumulative, x, side='right')
+        idx = np.clip(idx, bounds[owner], bounds[owner + 1] - 1)
+        return np.concatenate([[0], np.cumsum(k)]), members[idx]
 
     def get_category(self, cell):
-        if self.cells[cell]['parent'] is not None:
-            parent = self.cells[cell]['parent']
-            return self.cells[parent]['category']
+        row = self.rows[self.position(cell)]
+        if row['parent'] is not None:
+            parent = row['parent']
+            return self.rows[self.position(parent)]['category']
 
-        return self.cells[cell]['category']
+        return row['category']
 
     def get_parent(self, cell):
-        return self.cells[cell]['parent']
+        return self.rows[self.position(cell)]['parent']
 
     def get_child(self, cell):
-        return self.cells[cell]['child']
+        return self.rows[self.position(cell)]['child']
+
+    def hierarchy(self):
+        """
+        Flat parent/children arrays of the cells, built once (and rebuilt only when cells are added)
+
+        :return: (parent, child_offsets, children): parent[i] is the position of the (first) parent of the i-th
+                 cell, -1 if none, and parent[-1] == -1 so that -1 propagates when walking up the hierarchy;
+                 the children of the i-th cell are children[child_offsets[i]:child_offsets[i+1]]
+        """
+        if self._hierarchy is None:
+            parent = np.full(len(self.rows) + 1, -1, dtype=np.int32)
+            nchild, children = [], []
+            for i, row in enumerate(self.rows):
+                p = row['parent']
+                if isinstance(p, list):
+                    p = p[0] if len(p) > 0 else None
+                if p is not None:
+                    parent[i] = self.index.get(p)
+                ch = [x for x in (self.index.get(c) for c in row['child'] or []) if x >= 0]
+                children.extend(ch)
+                nchild.append(len(ch))
+            self._hierarchy = (parent, np.concatenate([[0], np.cumsum(nchild, dtype=np.int64)]),
+                               np.asarray(children, dtype=np.int32))
+        return self._hierarchy
+
+    def positions_of(self, cells):
+        """
+        :param cells: a cell (id or position) or an array of cell positions
+        :return: the cell position(s)
+        """
+        if isinstance(cells, str):
+            return self.index.position(cells)
+        return np.asarray(cells, dtype=np.int64)
+
+    def parent_of(self, cells, levels=1):
+        """
+        Vectorized ancestor lookup
+
+        :param cells: a cell (id or position) or an array of cell positions
+        :param levels: number of levels to walk up
+        :return: the position(s) of the ancestors, -1 where missing
+        """
+        parent = self.hierarchy()[0]
+        positions = self.positions_of(cells)
+        for _ in range(levels):
+            positions = parent[positions]
+        return positions
+
+    # census hierarchy: census cell -> municipality -> province -> region
+
+    def municipality_of(self, cells):
+        return self.parent_of(cells, 1)
+
+    def province_of(self, cells):
+        return self.parent_of(cells, 2)
+
+    def region_of(self, cells):
+        return self.parent_of(cells, 3)
+
+    def sample_children(self, cells, exclude=None):
+        """
+        Draw a child of each cell uniformly at random
+
+        :param cells: array of cell positions
+        :param exclude: (optional) array of child positions, one for each cell, not to be drawn
+        :return: array of child positions, -1 for cells without (other) children
+        """
+        parent, child_offsets, children = self.hierarchy()
+        cells = np.asarray(cells, dtype=np.int64)
+        valid = cells >= 0
+        start = np.where(valid, child_offsets[np.where(valid, cells, 0)], 0)
+        n = np.where(valid, child_offsets[np.where(valid, cells, 0) + 1] - start, 0)
+
+        if exclude is not None:
+            # position of each child among its siblings
+            rank = np.zeros(len(parent), dtype=np.int64)
+            rank[children] = np.arange(len(children)) - np.repeat(child_offsets[:-1], np.diff(child_offsets))
+            exclude = np.asarray(exclude, dtype=np.int64)
+            excluded = (exclude >= 0) & (parent[exclude] == cells) & valid
+            n = n - excluded
+
+        pick = (np.random.random_sample(len(cells)) * n).astype(np.int64)
+        if exclude is not None:
+            pick += excluded & (pick >= rank[exclude])
+        if len(children) == 0:
+            return np.full(len(cells), -1, dtype=np.int64)
+        return np.where(n > 0, children[np.minimum(start + pick, len(children) - 1)], -1)
+
+    def children_of(self, cell):
+        """
+        :param cell: cell id or position
+        :return: array of the positions of the children of the cell (empty for leaves)
+        """
+        _, child_offsets, children = self.hierarchy()
+        i = self.position(cell)
+        return children[child_offsets[i]:child_offsets[i + 1]]
 
     def load(self, filename, gz=False):
-        if not gz:
-            with open(filename) as f:
-                self.cells = json.load(f)
-        else:
-            with gzip.open(filename) as f:
-                self.cells = json.load(f)
+        self.cells, self.index, self.rows = {}, ContextIndex(), []
+        self._hierarchy, self._membership = None, None
+        self.update(filename, gz)
 
     def get_contexts(self, leaf=True):
         for c in self.cells:
@@ -89,12 +586,254 @@ class SocialContext(object):
                 yield c
 
 
+class CellTable(Mapping):
+    """
+    Read-only dict-like view over a ColumnarSocialContext: cells are materialized
+    in the JSON layout only when accessed.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    def __getitem__(self, cell):
+        i = self.context.position(cell)
+        return {
+            'category': self.context.get_category_at(i),
+            'parent': self.context.get_parent(cell),
+            'child': self.context.get_child(cell),
+            'agents': self.context.get_agents_at(i).tolist()
+        }
+
+    def __iter__(self):
+        return (str(c) for c in self.context.ids)
+
+    def __len__(self):
+        return len(self.context.ids)
+
+    def __contains__(self, cell):
+        return cell in self.context.index
+
+
+class ColumnarSocialContext(SocialContext):
+    """
+    SocialContext backed by flat arrays (possibly memory-mapped) instead of nested dicts.
+
+    Cell membership is stored CSR-style: the agents of the i-th cell are
+    members[offsets[i]:offsets[i+1]]. When agent_ids is given, members are rows of
+    that array (i.e., dense agent positions) and are translated back to agent ids on output.
+    """
+
+    def __init__(self, ids, offsets, members, category, categories, parent, child_offsets, children,
+                 agent_ids=None, parent_list=False):
+        self.ids = ids
+        self.offsets = offsets
+        self.members = members
+        self.category = category
+        self.categories = categories
+        self.parent = parent
+        self.child_offsets = child_offsets
+        self.children = children
+        self.agent_ids = agent_ids
+        self.parent_list = parent_list
+        self.index = ContextIndex(ids)
+        self.cells = CellTable(self)
+        self._hierarchy = None
+        self.agents = None
+
+    @classmethod
+    def from_columns(cls, parts):
+        """
+        Build a columnar context merging flattened cells (see cell_columns)
+
+        :param parts: list of flattened cells, e.g. one for each source file
+        :return: a ColumnarSocialContext (members are agent ids)
+        """
+        categories = []
+        for part in parts:
+            categories.extend(c for c in part['categories'] if c not in categories)
+
+        def concatenate(key, dtype):
+            return np.concatenate([np.asarray([], dtype=dtype)] + [part[key] for part in parts]).astype(dtype)
+
+        # per source category codes -> merged category codes
+        category = [np.asarray([], dtype=np.int16)]
+        for part in parts:
+            remap = np.asarray([categories.index(c) for c in part['categories']] + [-1], dtype=np.int16)
+            category.append(remap[part['category']])
+        category = np.concatenate(category)
+
+        ids = concatenate('ids', str)
+        sizes = concatenate('sizes', np.int64)
+        members = concatenate('members', np.int64)
+        parent = concatenate('parent', str)
+        nchild = concatenate('nchild', np.int64)
+        children = concatenate('children', str)
+
+        # a cell found in several sources is taken from the last one
+        last = {c: i for i, c in enumerate(ids.tolist())}
+        if len(last) < len(ids):
+            keep = np.zeros(len(ids), dtype=bool)
+            keep[list(last.values())] = True
+            members = members[np.repeat(keep, sizes)]
+            children = children[np.repeat(keep, nchild)]
+            ids, sizes, category, parent, nchild = ids[keep], sizes[keep], category[keep], parent[keep], nchild[keep]
+
+        index = ContextIndex(ids)
+
+        def positions(refs):
+            return np.asarray([index.get(r) for r in refs.tolist()], dtype=np.int32)
+
+        # references to unknown cells are dropped
+        children = positions(children)
+        owner = np.repeat(np.arange(len(ids)), nchild)
+        known = children >= 0
+        nchild = np.bincount(owner[known], minlength=len(ids))
+
+        return cls(ids, np.concatenate([[0], np.cumsum(sizes)]), members, category, categories, positions(parent),
+                   np.concatenate([[0], np.cumsum(nchild)]), children[known],
+                   parent_list=any(part['parent_list'] for part in parts))
+
+    @classmethod
+    def from_cells(cls, cells):
+        """
+        Build a columnar context from (cell id, cell) pairs
+
+        :param cells: iterable of (cell id, cell) pairs, e.g. as streamed by iter_cells
+        :return: a ColumnarSocialContext (members are agent ids)
+        """
+        return cls.from_columns([cell_columns(cells)])
+
+    def update(self, filename=None, gz=False):
+        raise NotImplementedError("Columnar contexts are compiled with all their sources already merged")
+
+    def load(self, filename, gz=False):
+        raise NotImplementedError("Columnar contexts are loaded from a PopulationStore")
+
+    def membership(self):
+        return self.offsets, self.members
+
+    def set_membership(self, offsets, members, agent_ids=None):
+        self.offsets, self.members, self.agent_ids = offsets, members, agent_ids
+
+    def get_category_at(self, i):
+        return self.categories[self.category[i]]
+
+    def hierarchy(self):
+        if self._hierarchy is None:
+            self._hierarchy = (np.append(self.parent, np.int32(-1)).astype(np.int32), self.child_offsets,
+                               self.children)
+        return self._hierarchy
+
+    def get_category(self, cell):
+        i = self.position(cell)
+        if self.parent[i] >= 0:
+            return self.get_category_at(self.parent[i])
+        return self.get_category_at(i)
+
+    def get_parent(self, cell):
+        p = self.parent[self.position(cell)]
+        if p < 0:
+            return None
+        if self.parent_list:
+            return [str(self.ids[p])]
+        return str(self.ids[p])
+
+    def get_child(self, cell):
+        i = self.position(cell)
+        children = self.children[self.child_offsets[i]:self.child_offsets[i + 1]]
+        if len(children) == 0:
+            return None
+        return [str(self.ids[c]) for c in children]
+
+    def get_contexts(self, leaf=True):
+        if leaf:
+            nchild = np.diff(self.child_offsets)
+            for i in np.flatnonzero(nchild == 0):
+                yield str(self.ids[i])
+        else:
+            for c in self.ids:
+                yield str(c)
+
+
+class ActivityLayer(object):
+    """
+    Daily attendance of the cells of a context. The attendance of a cell is drawn the first time it is needed in
+    a day, then shared by all the agents meeting there until reset.
+
+    This changes the contact semantics of SocialContext.sample_agents, where each agent draws int(size *
+    activity) contacts of its own: here every agent of a cell meets all of today's attending members. A member
+    attends with the probability that an agent with its activity meets a given member, 1 - (1 - 1/size)^int(size
+    * activity), so that with a uniform activity the expected contacts of each agent are the ones of
+    sample_agents. Their variance differs: the agents of a cell meet the same members, and the absent ones are
+    met by nobody. Epidemics over the layers are therefore more clustered, and their outcome departs from the
+    one of independent contacts, the more so at high transmission rates.
+    """
+
+    def __init__(self, context, activity):
+        """
+        :param context: a SocialContext bound to an AgentList
+        :param activity: activity of each agent (indexed by agent row), or a single value
+        """
+        self.context = context
+        self.activity = activity
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new day: the attendance of every cell is drawn anew
+        """
+        self.start = np.full(len(self.context.index), -1, dtype=np.int64)
+        self.size = np.zeros(len(self.context.index), dtype=np.int64)
+        self.present = [np.asarray([], dtype=np.int64)]
+        self.length = 0
+
+    def __draw(self, cells):
+        bounds, members = self.context.members_of(cells)
+        activity = self.activity if np.isscalar(self.activity) else self.activity[members]
+        owner = np.repeat(np.arange(len(cells)), np.diff(bounds))
+        size = np.diff(bounds)[owner]
+        present = np.random.random_sample(len(members)) < 1 - (1 - 1 / size) ** np.floor(size * activity)
+        self.size[cells] = np.bincount(owner[present], minlength=len(cells))
+        self.start[cells] = self.length + np.concatenate([[0], np.cumsum(self.size[cells])[:-1]])
+        self.present.append(members[present])
+        self.length += int(present.sum())
+
+    def sample(self, cells, activities=None):
+        """
+        Today's attendance of many cells
+
+        :param cells: array of cell positions (-1 for none)
+        :param activities: unused, the attendance depends on the activity of the members
+        :return: (offsets, rows): the attending agent rows of the i-th cell are rows[offsets[i]:offsets[i+1]]
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        if len(self.context.index) == 0:
+            # empty context: nobody to meet
+            return np.zeros(len(cells) + 1, dtype=np.int64), np.asarray([], dtype=np.int64)
+
+        valid = cells >= 0
+        missing = np.unique(cells[valid])
+        missing = missing[self.start[missing] < 0]
+        if len(missing) > 0:
+            self.__draw(missing)
+        if len(self.present) > 1:
+            self.present = [np.concatenate(self.present)]
+
+        cells = np.where(valid, cells, 0)
+        start = self.start[cells]
+        sizes = np.where(valid, self.size[cells], 0)
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        idx = np.repeat(start - bounds[:-1], sizes) + np.arange(bounds[-1])
+        return bounds, self.present[0][idx]
+
+
 class Contexts(object):
 
     def __init__(self, households: SocialContext, census: SocialContext,
                  workplaces: SocialContext = None, schools: SocialContext = None, activeness: SocialActiveness=None):
 
         self.activeness = activeness
+        self.agents = None
         self.contexts = {
             'households': households,
             'census': census,
@@ -102,6 +841,51 @@ class Contexts(object):
             'schools': schools
         }
 
+    def bind(self, agents):
+        """
+        Align the context positions held by the agents with the ones of these contexts, express the cell
+        members as agent rows and compile the agents activeness
+
+        :param agents: an AgentList
+        """
+        for name, field in CONTEXT_FIELDS.items():
+            if self.contexts[name] is not None:
+                agents.rebind(field, self.contexts[name].index)
+                self.contexts[name].bind_agents(agents)
+        if self.activeness is not None:
+            self.activeness.bind(agents)
+        self.agents = agents
+
+    def activity_layers(self):
+        """
+        Daily attendance layers of the census cells, workplaces and schools (see ActivityLayer and bind)
+
+        :return: context name -> ActivityLayer
+        """
+        layers = {}
+        for name, category in [('census', 'census'), ('workplaces', 'work'), ('schools', 'school')]:
+            if self.contexts[name] is not None:
+                activity = 1 if self.activeness is None else self.activeness.get_values(
+                    np.arange(self.agents.number_of_nodes()), category)
+                layers[name] = ActivityLayer(self.contexts[name], activity)
+        return layers
+
+    def incidence(self, name):
+        """
+        Sparse agent x cell incidence matrix of a context (see bind): entry (row, cell) is 1 if the agent is a
+        member of the cell
+
+        :param name: context name
+        :return: a scipy.sparse csr_matrix
+        """
+        import scipy.sparse
+
+        context = self.contexts[name]
+        bounds, members = context.members_of(np.arange(len(context.index)))
+        cells = np.repeat(np.arange(len(context.index)), np.diff(bounds))
+        return scipy.sparse.csr_matrix((np.ones(len(members)), (members, cells)),
+                                       shape=(self.agents.number_of_nodes(), len(context.index)))
+
     def get_household(self, hid):
         return self.contexts['households'].get_sample_agents(hid)
 
@@ -123,13 +907,29 @@ class Contexts(object):
     def get_school_category(self, wid):
         return self.contexts['schools'].get_category(wid)
 
+    def cell_of(self, agent, name):
+        """
+        Position of the cell of an agent in a context: the positions held by an AgentList bound to these contexts
+        (see bind) are used as they are, the ids of any other agent are resolved by the context
+
+        :param agent: an Agent (or AgentView)
+        :param name: context name
+        :return: the cell position, -1 if none or unknown
+        """
+        field = CONTEXT_FIELDS[name]
+        context = self.contexts[name]
+        if isinstance(agent, AgentView) and agent.agents.context_index[field] is context.index:
+            return int(agent.agents.columns[field][agent.row])
+        cid = getattr(agent, field)
+        return -1 if cid is None else context.index.get(cid)
+
     def get_neighbors(self, agent, restrictions=False, weekend=False, other_census=None):
-        household = self.get_household(agent.household)
+        household = self.get_household(self.cell_of(agent, 'households'))
         if not restrictions:
 
             activeness = self.activeness.get_value(agent, 'census')
             if other_census is None:
-                census = self.get_census_sample(agent.census, activeness)
+                census = self.get_census_sample(self.cell_of(agent, 'census'), activeness)
             else:
                 census = self.get_census_sample(other_census, activeness)
 
@@ -138,71 +938,513 @@ class Contexts(object):
             if not weekend:
                 if agent.work is not None:
                     activeness = self.activeness.get_value(agent, 'work')
-                    work = self.get_workplace_sample(agent.work, activeness)
+                    work = self.get_workplace_sample(self.cell_of(agent, 'workplaces'), activeness)
                 if agent.school is not None:
                     activeness = self.activeness.get_value(agent, 'school')
-                    school = self.get_school_sample(agent.school, activeness)
+                    school = self.get_school_sample(self.cell_of(agent, 'schools'), activeness)
 
             return list(set(household) | set(census) | set(work) | set(school))
         return list(household)
 
+    def sample_contacts(self, rows, restrictions=False, weekend=False, census=None, samplers=None, households=True):
+        """
+        Batched get_neighbors: contacts of many agents at once (see bind)
+
+        :param rows: agent rows
+        :param restrictions: whether to consider household contacts only
+        :param weekend: whether to skip work and school contacts
+        :param census: (optional) census cell to visit for each agent, instead of its own
+        :param samplers: (optional) context name -> sampler replacing the one of the context, such as a
+                         SusceptibleIndex (only the susceptible contacts are sampled) or an ActivityLayer (the
+                         contacts are today's attending members)
+        :param households: whether to sample the household contacts
+        :return: (owner, contacts): for each contact, the position in rows of the agent meeting it and its agent row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = self.agents.columns
+        owners, contacts = [], []
+
+        def sample(name, cells, category=None):
+            if category is None or self.activeness is None:
+                activity = 1
+            else:
+                activity = self.activeness.get_values(rows, category)
+            if samplers is not None and name in samplers:
+                offsets, sample = samplers[name].sample(cells, activity)
+            else:
+                offsets, sample = self.contexts[name].sample_agents(cells, activity, rows=True)
+            owners.append(np.repeat(np.arange(len(rows)), np.diff(offsets)))
+            contacts.append(sample)
+
+        if households:
+            sample('households', columns['household'][rows])
+            if restrictions:
+                return owners[0], contacts[0]
+        elif restrictions:
+            return np.asarray([], dtype=np.int64), np.asarray([], dtype=np.int64)
+
+        sample('census', columns['census'][rows] if census is None else census, 'census')
+        if not weekend:
+            for name, field, category in [('workplaces', 'work', 'work'), ('schools', 'school', 'school')]:
+                if self.contexts[name] is not None:
+                    sample(name, columns[field][rows], category)
+
+        # the contacts of each agent are a set
+        n = max(self.agents.number_of_nodes(), 1)
+        key = np.unique(np.concatenate(owners).astype(np.int64) * n + np.concatenate(contacts))
+        return key // n, key % n
+
+    def sample_infections(self, rows, weights, weekend=False, census=None):
+        """
+        Binomial counterpart of sample_contacts (see SocialContext.sample_successes) for the census, work and
+        school contacts: only the contacts succeeding in their Bernoulli trial are returned
+
+        :param rows: agent rows
+        :param weights: success probability of each agent row
+        :param weekend: whether to skip work and school contacts
+        :param census: (optional) census cell to visit for each agent, instead of its own
+        :return: (owner, contacts): for each success, the position in rows of the agent meeting it and its agent row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = self.agents.columns
+        owners, contacts = [np.asarray([], dtype=np.int64)], [np.asarray([], dtype=np.int64)]
+
+        def sample(name, cells, category):
+            activity = 1 if self.activeness is None else self.activeness.get_values(rows, category)
+            offsets, sample = self.contexts[name].sample_successes(cells, activity, weights)
+            owners.append(np.repeat(np.arange(len(rows)), np.diff(offsets)))
+            contacts.append(sample)
+
+        sample('census', columns['census'][rows] if census is None else census, 'census')
+        if not weekend:
+            for name, field, category in [('workplaces', 'work', 'work'), ('schools', 'school', 'school')]:
+                if self.contexts[name] is not None:
+                    sample(name, columns[field][rows], category)
+
+        n = max(self.agents.number_of_nodes(), 1)
+        key = np.unique(np.concatenate(owners) * n + np.concatenate(contacts))
+        return key // n, key % n
+
+
+# agent columns (rows of the AgentList) and their types
+AGENT_COLUMNS = {'aid': np.int64, 'age': np.int16, 'gender': np.int8, 'household': np.int32, 'census': np.int32,
+                 'work': np.int32, 'school': np.int32}
+
 
 class AgentList(object):
+    """
+    Population of agents, stored column-wise: each agent is a row of typed arrays (possibly memory-mapped).
 
-    def __init__(self, filename=None, gz=False):
+    Agent household, census, work and school are given and exposed as ids, and stored as positions in the
+    matching context_index table (see Contexts.bind to align them with the loaded contexts); age and gender
+    are positions in the ages and genders tables (ages can be classes, e.g. "80+"); -1 stands for None.
+    Rows keep the insertion order of the agents.
+
+    get_agent returns a lightweight AgentView over a row: hot paths should read the columns directly.
+    """
 
-        self.population = {}
+    def __init__(self, filename=None, gz=False, columns=None, genders=None, ages=None, context_index=None):
+        """
+        :param filename: (optional) agents file (one JSON object per row)
+        :param gz: whether the file is gzipped
+        :param columns: (optional) agent columns, see AGENT_COLUMNS
+        :param genders: genders table of the columns
+        :param ages: ages table of the columns
+        :param context_index: context_index tables of the columns
+        """
+        if columns is None:
+            columns = {c: np.empty(0, dtype=t) for c, t in AGENT_COLUMNS.items()}
+        self._columns = columns
+        self.genders = list(genders or [])
+        self.ages = list(ages or [])
+        if context_index is None:
+            context_index = {field: ContextIndex() for field in CONTEXT_FIELDS.values()}
+        self.context_index = context_index
+        self.population = AgentTable(self)
+
+        self._pending = []
+        self._lookup = None
+        self._codes = None
         if filename is not None:
             self.load(filename, gz)
 
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build an agent list
+
+        :param rows: iterable of agents as dictionaries (the rows of an agents file)
+        :return: an AgentList
+        """
+        agents = cls()
+        agents.add_rows(rows)
+        return agents
+
+    @property
+    def columns(self):
+        if len(self._pending) > 0:
+            self.__flush()
+        return self._columns
+
     def number_of_nodes(self):
-        return len(self.population)
+        return len(self.columns['aid'])
+
+    def __code(self, field, value):
+        if value is None:
+            return -1
+        if self._codes is None:
+            self._codes = {'age': {v: i for i, v in enumerate(self.ages)},
+                           'gender': {v: i for i, v in enumerate(self.genders)}}
+        codes = self._codes[field]
+        c = codes.get(value)
+        if c is None:
+            c = codes[value] = len(codes)
+            (self.ages if field == 'age' else self.genders).append(value)
+        return c
 
     def add_agent(self, agent):
-        self.population[agent.aid] = agent
+        # context ids (numeric ones included) are interned
+        self._pending.append([agent.aid, self.__code('age', agent.age), self.__code('gender', agent.gender)] +
+                             [-1 if getattr(agent, f) is None else self.context_index[f].intern(getattr(agent, f))
+                              for f in CONTEXT_FIELDS.values()])
+
+    def add_rows(self, rows):
+        """
+        Add agents given as dictionaries, their context ids being interned
+
+        :param rows: iterable of agents as dictionaries (the rows of an agents file)
+        """
+        for ag in rows:
+            self._pending.append([ag['aid'], self.__code('age', ag['age']), self.__code('gender', ag['gender'])] +
+                                 [-1 if ag[f] is None else self.context_index[f].intern(ag[f])
+                                  for f in CONTEXT_FIELDS.values()])
+
+    def __flush(self):
+        pending = np.asarray(self._pending, dtype=np.int64).reshape(-1, len(AGENT_COLUMNS))
+        self._pending = []
+        columns = {c: np.concatenate([self._columns[c], pending[:, i].astype(t)])
+                   for i, (c, t) in enumerate(AGENT_COLUMNS.items())}
+
+        # an agent added twice keeps its first row and its last values
+        aid = columns['aid']
+        _, first = np.unique(aid, return_index=True)
+        if len(first) < len(aid):
+            _, last = np.unique(aid[::-1], return_index=True)
+            keep = (len(aid) - 1 - last)[np.argsort(first)]
+            columns = {c: v[keep] for c, v in columns.items()}
+
+        self._columns = columns
+        self._lookup = None
+
+    def __index(self):
+        # aid -> row: a direct table (from the smallest aid) when aids are dense enough, a sorted permutation otherwise
+        if self._lookup is None:
+            aid = self.columns['aid']
+            base = int(aid.min()) if len(aid) > 0 else 0
+            span = int(aid.max()) - base + 1 if len(aid) > 0 else 0
+            if span < 2 * len(aid) + 2**16:
+                table = np.full(span, -1, dtype=np.int32)
+                table[aid - base] = np.arange(len(aid), dtype=np.int32)
+                self._lookup = (table, base, None)
+            else:
+                order = np.argsort(aid, kind='stable')
+                self._lookup = (np.asarray(aid[order]), 0, order.astype(np.int32))
+        return self._lookup
+
+    def row_of(self, aid):
+        table, base, order = self.__index()
+        if order is None:
+            i = aid - base
+            if 0 <= i < len(table):
+                row = int(table[i])
+                if row >= 0:
+                    return row
+            return None
+        pos = int(np.searchsorted(table, aid))
+        if pos < len(table) and table[pos] == aid:
+            return int(order[pos])
+        return None
+
+    def rows_of(self, aids):
+        """
+        Vectorized row_of
+
+        :param aids: array of agent ids
+        :return: array of their rows, -1 for unknown agents
+        """
+        aids = np.asarray(aids, dtype=np.int64)
+        table, base, order = self.__index()
+        if len(table) == 0:
+            return np.full(len(aids), -1, dtype=np.int32)
+        if order is None:
+            i = aids - base
+            inside = (i >= 0) & (i < len(table))
+            return np.where(inside, table[np.where(inside, i, 0)], -1).astype(np.int32)
+        pos = np.searchsorted(table, aids)
+        pos[pos == len(table)] = 0
+        return np.where(table[pos] == aids, order[pos], -1).astype(np.int32)
 
     def get_agent(self, aid):
-        return self.population[aid]
+        row = self.row_of(aid)
+        if row is None:
+            raise KeyError(aid)
+        return AgentView(self, row)
+
+    def get_agent_at(self, row):
+        return AgentView(self, row)
+
+    def codes(self, field):
+        """
+        Encoded agent attribute
+
+        :param field: age or gender
+        :return: (table, codes): the distinct values of the attribute and, for each agent row, the position of its
+                 value in the table (-1 for None)
+        """
+        return {'age': self.ages, 'gender': self.genders}[field], self.columns[field]
+
+    def rebind(self, field, index):
+        """
+        Express the field in terms of another context index
+
+        :param field: household, census, work or school
+        :param index: the target ContextIndex
+        """
+        old = self.context_index[field]
+        if old is index:
+            return
+
+        remap = np.array([index.get(c) for c in old.ids] + [-1], dtype=np.int32)
+        column = remap[self.columns[field]]  # -1 (None) picks the trailing -1
+        missing = int(np.sum((column < 0) & (self.columns[field] >= 0)))
+        if missing > 0:
+            warnings.warn(f"{missing} agents refer to a {field} not found among the contexts: set to None")
+
+        self.columns[field] = column
+        self.context_index[field] = index
 
     def load(self, filename, gz=False):
+        opener = gzip.open if gz else open
+        with opener(filename) as f:
+            self.add_rows(json.loads(row) for row in f)
 
-        if not gz:
-            with open(filename) as f:
-                for row in f:
-                    ag = json.loads(row)
-                    ag = Agent(ag['aid'], ag['household'], ag['census'], ag['gender'], ag['age'],
-                               ag['work'], ag['school'])
-                    self.add_agent(ag)
-        else:
-            with gzip.open(filename) as f:
-                for row in f:
-                    ag = json.loads(row)
-                    ag = Agent(ag['aid'], ag['household'], ag['census'], ag['gender'], ag['age'],
-                               ag['work'], ag['school'])
-                    self.add_agent(ag)
+
+class AgentTable(Mapping):
+    """
+    Read-only dict-like view (aid -> AgentView) over an AgentList.
+    """
+
+    def __init__(self, agents):
+        self.agents = agents
+
+    def __getitem__(self, aid):
+        return self.agents.get_agent(aid)
+
+    def __iter__(self):
+        return iter(self.agents.columns['aid'].tolist())
+
+    def __len__(self):
+        return self.agents.number_of_nodes()
+
+    def __contains__(self, aid):
+        return self.agents.row_of(aid) is not None
+
+    def items(self):
+        for row, aid in enumerate(self.agents.columns['aid'].tolist()):
+            yield aid, AgentView(self.agents, row)
+
+    def values(self):
+        for row in range(len(self)):
+            yield AgentView(self.agents, row)
 
 
 class ContactHistory(object):
+    """
+    Contacts of the agents over the last days, for contact tracing.
+
+    A ring buffer of daily buckets, bucket t % days holding the contacts of day t as packed int arrays (owner,
+    contact): the days older than the window are dropped, in O(1), when their bucket is reused. Deleting the
+    history of an agent is O(1) as well: its position in the latest bucket is recorded, and its older contacts
+    are skipped when read.
+    """
+
+    def __init__(self, days=1):
+        """
+        :param days: number of days to keep (0 to keep none)
+        """
+        self.days = 0
+        self.latest = -1
+        self.resize(days)
+
+    def resize(self, days):
+        """
+        Change the number of days kept, keeping the most recent ones
 
-    def __init__(self):
-        self.agent_to_queue = defaultdict(list)
+        :param days: number of days to keep (0 to keep none)
+        """
+        buckets = [(self.day[i], self.owners[i], self.contacts[i], self.deleted[i]) for i in range(self.days)
+                   if self.day[i] >= 0]
+        self.days = max(int(days), 0)
+        self.day = [-1] * self.days
+        self.owners = [array('q') for _ in range(self.days)]
+        self.contacts = [array('q') for _ in range(self.days)]
+        self.deleted = [{} for _ in range(self.days)]
+        for t, owners, contacts, deleted in sorted(buckets, key=lambda b: b[0]):
+            if t > self.latest - self.days:
+                i = t % self.days
+                self.day[i], self.owners[i], self.contacts[i], self.deleted[i] = t, owners, contacts, deleted
+
+    def __bucket(self, t):
+        # bucket of day t, reset when it holds an older day; None if the day is out of the window
+        if self.days == 0 or t <= self.latest - self.days:
+            return None
+        i = t % self.days
+        if self.day[i] != t:
+            self.day[i], self.owners[i], self.contacts[i], self.deleted[i] = t, array('q'), array('q'), {}
+        self.latest = max(self.latest, t)
+        return i
 
     def add_to_queue(self, node, queue):
-        self.agent_to_queue[node].extend(queue)
+        """
+        :param node: agent id
+        :param queue: (contact id, iteration) pairs
+        """
+        for aid, t in queue:
+            i = self.__bucket(t)
+            if i is not None:
+                self.owners[i].append(node)
+                self.contacts[i].append(aid)
 
     def get_contacts(self, node, iteration, delta_iteration):
-        queue = self.agent_to_queue[node]
-        res = [aid for aid, t in queue if delta_iteration <= iteration-t]
-        return res
+        """
+        :param node: agent id
+        :param iteration: current iteration
+        :param delta_iteration: number of days to look back (the current one included)
+        :return: the contacts of the agent over the last delta_iteration days, oldest first
+        """
+        return self.get_contacts_of([node], iteration, delta_iteration)[1].tolist()
+
+    def get_contacts_of(self, nodes, iteration, delta_iteration):
+        """
+        Batched get_contacts: a single pass over the buckets, whatever the number of agents
+
+        :param nodes: distinct agent ids
+        :param iteration: current iteration
+        :param delta_iteration: number of days to look back (the current one included)
+        :return: (owner, contacts): for each contact, oldest first, the position in nodes of the agent and the
+                 contact id
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        order = np.argsort(nodes, kind='stable')
+        keys = nodes[order]
+        days = [t for t in range(iteration, max(iteration - min(delta_iteration, self.days), -1), -1)
+                if self.day[t % self.days] == t]
+
+        # latest deletion of each agent: its contacts recorded before it are skipped
+        cut_day = np.full(len(nodes), -1, dtype=np.int64)
+        cut_at = np.zeros(len(nodes), dtype=np.int64)
+        for t in days:
+            deleted = self.deleted[t % self.days]
+            for k in np.flatnonzero(cut_day < 0).tolist() if len(deleted) > 0 else []:
+                if int(nodes[k]) in deleted:
+                    cut_day[k], cut_at[k] = t, deleted[int(nodes[k])]
+
+        owner, contacts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for t in days[::-1]:
+            i = t % self.days
+            owners = np.frombuffer(self.owners[i], dtype=np.int64)
+            if len(owners) == 0 or len(keys) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(keys, owners), len(keys) - 1)
+            idx = np.flatnonzero(keys[pos] == owners)
+            k = order[pos[idx]]
+            keep = (cut_day[k] < t) | (cut_day[k] == t) & (idx >= cut_at[k])
+            owner.append(k[keep])
+            contacts.append(np.frombuffer(self.contacts[i], dtype=np.int64)[idx[keep]])
+        return np.concatenate(owner), np.concatenate(contacts)
 
     def compact_queue(self, node, iteration, delta_iteration):
-        self.agent_to_queue[node] = [(n, t) for n, t in self.agent_to_queue[node] if delta_iteration <= iteration-t]
+        """
+        Nothing left to do: the days out of the window are dropped as the ring buffer rotates
+        """
 
     def delete(self, node):
-        if node in self.agent_to_queue:
-            del self.agent_to_queue[node]
-        elif str(node) in self.agent_to_queue:
-            del self.agent_to_queue[str(node)]
+        """
+        Forget the contacts of an agent recorded so far
+
+        :param node: agent id
+        """
+        i = None if self.latest < 0 else self.__bucket(self.latest)
+        if i is not None:
+            self.deleted[i][node] = len(self.owners[i])
+
+
+def _peak_memory():
+    # peak resident set size of the current process (MB)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _load_source(kind, filename, gz):
+    start = time.time()
+    if kind == 'agents':
+        opener = gzip.open if gz else open
+        with opener(filename) as f:
+            data = AgentList.from_rows(json.loads(row) for row in f)
+        size = data.number_of_nodes()
+    else:
+        data = cell_columns(iter_cells(filename, gz))
+        size = len(data['ids'])
+
+    return data, {'file': filename, 'items': size, 'seconds': time.time() - start, 'peak_memory': _peak_memory()}
+
+
+def load_region(region, data_dir="italy_data", processes=None, gz=True):
+    """
+    Load a region decoding its source files concurrently
+
+    :param region: a Regions value (or its numeric code)
+    :param data_dir: root of the JSON data
+    :param processes: number of worker processes (default: one per source file, up to the available CPUs)
+    :param gz: whether the sources are gzipped
+    :return: the Contexts, the AgentList and the load report (file, items, seconds, peak_memory (MB) of the
+             worker) for each source file
+    """
+    r = getattr(region, 'value', region)
+    ext = 'json.gz' if gz else 'json'
+    sources = {
+        'agents': ['agents'],
+        'census': ['census'],
+        'households': ['households'],
+        'workplaces': ['private_sector', 'public_sector'],
+        'schools': ['schools', 'universities']
+    }
+    tasks = [(name, os.path.join(data_dir, s, f"{s}_{r}.{ext}")) for name, ss in sources.items() for s in ss]
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+
+    # a fresh worker per file keeps the reported peak memory per file
+    with Pool(processes, maxtasksperchild=1) as pool:
+        results = pool.starmap(_load_source, [('agents' if name == 'agents' else 'cells', f, gz)
+                                              for name, f in tasks])
+
+    report = [stats for _, stats in results]
+    parts = defaultdict(list)
+    for (name, _), (data, _) in zip(tasks, results):
+        parts[name].append(data)
+
+    agents = parts.pop('agents')[0]
+    contexts = {name: ColumnarSocialContext.from_columns(p) for name, p in parts.items()}
+    activeness = SocialActiveness(filename=os.path.join(data_dir, 'activeness.json'))
+
+    ctx = Contexts(contexts['households'], contexts['census'], contexts['workplaces'], contexts['schools'],
+                   activeness)
+    ctx.bind(agents)
+
+    return ctx, agents, report
+
 
 @dataclass
 class Agent(object):
@@ -215,4 +1457,52 @@ class Agent(object):
     school: str = None
 
 
+def _context_field(field):
+    def get(self):
+        return self.agents.context_index[field].id_of(self.agents.columns[field][self.row])
+    return property(get)
+
+
+def _coded_field(field, table):
+    def get(self):
+        c = self.agents.columns[field][self.row]
+        return None if c < 0 else getattr(self.agents, table)[c]
+    return property(get)
+
+
+class AgentView(Agent):
+    """
+    Read-only Agent-like view over a row of an AgentList.
+    """
+    __slots__ = ['agents', 'row']
+
+    fields = ['aid', 'household', 'census', 'gender', 'age', 'work', 'school']
+
+    def __init__(self, agents, row):
+        self.agents = agents
+        self.row = row
+
+    @property
+    def aid(self):
+        return int(self.agents.columns['aid'][self.row])
+
+    household = _context_field('household')
+    census = _context_field('census')
+    work = _context_field('work')
+    school = _context_field('school')
+    gender = _coded_field('gender', 'genders')
+    age = _coded_field('age', 'ages')
+
+    def to_agent(self):
+        return Agent(*(getattr(self, f) for f in self.fields))
+
+    def __eq__(self, other):
+        try:
+            return all(getattr(self, f) == getattr(other, f) for f in self.fields)
+        except AttributeError:
+            return NotImplemented
+
+    __hash__ = None
 
+    def __repr__(self):
+        return "Agent(" + ", ".join(f"{f}={getattr(self, f)!r}" for f in self.fields) + ")"
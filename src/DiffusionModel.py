@@ -149,7 +149,7 @@ class DiffusionModel(object):
                         "single node will be set as infected")
                     number_of_initial_infected = 1
 
-                available_nodes = [n for n in self.status if self.status[n] == 0]
+                available_nodes = [n for n, s in self.status.items() if s == 0]
                 sampled_nodes = np.random.choice(available_nodes, int(number_of_initial_infected), replace=False)
                 for k in sampled_nodes:
                     self.status[k] = self.available_statuses['Infected']
@@ -212,7 +212,7 @@ class DiffusionModel(object):
                     self.status[n] = 0
                 number_of_initial_infected = self.graph.number_of_nodes() * float(
                     self.params['model']['fraction_infected'])
-                available_nodes = [n for n in self.status if self.status[n] == 0]
+                available_nodes = [n for n, s in self.status.items() if s == 0]
                 sampled_nodes = np.random.choice(available_nodes, int(number_of_initial_infected), replace=False)
 
                 for k in sampled_nodes:
@@ -289,9 +289,8 @@ class DiffusionModel(object):
                 changes[v] += 1
                 delta[int(n)] = actual_status[n]
 
-        freq = Counter(self.status.values()).most_common()
-        for i in freq:
-            old_status_count[i[0]] = i[1]
+        for k, v in self.status_count().items():
+            old_status_count[k] = v
 
         for k, v in old_status_count.items():
             actual_status_count[int(k)] = v
@@ -303,6 +302,14 @@ class DiffusionModel(object):
 
         return delta, actual_status_count, status_delta
 
+    def status_count(self):
+        """
+        Count the nodes in each status
+
+        :return: number of nodes per status (dictionary status->node count), most common first
+        """
+        return dict(Counter(self.status.values()).most_common())
+
     def build_trends(self, iterations):
         """
         Build node status and node delta trends from model iteration bunch
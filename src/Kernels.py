@@ -0,0 +1,260 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # optional: the compiled engine falls back to the vectorized one
+    numba = None
+
+__author__ = ["Giulio Rossetti", "Letizia Milli", "Salvatore Citraro"]
+__license__ = "BSD-2-Clause"
+
+
+AVAILABLE = numba is not None
+
+
+def jit(f):
+    """
+    Compile a kernel in nopython mode, caching it on disk (in __pycache__, or in NUMBA_CACHE_DIR) so that new
+    processes do not compile it again. Without Numba the kernel is left as plain Python.
+    """
+    if numba is None:
+        return f
+    return numba.njit(cache=True)(f)
+
+
+# entries of the codes passed to the kernels: statuses (see UTLDR3.available_statuses), then sociality values
+# (see Sociality)
+STATUSES = ['Susceptible', 'Infected', 'Exposed', 'Recovered', 'Identified_Exposed', 'Hospitalized_mild',
+            'Hospitalized_severe_ICU', 'Hospitalized_severe', 'Lockdown_Susceptible', 'Lockdown_Exposed',
+            'Lockdown_Infected', 'Dead']
+SOCIALITY = ['Normal', 'Lockdown']
+SUSCEPTIBLE, INFECTED, EXPOSED, RECOVERED, IDENTIFIED_EXPOSED, HOSPITALIZED_MILD, HOSPITALIZED_SEVERE_ICU, \
+    HOSPITALIZED_SEVERE, LOCKDOWN_SUSCEPTIBLE, LOCKDOWN_EXPOSED, LOCKDOWN_INFECTED, DEAD = range(len(STATUSES))
+NORMAL, LOCKDOWN = range(len(STATUSES), len(STATUSES) + len(SOCIALITY))
+
+# rows of the thresholds passed to transitions
+PARAMETERS = ['phi_e', 'phi_i', 'sigma', 'gamma', 'omega', 'gamma_t', 'omega_t', 'gamma_f', 'omega_f', 'iota', 'mu']
+PHI_E, PHI_I, SIGMA, GAMMA, OMEGA, GAMMA_T, OMEGA_T, GAMMA_F, OMEGA_F, IOTA, MU = range(len(PARAMETERS))
+
+# outcomes of transitions: test to run, and flags of the agents
+TEST_EXPOSITION, TEST_INFECTION = 1, 2
+RESTORED, RESOLVED, HOSPITALIZED = 1, 2, 4
+
+
+@jit
+def seed(value):
+    """
+    Seed the generator of the compiled kernels (distinct from the one of NumPy)
+
+    :param value: the seed
+    """
+    np.random.seed(value)
+
+
+@jit
+def _resolve(gamma, omega, dead_first, codes):
+    # recovery or death, -1 if neither
+    if dead_first:
+        if np.random.random() < omega:
+            return codes[DEAD]
+        if np.random.random() < gamma:
+            return codes[RECOVERED]
+        return -1
+    if np.random.random() < gamma:
+        return codes[RECOVERED]
+    if np.random.random() < omega:
+        return codes[DEAD]
+    return -1
+
+
+@jit
+def _exit(mu):
+    # lockdown exit (a zero draw never exits, even when mu is 1)
+    x = np.random.random()
+    return x > 0 and x < mu
+
+
+@jit
+def transitions(status, tested, icu, p, icu_b, codes):
+    """
+    Daily transitions of the active agents, as in the vectorized engine: ICU beds released during the day are
+    available to the patients admitted in it, in the order of the agents
+
+    :param status: status of each agent
+    :param tested: whether each agent was already tested
+    :param icu: whether each agent was already admitted to the ICU
+    :param p: thresholds of each agent (one row for each of PARAMETERS)
+    :param icu_b: available ICU beds
+    :param codes: code of each entry of STATUSES and SOCIALITY
+    :return: (new status, test to run, flags, available ICU beds)
+    """
+    n = len(status)
+    new = status.copy()
+    test = np.zeros(n, dtype=np.int8)
+    flags = np.zeros(n, dtype=np.int8)
+    hospital = np.zeros(n, dtype=np.bool_)
+
+    for i in range(n):
+        s = status[i]
+        outcome = -1
+        if s == codes[EXPOSED]:
+            if np.random.random() < p[PHI_E, i] and not tested[i]:
+                test[i] = TEST_EXPOSITION
+            elif np.random.random() < p[SIGMA, i]:
+                new[i] = codes[INFECTED]
+        elif s == codes[INFECTED]:
+            if np.random.random() < p[PHI_I, i] and not tested[i]:
+                test[i] = TEST_INFECTION
+            else:
+                outcome = _resolve(p[GAMMA, i], p[OMEGA, i], False, codes)
+        elif s == codes[HOSPITALIZED_SEVERE_ICU]:
+            outcome = _resolve(p[GAMMA_T, i], p[OMEGA_T, i], False, codes)
+            if outcome >= 0:
+                icu_b += 1
+        elif s == codes[HOSPITALIZED_MILD]:
+            outcome = _resolve(p[GAMMA, i], p[OMEGA, i], False, codes)
+        elif s == codes[HOSPITALIZED_SEVERE]:
+            outcome = _resolve(p[GAMMA_F, i], p[OMEGA_F, i], False, codes)
+        elif s == codes[IDENTIFIED_EXPOSED]:
+            hospital[i] = np.random.random() < p[SIGMA, i]
+        elif s == codes[LOCKDOWN_SUSCEPTIBLE]:
+            if _exit(p[MU, i]):
+                new[i] = codes[SUSCEPTIBLE]
+                flags[i] |= RESTORED
+        elif s == codes[LOCKDOWN_EXPOSED]:
+            if np.random.random() < p[PHI_E, i] and not tested[i]:
+                test[i] = TEST_EXPOSITION
+            elif _exit(p[MU, i]):
+                new[i] = codes[EXPOSED]
+                flags[i] |= RESTORED
+            elif np.random.random() < p[SIGMA, i]:
+                new[i] = codes[LOCKDOWN_INFECTED]
+        elif s == codes[LOCKDOWN_INFECTED]:
+            if np.random.random() < p[PHI_I, i] and not tested[i]:
+                test[i] = TEST_INFECTION
+            elif _exit(p[MU, i]):
+                new[i] = codes[INFECTED]
+                flags[i] |= RESTORED
+            else:
+                outcome = _resolve(p[GAMMA, i], p[OMEGA, i], True, codes)
+
+        if outcome >= 0:
+            new[i] = outcome
+            flags[i] |= RESOLVED
+
+    # beds are released before being assigned
+    for i in range(n):
+        if hospital[i]:
+            flags[i] |= HOSPITALIZED
+            if np.random.random() < p[IOTA, i]:
+                new[i] = codes[HOSPITALIZED_SEVERE]
+                if not icu[i] and icu_b > 0:
+                    new[i] = codes[HOSPITALIZED_SEVERE_ICU]
+                    icu_b -= 1
+            else:
+                new[i] = codes[HOSPITALIZED_MILD]
+
+    return new, test, flags, icu_b
+
+
+@jit
+def _draws(offsets, cell, activity):
+    # number of contacts drawn in a cell (see SocialContext.sample_agents)
+    if cell < 0 or cell >= len(offsets) - 1:
+        return 0
+    return int((offsets[cell + 1] - offsets[cell]) * activity)
+
+
+@jit
+def _visit(offsets, members, cell, activity, seen, stamp, out, m):
+    # contacts drawn in a cell, written to out[m:] (skipping the ones already met when stamp >= 0)
+    if cell < 0 or cell >= len(offsets) - 1:
+        return m
+    start = offsets[cell]
+    size = offsets[cell + 1] - start
+    for _ in range(int(size * activity)):
+        c = members[start + np.random.randint(0, size)]
+        if stamp >= 0:
+            if seen[c] == stamp:
+                continue
+            seen[c] = stamp
+        out[m] = c
+        m += 1
+    return m
+
+
+@jit
+def infect(infectors, sociality, lockdown, exposed, targets, weekend, offsets, members, cells, activity, status,
+           filtered, beta, beta_e, codes):
+    """
+    Daily infections, as in the vectorized engine with contact sampling (see UTLDR3.__infect_contacts): the
+    contacts of each visit are a set, except for the agents restricted to their household, and each of them is
+    infected with a single Bernoulli draw
+
+    :param infectors: agent rows of today's infectious agents
+    :param sociality: sociality of each infector
+    :param lockdown: whether each infector is in lockdown
+    :param exposed: whether each infector is exposed
+    :param targets: census cell visited by each infector through mobility, -1 for none
+    :param weekend: whether to skip work and school contacts
+    :param offsets: CSR offsets of households, census cells, workplaces and schools
+    :param members: CSR members (agent rows) of households, census cells, workplaces and schools
+    :param cells: household, census cell, workplace and school of each agent row (one row each), -1 for none
+    :param activity: household (ones), census, work and school activity of each agent row (one row each)
+    :param status: status of each agent row
+    :param filtered: sociality of each agent row
+    :param beta: infection probability of each agent row
+    :param beta_e: infection probability from the exposed of each agent row
+    :param codes: code of each entry of STATUSES and SOCIALITY
+    :return: (owner, contact): for each infection, the position in infectors of the agent infecting and the
+             agent row infected
+    """
+    total = 0
+    for k in range(len(infectors)):
+        r = infectors[k]
+        if sociality[k] == codes[NORMAL]:
+            for j in range(2 if weekend else 4):
+                total += _draws(offsets[j], cells[j, r], activity[j, r])
+        elif sociality[k] == codes[LOCKDOWN]:
+            total += _draws(offsets[0], cells[0, r], 1.0)
+        if not lockdown[k] and targets[k] >= 0:
+            total += _draws(offsets[0], cells[0, r], 1.0) + _draws(offsets[1], targets[k], activity[1, r])
+
+    contacts = np.empty(total, dtype=np.int64)
+    owner = np.empty(total, dtype=np.int64)
+    contact = np.empty(total, dtype=np.int64)
+    seen = np.full(len(status), -1, dtype=np.int64)
+    stamp = 0
+    hits = 0
+
+    for k in range(len(infectors)):
+        r = infectors[k]
+        for visit in range(3):
+            m = 0
+            if visit == 0 and sociality[k] == codes[NORMAL]:
+                for j in range(2 if weekend else 4):
+                    m = _visit(offsets[j], members[j], cells[j, r], activity[j, r], seen, stamp, contacts, m)
+            elif visit == 1 and sociality[k] == codes[LOCKDOWN]:
+                # household only, not deduplicated
+                m = _visit(offsets[0], members[0], cells[0, r], 1.0, seen, -1, contacts, m)
+            elif visit == 2 and not lockdown[k] and targets[k] >= 0:
+                # long range contacts due to user mobility
+                m = _visit(offsets[0], members[0], cells[0, r], 1.0, seen, stamp, contacts, m)
+                m = _visit(offsets[1], members[1], targets[k], activity[1, r], seen, stamp, contacts, m)
+            stamp += 1
+
+            for j in range(m):
+                c = contacts[j]
+                s = status[c]
+                if lockdown[k]:
+                    keep = s == codes[SUSCEPTIBLE] or s == codes[LOCKDOWN_SUSCEPTIBLE]
+                else:
+                    # contacts in quarantine or in lockdown are filtered out (except household members)
+                    keep = (s == codes[SUSCEPTIBLE] and filtered[c] == codes[NORMAL]) or \
+                           (filtered[c] == codes[LOCKDOWN] and cells[0, c] == cells[0, r])
+                if keep and np.random.random() < (beta_e[c] if exposed[k] else beta[c]):
+                    owner[hits] = k
+                    contact[hits] = c
+                    hits += 1
+
+    return owner[:hits], contact[:hits]
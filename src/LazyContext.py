@@ -0,0 +1,220 @@
+"""
+Seekable context files and lazily materialized social contexts.
+
+build_cell_index rewrites one or more context files as a block-compressed gzip: a
+sequence of independent gzip members, each holding the JSON text of a run of cells.
+The result is still a valid .json.gz (gzip readers concatenate the members), while
+the companion index (<file>.idx.npz) records, for every cell, its block and the
+position of its JSON value within the decompressed block, together with the cell
+metadata (category, parent, children, size).
+
+LazySocialContext answers metadata queries from the index and decodes the agents of a
+cell only when first needed, keeping a bounded LRU of decoded cells.
+"""
+import os
+import json
+import gzip
+import zlib
+from collections import OrderedDict
+import numpy as np
+from .AgentData import ColumnarSocialContext, iter_cells, cell_columns
+
+__author__ = ["Giulio Rossetti", "Letizia Milli", "Salvatore Citraro"]
+__license__ = "BSD-2-Clause"
+
+
+def index_filename(filename):
+    return f"{filename}.idx.npz"
+
+
+def build_cell_index(sources, filename, gz=True, block_size=2**16):
+    """
+    Rewrite context files as a block-compressed gzip file and index its cells
+
+    :param sources: context file, or list of files to merge (a cell found in several files is taken from the last one)
+    :param filename: output file (readable as a regular .json.gz as well)
+    :param gz: whether the sources are gzipped
+    :param block_size: (uncompressed) size of the blocks in bytes: smaller blocks are faster to seek, larger ones
+                       compress better
+    :return: the output filename
+    """
+    if isinstance(sources, str):
+        sources = [sources]
+
+    block, start, end, sizes = [], [], [], []
+    block_offsets = [0]
+    chunks, length = [], 0
+
+    def flush(out):
+        data = gzip.compress(b''.join(chunks), mtime=0)
+        out.write(data)
+        block_offsets.append(block_offsets[-1] + len(data))
+        chunks.clear()
+
+    def cells(out):
+        nonlocal length
+        for cid, cell in (c for f in sources for c in iter_cells(f, gz)):
+            if length >= block_size:
+                flush(out)
+                length = 0
+
+            key = (', ' if len(block) > 0 else '{') + json.dumps(cid) + ': '
+            value = json.dumps(cell)
+            chunks.append(key.encode() + value.encode())
+
+            block.append(len(block_offsets) - 1)
+            start.append(length + len(key.encode()))
+            length += len(chunks[-1])
+            end.append(length)
+            sizes.append(len(cell['agents'] or []))
+
+            # metadata only: members stay in the blocks
+            yield cid, dict(cell, agents=None)
+
+    with open(filename, 'wb') as out:
+        columns = cell_columns(cells(out))
+        chunks.append(b'}' if len(block) > 0 else b'{}')
+        flush(out)
+
+    # a cell found in several sources is taken from the last one (as ColumnarSocialContext.from_columns does)
+    last = {c: i for i, c in enumerate(columns['ids'].tolist())}
+    keep = np.zeros(len(columns['ids']), dtype=bool)
+    keep[list(last.values())] = True
+
+    meta = ColumnarSocialContext.from_columns([columns])
+    np.savez(index_filename(filename), ids=meta.ids, category=meta.category, parent=meta.parent,
+             child_offsets=meta.child_offsets, children=meta.children,
+             sizes=np.asarray(sizes, dtype=np.int64)[keep], block=np.asarray(block, dtype=np.int32)[keep],
+             start=np.asarray(start, dtype=np.int64)[keep], end=np.asarray(end, dtype=np.int64)[keep],
+             block_offsets=np.asarray(block_offsets, dtype=np.int64),
+             meta=np.asarray(json.dumps({'categories': meta.categories, 'parent_list': meta.parent_list})))
+
+    return filename
+
+
+def index_region(region, data_dir="italy_data", path=None):
+    """
+    Build the block-compressed, indexed context files of an italy_data region
+
+    :param region: a Regions value (or its numeric code)
+    :param data_dir: root of the JSON data
+    :param path: (optional) output directory, default <data_dir>/blocks
+    :return: dictionary context name -> block-compressed file
+    """
+    r = getattr(region, 'value', region)
+    if path is None:
+        path = os.path.join(data_dir, 'blocks')
+    os.makedirs(path, exist_ok=True)
+
+    sources = {
+        'census': ['census'],
+        'households': ['households'],
+        'workplaces': ['private_sector', 'public_sector'],
+        'schools': ['schools', 'universities']
+    }
+    return {name: build_cell_index([os.path.join(data_dir, s, f"{s}_{r}.json.gz") for s in ss],
+                                   os.path.join(path, f"{name}_{r}.json.gz"))
+            for name, ss in sources.items()}
+
+
+class LazySocialContext(ColumnarSocialContext):
+    """
+    SocialContext over a block-compressed context file (see build_cell_index): the
+    agents of a cell are decoded on first access and kept in a bounded LRU.
+    """
+
+    def __init__(self, filename, cache_size=2**14):
+        """
+        :param filename: block-compressed context file
+        :param cache_size: maximum number of decoded cells kept in memory
+        """
+        with np.load(index_filename(filename)) as idx:
+            meta = json.loads(str(idx['meta']))
+            super(LazySocialContext, self).__init__(idx['ids'], None, None, idx['category'], meta['categories'],
+                                                    idx['parent'], idx['child_offsets'], idx['children'],
+                                                    parent_list=meta['parent_list'])
+            self.sizes = idx['sizes']
+            self.block = idx['block']
+            self.start = idx['start']
+            self.end = idx['end']
+            self.block_offsets = idx['block_offsets']
+
+        self.filename = filename
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.__last_block = (None, None)
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cells': len(self.cache), 'max_cells': self.cache_size}
+
+    def __read_block(self, b):
+        # consecutive cells often share a block: the last one is kept decompressed
+        if self.__last_block[0] != b:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.block_offsets[b])
+                data = f.read(self.block_offsets[b + 1] - self.block_offsets[b])
+            self.__last_block = (b, zlib.decompress(data, 16 + zlib.MAX_WBITS))
+        return self.__last_block[1]
+
+    def get_agents_at(self, i):
+        agents = self.cache.get(i)
+        if agents is not None:
+            self.hits += 1
+            self.cache.move_to_end(i)
+            return agents
+
+        self.misses += 1
+        text = self.__read_block(self.block[i])
+        cell = json.loads(text[self.start[i]:self.end[i]])
+        agents = np.asarray(cell['agents'] or [], dtype=np.int64)
+
+        self.cache[i] = agents
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return agents
+
+    def membership(self):
+        raise NotImplementedError("Lazy contexts decode their cells on demand")
+
+    def bind_agents(self, agents):
+        # decoded cells keep agent ids: rows are looked up when sampling
+        self.agents = agents
+
+    def members_of(self, cells):
+        if self.agents is None:
+            raise ValueError("Agent rows require a context bound to an AgentList (see bind_agents)")
+        cells = np.asarray(cells, dtype=np.int64)
+        members = [self.agents.rows_of(self.get_agents_at(i)) for i in cells.tolist()]
+        # members missing from the population are dropped
+        members = [m[m >= 0] for m in members]
+        bounds = np.concatenate([[0], np.cumsum([len(m) for m in members], dtype=np.int64)])
+        return bounds, np.concatenate([np.asarray([], dtype=np.int64)] + members)
+
+    def get_sample_agents(self, cell, activity=1):
+        i = self.find(cell)
+        if i < 0:
+            return []
+        n = int(self.sizes[i] * activity)
+        if n == 0:
+            # nobody met: the cell is not decoded
+            return np.asarray([], dtype=np.int64)
+        return np.random.choice(self.get_agents_at(i), n)
+
+    def sample_agents(self, cells, activities=1, rows=False):
+        if rows and self.agents is None:
+            raise ValueError("Agent rows require a context bound to an AgentList (see bind_agents)")
+
+        cells = np.asarray(cells, dtype=np.int64)
+        activities = np.broadcast_to(np.asarray(activities, dtype=np.float64), cells.shape)
+        samples = [self.get_sample_agents(c, a) if c >= 0 else [] for c, a in zip(cells.tolist(), activities)]
+
+        sample = np.concatenate([np.asarray([], dtype=np.int64)] + [np.asarray(x, dtype=np.int64) for x in samples])
+        sizes = np.asarray([len(x) for x in samples], dtype=np.int64)
+        if rows:
+            # members missing from the population are dropped
+            sample = self.agents.rows_of(sample)
+            known = sample >= 0
+            sizes = np.bincount(np.repeat(np.arange(len(cells)), sizes)[known], minlength=len(cells))
+            sample = sample[known].astype(np.int64)
+        return np.concatenate([[0], np.cumsum(sizes)]), sample
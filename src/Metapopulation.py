@@ -0,0 +1,498 @@
+from .DiffusionModel import DiffusionModel
+from .ModelState import StatusArray, ModelParameters
+from .UTLDR import UTLDR3
+import numpy as np
+from .Entities import Weekdays
+
+
+__author__ = ["Giulio Rossetti", "Letizia Milli", "Salvatore Citraro"]
+__license__ = "BSD-2-Clause"
+
+
+class MetaUTLDR3(DiffusionModel):
+    """
+    Metapopulation counterpart of UTLDR3, for screening scenarios before running the agents.
+
+    The agents are aggregated into patches (municipalities or census cells) and the model evolves the number of
+    agents of each patch in each compartment, with the parameters, compartments and daily transitions of the
+    vectorized engine. The contacts are the expected ones of the agent model, assuming the infectious agents of
+    each patch to be spread uniformly over its members: households, census cells, workplaces and schools are
+    summarized by patch x patch contact matrices, and the long range contacts by the p_mobility flows between
+    the provinces of each region. Contact tracing is not modelled.
+    """
+
+    def __init__(self, agents, contexts, seed=None, level='municipality', stochastic=True):
+        """
+
+        :param agents:
+        :param contexts:
+        :param seed:
+        :param level: 'municipality' or 'census', the patches the agents are aggregated into
+        :param stochastic: whether to draw the transitions (binomial draws) or to take their expected value
+        """
+        if level not in ['municipality', 'census']:
+            raise ValueError(f"Unknown level {level}")
+
+        super(self.__class__, self).__init__(agents, contexts, seed)
+        self.contexts.bind(self.agents)
+        self.graph = self.agents
+        # initial statuses only, the model then evolves the counts
+        self.status = StatusArray(self.agents)
+
+        self.level = level
+        self.stochastic = stochastic
+        self.icu_b = self.agents.number_of_nodes()
+        self.current_day = Weekdays.Monday
+        self.identified_cases = 0
+        self.mobility_limits = None
+        self.rt = 0
+        # per-stratum thresholds, and their per-patch averages: compiled on first use
+        self.thresholds = ModelParameters(self.agents, self.params['model'])
+        self.rates = {}
+
+        self.name = "MetaUTLDR"
+
+        self.available_statuses = {
+            "Susceptible": 0,
+            "Exposed": 2,
+            "Infected": 1,
+            "Recovered": 3,
+            "Identified_Exposed": 4,
+            "Hospitalized_mild": 5,
+            "Hospitalized_severe_ICU": 6,
+            "Hospitalized_severe": 7,
+            "Lockdown_Susceptible": 8,
+            "Lockdown_Exposed": 9,
+            "Lockdown_Infected": 10,
+            "Dead": 11
+        }
+
+        self.parameters = UTLDR3.model_parameters(self.agents.number_of_nodes())
+
+        self.__patches()
+        self.__contact_matrices()
+        # agents of each patch in each status, untested (0) or already tested (1)
+        self.counts = np.zeros((len(self.size), len(self.available_statuses), 2))
+
+    def __patches(self):
+        """
+        Aggregate the agents into patches, together with the census hierarchy above them
+        """
+        census = self.contexts.contexts['census']
+        cells = self.agents.columns['census'].astype(np.int64)
+        keys = census.municipality_of(cells) if self.level == 'municipality' else cells
+        keys, self.patch = np.unique(keys, return_inverse=True)
+        self.patch = self.patch.ravel()
+        self.size = np.bincount(self.patch, minlength=len(keys)).astype(np.float64)
+
+        # municipality, province and region of each patch, and the number of children met along the way
+        _, child_offsets, _ = census.hierarchy()
+        children = np.append(np.diff(child_offsets), 0)
+        municipality = keys if self.level == 'municipality' else census.municipality_of(keys)
+        province = census.parent_of(municipality)
+        region = census.parent_of(province)
+        self.cells = children[municipality]
+        self.municipalities = children[province]
+        self.others = np.maximum(children[region] - 1, 0)
+        _, self.municipality = np.unique(municipality, return_inverse=True)
+        provinces, self.province = np.unique(province, return_inverse=True)
+        _, self.province_region = np.unique(census.parent_of(provinces), return_inverse=True)
+        self.municipality, self.province = self.municipality.ravel(), self.province.ravel()
+        self.province_region = self.province_region.ravel()
+
+    def __contact_matrices(self):
+        """
+        Expected contacts between patches. An agent drawing int(n * activity) contacts in a cell of n members
+        meets each of them with probability m = 1 - (1 - 1/n)^int(n * activity) (see Contexts.sample_contacts):
+        given the cells x patches membership counts B, a member of patch p meets on average
+        C[p, q] = (B^T diag(m) B)[p, q] / N_p members of patch q, itself excluded.
+        """
+        import scipy.sparse
+
+        activeness = self.contexts.activeness
+        rows = np.arange(self.agents.number_of_nodes())
+        patches = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, self.patch)),
+                                          shape=(len(rows), len(self.size)))
+        self.contacts = {}
+        for name, category in [('households', None), ('census', 'census'), ('workplaces', 'work'),
+                               ('schools', 'school')]:
+            if self.contexts.contexts[name] is None:
+                continue
+            incidence = self.contexts.incidence(name)
+            n = np.asarray(incidence.sum(axis=0)).ravel()
+            activity = np.ones(len(rows)) if category is None or activeness is None else \
+                activeness.get_values(rows, category)
+            activity = incidence.T @ activity / np.maximum(n, 1)
+            met = self.__met(n, activity)
+            b = (incidence.T @ patches).tocsr()
+            c = (b.T @ scipy.sparse.diags(met) @ b).tocsr() - scipy.sparse.diags(b.T @ met)
+            self.contacts[name] = (scipy.sparse.diags(1 / self.size) @ c).tocsr()
+
+            if name == 'households':
+                # members of agents restricted to their household, whose contacts are not deduplicated: n draws
+                # give each of them an infection probability of about beta
+                c = (b.T @ b).tocsr() - scipy.sparse.diags(np.asarray(b.sum(axis=0)).ravel())
+                self.contacts['restricted'] = (scipy.sparse.diags(1 / self.size) @ c).tocsr()
+            elif name == 'census':
+                # a member of patch p meets each agent visiting one of its census cells with probability m
+                # (computed with the average census activity of the visitors)
+                mean = activity[n > 0].mean() if np.any(n > 0) else 1
+                met = self.__met(n, np.full(len(n), mean))
+                self.visited = (b.T @ met) / (self.size * np.maximum(self.cells, 1))
+
+    @staticmethod
+    def __met(n, activity):
+        """
+        :param n: cell sizes
+        :param activity: activity of the agents drawing the contacts
+        :return: the probability of meeting each member of the cell
+        """
+        draws = np.floor(n * activity)
+        return np.where(n > 0, 1 - (1 - 1 / np.maximum(n, 1)) ** draws, 0)
+
+    def status_count(self):
+        totals = self.counts.sum(axis=(0, 2))
+        present = np.flatnonzero(totals)
+        present = present[np.argsort(-totals[present], kind='stable')]
+        return {int(s): self.__value(totals[s]) for s in present}
+
+    def __value(self, x):
+        return int(round(x)) if self.stochastic else float(x)
+
+    def update_model_parameter(self, name, value):
+        """
+
+        :param name:
+        :param value:
+        :return:
+        """
+        if name in self.params['model']:
+            self.params['model'][name] = value
+            self.thresholds.invalidate(name)
+            self.rates.pop(name, None)
+
+    def set_initial_status(self, configuration):
+        super(self.__class__, self).set_initial_status(configuration)
+        self.thresholds.invalidate()
+        self.rates.clear()
+
+        self.counts[:] = 0
+        np.add.at(self.counts, (self.patch, self.status.array.astype(np.int64), 0), 1)
+
+    def __rate(self, name):
+        """
+        :param name: model parameter
+        :return: the parameter in each patch, averaged over its agents when stratified
+        """
+        rate = self.rates.get(name)
+        if rate is None:
+            table = self.thresholds.table(name)
+            if table.__class__ is float:
+                rate = np.full(len(self.size), table)
+            else:
+                values = self.thresholds.get_rows(np.arange(self.agents.number_of_nodes()), name)
+                rate = np.bincount(self.patch, weights=values, minlength=len(self.size)) / self.size
+            self.rates[name] = rate
+        return rate
+
+    def __draw(self, n, p):
+        """
+        :param n: number of agents, for each patch
+        :param p: probability of the event, for each patch
+        :return: the number of agents the event happens to (its expected value, if deterministic)
+        """
+        p = np.clip(p, 0, 1)
+        if self.stochastic:
+            return np.random.binomial(n.astype(np.int64), p).astype(np.float64)
+        return n * p
+
+    def iteration(self, node_status=True):
+        """
+
+        :param node_status: ignored, the model has no agent statuses
+        :return:
+        """
+        self.current_day = (self.actual_iteration % 7) + 1
+
+        if self.actual_iteration == 0:
+            self.icu_b = self.params['model']['icu_b']
+            self.current_day = (self.params['model']['start_day'] % len(Weekdays)) + 1
+            self.actual_iteration += 1
+
+            node_count = self.status_count()
+            size = self.agents.number_of_nodes()
+            beta = self.__rate('beta') @ self.size / size + self.__rate('beta_e') @ self.size / size
+            r0 = beta / ((self.__rate('omega') + self.__rate('gamma')) @ self.size / size)
+            return {"iteration": 0, "status": {}, "node_count": node_count,
+                    "status_delta": {s: 0 for s in node_count}, "identified_cases": self.identified_cases,
+                    "Rt": r0}
+
+        previous = self.counts.sum(axis=(0, 2))
+        self.__transitions()
+        self.actual_iteration += 1
+
+        node_count = self.status_count()
+        actual = self.counts.sum(axis=(0, 2))
+        status_delta = {int(s): self.__value(actual[s] - previous[s])
+                        for s in np.flatnonzero((actual != 0) | (previous != 0))}
+        return {"iteration": self.actual_iteration - 1, "status": {}, "node_count": node_count,
+                "status_delta": status_delta, "identified_cases": self.identified_cases, "Rt": self.rt}
+
+    def __force(self):
+        """
+        Daily hazard of infection of the susceptible agents of each patch, as in the vectorized engine: agents
+        not in lockdown meet their household twice (once more when moving), their census cell, workplace and
+        school, and a census cell reached through mobility; agents in lockdown only meet their household, and
+        are only met by it.
+
+        :return: (hazard of the susceptible agents, hazard of the ones in lockdown)
+        """
+        st = self.available_statuses
+        counts = self.counts.sum(axis=2)
+        weekend = self.current_day in [Weekdays.Saturday, Weekdays.Sunday]  # checking for work related activities
+
+        # spreading agents: infected (beta) and exposed (beta_e), free or in lockdown
+        free = np.stack([counts[:, st['Infected']], counts[:, st['Exposed']]], axis=1)
+        locked = np.stack([counts[:, st['Lockdown_Infected']], counts[:, st['Lockdown_Exposed']]], axis=1)
+
+        household = 2 * (self.contacts['households'] @ (free / self.size[:, None])) + \
+            self.contacts['restricted'] @ (locked / self.size[:, None])
+        others = np.zeros_like(household)
+        for name in ['census'] + ([] if weekend else ['workplaces', 'schools']):
+            if name in self.contacts:
+                others += self.contacts[name] @ (free / self.size[:, None])
+        if 'census' in self.contacts:
+            others += self.visited[:, None] * self.__mobility(free)
+
+        beta = np.stack([self.__rate('beta'), self.__rate('beta_e')], axis=1)
+        return np.sum(beta * (household + others), axis=1), np.sum(beta * household, axis=1)
+
+    def __mobility(self, free):
+        """
+        Agents moving to a census cell of the municipality of each patch (see UTLDR3.__get_mobilities): a
+        different province of the same region with probability p_mobility, otherwise their own, then a random
+        municipality and a random census cell
+
+        :param free: agents moving from each patch (one column for each kind)
+        :return: agents reaching each census cell of the municipality of each patch
+        """
+        if self.mobility_limits == 'municipality':
+            flow = np.stack([np.bincount(self.municipality, weights=x) for x in free.T], axis=1)
+            return flow[self.municipality]
+
+        if self.mobility_limits == 'province':
+            flow = np.stack([np.bincount(self.province, weights=x) for x in free.T], axis=1)
+        else:
+            p = self.__rate('p_mobility') * (self.others > 0)
+            out = p / np.maximum(self.others, 1)
+            flow = []
+            for x in free.T:
+                stay = np.bincount(self.province, weights=x * (1 - p))
+                leave = np.bincount(self.province, weights=x * out, minlength=len(stay))
+                flow.append(stay + np.bincount(self.province_region, weights=leave)[self.province_region] - leave)
+            flow = np.stack(flow, axis=1)
+        return flow[self.province] / np.maximum(self.municipalities, 1)[:, None]
+
+    def __transitions(self):
+        """
+        Daily transitions of each patch, drawn from the counts at the beginning of the day
+        """
+        st = self.available_statuses
+        counts = self.counts
+        new = counts.copy()
+        rate = self.__rate
+
+        def move(source, target, n, tested=None):
+            # n agents (per patch) from source to target, keeping their tested flag unless set
+            for t in [0, 1]:
+                new[:, source, t] -= n[t]
+                new[:, target, t if tested is None else tested] += n[t]
+
+        def events(compartment, outcomes, test=None):
+            # competing events, drawn in order among the agents left by the previous ones
+            left = [counts[:, compartment, 0].copy(), counts[:, compartment, 1].copy()]
+            if test is not None:
+                selected = self.__draw(left[0], rate(test))
+                left[0] = left[0] - selected
+                self.__test(compartment, selected, test, new)
+            drawn = []
+            for target, parameter in outcomes:
+                n = [self.__draw(left[0], rate(parameter)), self.__draw(left[1], rate(parameter))]
+                move(compartment, target, n)
+                left = [left[0] - n[0], left[1] - n[1]]
+                drawn.append(n)
+            return drawn
+
+        # infections, from the counts at the beginning of the day
+        hazard, locked = self.__force()
+        infected = [self.__draw(counts[:, st['Susceptible'], t], -np.expm1(-hazard)) for t in [0, 1]]
+        move(st['Susceptible'], st['Exposed'], infected)
+        exposed = [self.__draw(counts[:, st['Lockdown_Susceptible'], t], -np.expm1(-locked)) for t in [0, 1]]
+        move(st['Lockdown_Susceptible'], st['Lockdown_Exposed'], exposed)
+        spreading = counts[:, [st['Infected'], st['Exposed'], st['Lockdown_Infected'], st['Lockdown_Exposed']]]
+        spreading = spreading.sum()
+        removal = (rate('gamma') + rate('omega')) @ self.size / self.size.sum()
+        self.rt = 0 if spreading == 0 else float(np.sum(infected) + np.sum(exposed)) / spreading / removal
+
+        # undetected compartments
+        events(st['Exposed'], [(st['Infected'], 'sigma')], test='phi_e')
+        events(st['Infected'], [(st['Recovered'], 'gamma'), (st['Dead'], 'omega')], test='phi_i')
+
+        # quarantined compartments: beds are released before being assigned
+        released = events(st['Hospitalized_severe_ICU'], [(st['Recovered'], 'gamma_t'), (st['Dead'], 'omega_t')])
+        self.icu_b += self.__value(sum(np.sum(n) for outcome in released for n in outcome))
+        events(st['Hospitalized_mild'], [(st['Recovered'], 'gamma'), (st['Dead'], 'omega')])
+        events(st['Hospitalized_severe'], [(st['Recovered'], 'gamma_f'), (st['Dead'], 'omega_f')])
+        hospital = [self.__draw(counts[:, st['Identified_Exposed'], t], rate('sigma')) for t in [0, 1]]
+        for t in [0, 1]:
+            new[:, st['Identified_Exposed'], t] -= hospital[t]
+        self.__hospitalize(hospital[0] + hospital[1], new)
+
+        # lockdown compartments (the susceptible ones infected today stay in lockdown)
+        left = counts[:, st['Lockdown_Susceptible']] - np.stack(exposed, axis=1)
+        move(st['Lockdown_Susceptible'], st['Susceptible'], [self.__draw(left[:, t], rate('mu')) for t in [0, 1]])
+        events(st['Lockdown_Exposed'], [(st['Exposed'], 'mu'), (st['Lockdown_Infected'], 'sigma')], test='phi_e')
+        events(st['Lockdown_Infected'], [(st['Infected'], 'mu'), (st['Dead'], 'omega'), (st['Recovered'], 'gamma')],
+               test='phi_i')
+
+        self.counts = new
+
+    def __test(self, compartment, selected, parameter, new):
+        """
+        Test the agents selected in a compartment: the positive ones are identified (exposed) or hospitalized
+        (infected), the negative ones stay, as tested
+
+        :param compartment: their compartment
+        :param selected: agents selected for testing, in each patch
+        :param parameter: phi_e or phi_i
+        :param new: counts at the end of the day
+        """
+        st = self.available_statuses
+        exposed = parameter == 'phi_e'
+        positive = self.__draw(selected, 1 - self.__rate('kappa_e' if exposed else 'kappa_i'))
+        self.identified_cases += self.__value(np.sum(positive))
+
+        new[:, compartment, 0] -= selected
+        new[:, compartment, 1] += selected - positive
+        if exposed:
+            new[:, st['Identified_Exposed'], 1] += positive
+        else:
+            self.__hospitalize(positive, new)
+
+    def __hospitalize(self, n, new):
+        """
+        Hospitalize agents, severe cases taking the available ICU beds
+
+        :param n: agents to hospitalize, in each patch
+        :param new: counts at the end of the day
+        """
+        st = self.available_statuses
+        severe = self.__draw(n, self.__rate('iota'))
+        new[:, st['Hospitalized_mild'], 1] += n - severe
+
+        total = np.sum(severe)
+        beds = max(0, min(self.icu_b, total))
+        if beds == total:
+            icu = severe
+        elif self.stochastic:
+            # beds are assigned to random patients
+            picked = np.random.choice(int(total), int(beds), replace=False)
+            icu = np.bincount(np.searchsorted(np.cumsum(severe), picked, side='right'),
+                              minlength=len(severe)).astype(np.float64)
+        else:
+            icu = severe * beds / total
+        self.icu_b -= self.__value(np.sum(icu))
+        new[:, st['Hospitalized_severe_ICU'], 1] += icu
+        new[:, st['Hospitalized_severe'], 1] += severe - icu
+
+    ###################################################################################################################
+
+    def add_ICU_beds(self, n):
+        """
+        Add/Subtract beds in intensive care
+
+        :param n: number of beds to add/remove
+        :return:
+        """
+        self.icu_b = max(0, self.icu_b + n)
+
+    def __eligible(self, categories):
+        """
+        :param categories: workplace/school categories
+        :return: the fraction of the agents of each patch working or studying in one of them
+        """
+        columns = self.agents.columns
+        eligible = np.zeros(self.agents.number_of_nodes(), dtype=bool)
+        for name, field in [('workplaces', 'work'), ('schools', 'school')]:
+            context = self.contexts.contexts[name]
+            if context is None:
+                continue
+            lut = np.asarray([context.get_category(p) in categories for p in range(len(context.index))] + [False])
+            cells = columns[field].astype(np.int64)
+            eligible |= lut[np.where(cells >= 0, cells, len(lut) - 1)]
+        return np.bincount(self.patch, weights=eligible, minlength=len(self.size)) / self.size
+
+    def __swap(self, pairs, p):
+        """
+        Move a fraction of the agents of each patch between compartments
+
+        :param pairs: (source, target) compartments
+        :param p: probability of moving, for each patch
+        :return: the new counts
+        """
+        new = self.counts.copy()
+        for source, target in pairs:
+            for t in [0, 1]:
+                n = self.__draw(self.counts[:, source, t], p)
+                new[:, source, t] -= n
+                new[:, target, t] += n
+        return new
+
+    def __result(self, iteration, new):
+        previous = self.counts.sum(axis=(0, 2))
+        self.counts = new
+        actual = self.counts.sum(axis=(0, 2))
+        status_delta = {int(s): self.__value(actual[s] - previous[s])
+                        for s in np.flatnonzero((actual != 0) | (previous != 0))}
+        return {"iteration": iteration, "status": {}, "node_count": self.status_count(),
+                "status_delta": status_delta, "identified_cases": self.identified_cases, "Rt": self.rt}
+
+    def set_lockdown(self, to_close=None, to_keep=None):
+        """
+        Impose the beginning of a lockdown (see UTLDR3.set_lockdown): the compliant agents of each patch are
+        drawn among the ones working or studying in the categories to close (not in the ones to keep)
+
+        :param to_close: (optional) list of workplace/school categories to close
+        :param to_keep: (optional) list of workplace/school categories to keep open
+        :return:
+        """
+        st = self.available_statuses
+        p = self.__rate('lambda')
+        if to_close is not None:
+            p = p * self.__eligible(set(to_close))
+        if to_keep is not None:
+            p = p * (1 - self.__eligible(set(to_keep)))
+
+        new = self.__swap([(st['Susceptible'], st['Lockdown_Susceptible']), (st['Exposed'], st['Lockdown_Exposed']),
+                           (st['Infected'], st['Lockdown_Infected'])], p)
+        return self.__result(self.actual_iteration - 1, new)
+
+    def unset_lockdown(self, to_release=None):
+        """
+        Remove the lockdown social limitations
+
+        :param to_release: (optional) list of workplace/school categories to release
+        :return:
+        """
+        st = self.available_statuses
+        p = np.ones(len(self.size)) if to_release is None else self.__eligible(set(to_release))
+
+        new = self.__swap([(st['Lockdown_Susceptible'], st['Susceptible']), (st['Lockdown_Exposed'], st['Exposed']),
+                           (st['Lockdown_Infected'], st['Infected'])], p)
+        return self.__result(self.actual_iteration + 1, new)
+
+    def set_mobility_limits(self, value):
+        self.mobility_limits = value
+
+    def unset_mobility_limits(self):
+        self.mobility_limits = None
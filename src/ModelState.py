@@ -0,0 +1,516 @@
+"""
+Per-agent model state held in arrays indexed by agent row (see AgentList).
+
+Each state is exposed through a dict-like adapter (aid -> value), so that code written
+against the original dictionaries keeps working, while vectorized code can read and
+write the underlying array directly. Model parameters are compiled into per-stratum
+tables (ModelParameters) and pending transitions kept in per-day buckets (EventCalendar).
+"""
+from collections import defaultdict
+from collections.abc import MutableMapping
+import numpy as np
+from .Entities import Sociality
+
+__author__ = ["Giulio Rossetti", "Letizia Milli", "Salvatore Citraro"]
+__license__ = "BSD-2-Clause"
+
+
+class AgentArray(MutableMapping):
+    """
+    Dict-like view (aid -> value) over a per-agent array.
+    """
+
+    def __init__(self, agents, array):
+        """
+        :param agents: the AgentList whose rows index the array
+        :param array: per-agent values
+        """
+        self.agents = agents
+        self.array = array
+        self.written = None
+
+    def track(self):
+        """
+        Record the rows written through the adapter from now on (see written_rows); writes to the array itself
+        are not recorded
+        """
+        self.written = []
+
+    def written_rows(self):
+        """
+        :return: the distinct rows written since the tracking started or since the last call
+        """
+        rows = np.unique(np.concatenate([np.asarray([], dtype=np.int64)] +
+                                        [np.asarray(x, dtype=np.int64).ravel() for x in self.written]))
+        self.written = []
+        return rows
+
+    def record(self, rows):
+        if self.written is not None:
+            self.written.append(rows)
+
+    def row(self, aid):
+        row = self.agents.row_of(aid)
+        if row is None:
+            raise KeyError(aid)
+        return row
+
+    def get_at(self, row):
+        return self.array[row]
+
+    def set_at(self, row, value):
+        self.array[row] = value
+
+    def get_rows(self, rows):
+        return self.array[rows]
+
+    def set_rows(self, rows, value):
+        self.array[rows] = value
+        self.record(rows)
+
+    def decode(self, values):
+        # array values -> list of python values
+        return values.tolist()
+
+    def __getitem__(self, aid):
+        return self.decode(np.asarray([self.get_at(self.row(aid))]))[0]
+
+    def __setitem__(self, aid, value):
+        row = self.row(aid)
+        self.set_at(row, value)
+        self.record(row)
+
+    def __delitem__(self, aid):
+        raise TypeError("Agents cannot be removed from the model state")
+
+    def __iter__(self):
+        return iter(self.agents.columns['aid'].tolist())
+
+    def __len__(self):
+        return self.agents.number_of_nodes()
+
+    def __contains__(self, aid):
+        return self.agents.row_of(aid) is not None
+
+    def values(self):
+        return self.decode(self.get_rows(slice(None)))
+
+    def items(self):
+        return zip(self.agents.columns['aid'].tolist(), self.values())
+
+    def copy(self):
+        return dict(self.items())
+
+
+class StatusArray(AgentArray):
+    """
+    Agent statuses as an int8 array, together with the number of agents in each status (kept up to date by
+    the writes going through the adapter).
+    """
+
+    def __init__(self, agents, value=0):
+        super(StatusArray, self).__init__(agents, np.full(agents.number_of_nodes(), value, dtype=np.int8))
+        # indexed by the status byte (uint8 view of the int8 value)
+        self.count = np.zeros(256, dtype=np.int64)
+        self.count[np.uint8(value)] = len(self.array)
+
+    def set_at(self, row, value):
+        self.count[np.uint8(self.array[row])] -= 1
+        self.array[row] = value
+        self.count[np.uint8(self.array[row])] += 1
+
+    def set_rows(self, rows, value):
+        # a row given several times is counted once (with its last value)
+        unique = np.unique(np.asarray(rows, dtype=np.int64))
+        np.subtract.at(self.count, self.array[unique].view(np.uint8), 1)
+        self.array[rows] = value
+        np.add.at(self.count, self.array[unique].view(np.uint8), 1)
+        self.record(unique)
+
+    def recount(self):
+        """
+        Recompute the counts, after writing the array directly
+        """
+        self.count = np.bincount(self.array.view(np.uint8), minlength=256).astype(np.int64)
+
+    def counts(self):
+        """
+        :return: dictionary status -> number of agents, most common first (statuses without agents are omitted)
+        """
+        present = np.flatnonzero(self.count)
+        present = present[np.argsort(-self.count[present], kind='stable')]
+        return {int(np.uint8(s).view(np.int8)): int(self.count[s]) for s in present}
+
+    def __getitem__(self, aid):
+        return int(self.array[self.row(aid)])
+
+
+class FlagArray(AgentArray):
+    """
+    Boolean agent flags packed eight per byte.
+    """
+
+    def __init__(self, agents):
+        self.size = agents.number_of_nodes()
+        super(FlagArray, self).__init__(agents, np.zeros((self.size + 7) // 8, dtype=np.uint8))
+
+    def get_at(self, row):
+        return bool((self.array[row >> 3] >> (row & 7)) & 1)
+
+    def set_at(self, row, value):
+        if value:
+            self.array[row >> 3] |= np.uint8(1 << (row & 7))
+        else:
+            self.array[row >> 3] &= np.uint8(~(1 << (row & 7)) & 0xFF)
+
+    def get_rows(self, rows):
+        if isinstance(rows, slice):
+            return np.unpackbits(self.array, bitorder='little')[:self.size][rows].astype(bool)
+        rows = np.asarray(rows)
+        return ((self.array[rows >> 3] >> (rows & 7)) & 1).astype(bool)
+
+    def set_rows(self, rows, value):
+        rows = np.asarray(rows)
+        masks = (1 << (rows & 7)).astype(np.uint8)
+        if value:
+            np.bitwise_or.at(self.array, rows >> 3, masks)
+        else:
+            np.bitwise_and.at(self.array, rows >> 3, ~masks)
+        self.record(rows)
+
+    def __getitem__(self, aid):
+        return self.get_at(self.row(aid))
+
+
+_SOCIALITY = {s.value: s for s in Sociality}
+
+
+class SocialityArray(AgentArray):
+    """
+    Agent Sociality levels as a uint8 array of their values.
+    """
+
+    def __init__(self, agents, value=Sociality.Normal):
+        super(SocialityArray, self).__init__(agents, np.full(agents.number_of_nodes(), value.value, dtype=np.uint8))
+
+    def set_at(self, row, value):
+        self.array[row] = value.value
+
+    def set_rows(self, rows, value):
+        self.array[rows] = value.value
+        self.record(rows)
+
+    def decode(self, values):
+        return [_SOCIALITY[v] for v in values.tolist()]
+
+    def __getitem__(self, aid):
+        return _SOCIALITY[int(self.array[self.row(aid)])]
+
+
+class ModelParameters(object):
+    """
+    Model parameters compiled into per-stratum tables.
+
+    Agents sharing gender and age class share a stratum: a stratified parameter (a dict keyed by gender or by
+    str(age), gender first) is resolved once per stratum, a plain value once for all. Tables are compiled on
+    first use and have to be invalidated when the parameter changes.
+    """
+
+    def __init__(self, agents, params):
+        """
+        :param agents: the AgentList whose rows index the strata
+        :param params: model parameters (name -> value or dict), read when compiling
+        """
+        self.agents = agents
+        self.params = params
+        self.tables = {}
+
+        genders, gender = agents.codes('gender')
+        ages, age = agents.codes('age')
+        self.genders = list(genders)
+        self.ages = list(ages)
+        # -1 (None) codes pick the last entry of each table
+        gender = np.where(gender < 0, len(self.genders), gender).astype(np.int64)
+        age = np.where(age < 0, len(self.ages), age).astype(np.int64)
+        self.stratum = gender * (len(self.ages) + 1) + age
+
+    def invalidate(self, name=None):
+        """
+        :param name: the changed parameter, None for all of them
+        """
+        if name is None:
+            self.tables.clear()
+        else:
+            self.tables.pop(name, None)
+
+    def table(self, name):
+        """
+        :param name: parameter name
+        :return: the parameter value, if not stratified, otherwise its per-stratum table (nan where unspecified)
+        """
+        table = self.tables.get(name)
+        if table is None:
+            value = self.params[name]
+            if isinstance(value, dict):
+                by_gender = [value.get(g, np.nan) for g in self.genders] + [np.nan]
+                by_age = [value.get(str(a), np.nan) for a in self.ages] + [value.get(str(None), np.nan)]
+                table = np.asarray([[a if np.isnan(g) else g for a in by_age] for g in by_gender],
+                                   dtype=np.float64).ravel()
+            else:
+                table = float(value)
+            self.tables[name] = table
+        return table
+
+    def get_at(self, row, name):
+        table = self.table(name)
+        if table.__class__ is float:
+            return table
+
+        value = table[self.stratum[row]]
+        if value != value:
+            raise ValueError(f"Parameter {name} not specified for {self.agents.get_agent_at(int(row))}")
+        return value
+
+    def get_rows(self, rows, name):
+        table = self.table(name)
+        if table.__class__ is float:
+            return np.full(len(rows), table, dtype=np.float64)
+
+        values = table[self.stratum[rows]]
+        missing = np.isnan(values)
+        if np.any(missing):
+            row = int(np.asarray(rows)[missing][0])
+            raise ValueError(f"Parameter {name} not specified for {self.agents.get_agent_at(row)}")
+        return values
+
+
+class EventCalendar(object):
+    """
+    Per-day buckets of pending agent transitions.
+
+    Each active agent holds at most one pending event: the compartment it was scheduled in, its due day and
+    its outcome. Events are dropped lazily, when the agent left the compartment (or became inactive) before the
+    due day or has been rescheduled in the meantime.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: number of agents
+        """
+        self.active = np.zeros(size, dtype=bool)
+        self.compartment = np.full(size, -1, dtype=np.int8)
+        self.due = np.full(size, -1, dtype=np.int64)
+        self.outcome = np.full(size, -1, dtype=np.int8)
+        self.buckets = defaultdict(list)
+
+    def activate(self, rows):
+        self.active[rows] = True
+
+    def deactivate(self, rows):
+        self.active[rows] = False
+
+    def stale(self, status):
+        """
+        :param status: agent statuses
+        :return: rows of the active agents whose status differs from the one their event was scheduled in
+        """
+        return np.flatnonzero(self.active & (self.compartment != status))
+
+    def invalidate(self, rows):
+        """
+        Drop the pending events of some agents: they will be rescheduled as stale
+
+        :param rows: agent rows
+        """
+        self.compartment[rows] = -1
+
+    def schedule(self, rows, compartment, due, outcome):
+        """
+        :param rows: agent rows
+        :param compartment: the compartment of each agent
+        :param due: day of each event, -1 for none
+        :param outcome: outcome of each event
+        """
+        self.compartment[rows] = compartment
+        self.due[rows] = due
+        self.outcome[rows] = outcome
+
+        pending = due >= 0
+        rows, due = rows[pending], due[pending]
+        order = np.argsort(due, kind='stable')
+        days, start = np.unique(due[order], return_index=True)
+        for day, part in zip(days.tolist(), np.split(rows[order], start[1:])):
+            self.buckets[day].append(part)
+
+    def pop(self, day, status):
+        """
+        :param day: the current day
+        :param status: agent statuses
+        :return: (rows, outcomes) of the events due on the day
+        """
+        parts = self.buckets.pop(day, [])
+        rows = np.unique(np.concatenate([np.asarray([], dtype=np.int64)] + parts))
+        rows = rows[(self.due[rows] == day) & (self.compartment[rows] == status[rows]) & self.active[rows]]
+        self.due[rows] = -1
+        return rows, self.outcome[rows]
+
+
+class SusceptibleIndex(object):
+    """
+    Dynamic set of the susceptible members of each cell of a context.
+
+    The members of each cell are kept partitioned, susceptible ones first: an agent enters or leaves the set
+    by swapping its entry with the one at the boundary of its cell, in O(1).
+    """
+
+    def __init__(self, offsets, members, size, susceptible):
+        """
+        :param offsets: CSR offsets of the cell membership
+        :param members: agent rows of the cell members
+        :param size: number of agents
+        :param susceptible: whether each agent is susceptible
+        """
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        members = np.asarray(members, dtype=np.int64)
+        self.owner = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        self.state = np.asarray(susceptible, dtype=bool).copy()
+
+        # entries of each agent
+        self.entries = np.argsort(members, kind='stable')
+        self.agent_offsets = np.concatenate([[0], np.cumsum(np.bincount(members, minlength=size))])
+
+        # susceptible entries first within each cell
+        self.at = np.lexsort((~self.state[members], self.owner))
+        self.slot = np.empty(len(members), dtype=np.int64)
+        self.slot[self.at] = np.arange(len(members))
+        self.rows = members[self.at]
+        self.count = np.bincount(self.owner[self.state[members]], minlength=len(self.offsets) - 1)
+
+    def __swap(self, p, q):
+        ep, eq = self.at[p], self.at[q]
+        self.at[p], self.at[q] = eq, ep
+        self.slot[eq], self.slot[ep] = p, q
+        self.rows[p], self.rows[q] = self.rows[q], self.rows[p]
+
+    def add(self, row):
+        for e in self.entries[self.agent_offsets[row]:self.agent_offsets[row + 1]]:
+            c = self.owner[e]
+            boundary = self.offsets[c] + self.count[c]
+            if self.slot[e] >= boundary:
+                self.__swap(self.slot[e], boundary)
+                self.count[c] += 1
+        self.state[row] = True
+
+    def remove(self, row):
+        for e in self.entries[self.agent_offsets[row]:self.agent_offsets[row + 1]]:
+            c = self.owner[e]
+            boundary = self.offsets[c] + self.count[c] - 1
+            if self.slot[e] <= boundary:
+                self.__swap(self.slot[e], boundary)
+                self.count[c] -= 1
+        self.state[row] = False
+
+    def update(self, susceptible, rows=None):
+        """
+        Align the index with the current state of the agents
+
+        :param susceptible: whether each agent is susceptible (each of the given rows, if any)
+        :param rows: (optional) agent rows whose state may have changed, all the agents if not given
+        """
+        if rows is None:
+            rows = np.arange(len(self.state))
+        rows = np.asarray(rows, dtype=np.int64)
+        susceptible = np.asarray(susceptible, dtype=bool)
+        changed = susceptible != self.state[rows]
+        for row, value in zip(rows[changed].tolist(), susceptible[changed].tolist()):
+            if value:
+                self.add(row)
+            else:
+                self.remove(row)
+
+    def sample(self, cells, activities=1):
+        """
+        Susceptible part of an activity-scaled sample (with replacement) of many cells: out of the int(size *
+        activity) draws of each cell, the ones hitting a susceptible member follow a binomial
+
+        :param cells: array of cell positions (-1 for none)
+        :param activities: array of activity values, one for each cell (or a single value)
+        :return: (offsets, sample): the sampled agent rows of the i-th cell are sample[offsets[i]:offsets[i+1]]
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        if len(self.offsets) == 1:
+            # empty context: nobody to meet
+            return np.zeros(len(cells) + 1, dtype=np.int64), np.asarray([], dtype=np.int64)
+
+        valid = cells >= 0
+        cells = np.where(valid, cells, 0)
+        start = self.offsets[cells]
+        sizes = np.where(valid, self.offsets[cells + 1] - start, 0)
+        count = np.where(valid, self.count[cells], 0)
+
+        n = (sizes * np.asarray(activities, dtype=np.float64)).astype(np.int64)
+        n = np.random.binomial(n, np.where(sizes > 0, count / np.maximum(sizes, 1), 0))
+        owner = np.repeat(np.arange(len(cells)), n)
+        sample = self.rows[start[owner] + (np.random.random_sample(len(owner)) * count[owner]).astype(np.int64)]
+        return np.concatenate([[0], np.cumsum(n)]), sample
+
+
+class AliasTable(object):
+    """
+    Alias tables (Walker, Vose) of many discrete distributions: each draw takes O(1), whatever the number of
+    outcomes of its distribution.
+
+    The outcomes of the distributions are laid out as in CSR: the outcomes of the i-th one are
+    values[offsets[i]:offsets[i+1]].
+    """
+
+    def __init__(self, offsets, weights, values):
+        """
+        :param offsets: CSR offsets of the distributions
+        :param weights: (unnormalized) weight of each outcome
+        :param values: value of each outcome
+        """
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = np.asarray(values)
+        weights = np.asarray(weights, dtype=np.float64)
+        n = np.diff(self.offsets)
+        owner = np.repeat(np.arange(len(n)), n)
+        total = np.bincount(owner, weights=weights, minlength=len(n))
+        self.empty = total <= 0
+
+        # probability of keeping each entry (scaled to 1 on average), otherwise its alias is drawn
+        scaled = weights * n[owner] / np.where(self.empty, 1, total)[owner]
+        self.prob = np.ones(len(weights))
+        self.alias = np.arange(len(weights))
+        for i in np.flatnonzero(~self.empty).tolist():
+            start = self.offsets[i]
+            p = scaled[start:self.offsets[i + 1]].tolist()
+            small = [j for j, x in enumerate(p) if x < 1]
+            large = [j for j, x in enumerate(p) if x >= 1]
+            while small and large:
+                s, g = small.pop(), large[-1]
+                self.prob[start + s] = p[s]
+                self.alias[start + s] = start + g
+                p[g] -= 1 - p[s]
+                if p[g] < 1:
+                    small.append(large.pop())
+            # the ones left are 1, up to rounding errors
+
+    def sample(self, groups):
+        """
+        :param groups: the distribution to draw from, for each draw (-1 for none)
+        :return: the value drawn for each draw, -1 for none (or for an empty distribution)
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        valid = groups >= 0
+        valid[valid] = ~self.empty[groups[valid]]
+        groups = np.where(valid, groups, 0)
+        start = self.offsets[groups]
+        n = self.offsets[groups + 1] - start
+
+        j = start + np.minimum((np.random.random_sample(len(groups)) * n).astype(np.int64), np.maximum(n - 1, 0))
+        if len(self.prob) > 0:
+            j = np.where(valid, j, 0)
+            j = np.where(np.random.random_sample(len(groups)) < self.prob[j], j, self.alias[j])
+            return np.where(valid, self.values[j], -1)
+        return np.full(len(groups), -1, dtype=np.int64)
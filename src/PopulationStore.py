@@ -0,0 +1,206 @@
+"""
+Columnar on-disk population format.
+
+A region is compiled once from its JSON sources into a directory of .npy arrays:
+
+    meta.json                   format version, sizes, gender, age and category tables
+    activeness.json             copy of the activeness table (if given)
+    agents/<column>.npy         aid, age, gender, household, census, work, school
+    <context>/ids.npy           original cell ids
+    <context>/offsets.npy       CSR offsets of the cell membership
+    <context>/members.npy       agent rows (positions in agents/aid.npy)
+    <context>/category.npy      positions in the context categories table
+    <context>/parent.npy        parent cell position (-1 if none)
+    <context>/child_offsets.npy CSR offsets of the children lists
+    <context>/children.npy      children cell positions
+
+Arrays are opened memory-mapped, thus a store opens almost instantly and its pages are
+shared among all the processes reading it.
+"""
+import os
+import json
+import gzip
+import shutil
+import numpy as np
+from .AgentData import ColumnarSocialContext, AgentList, Contexts, SocialActiveness, ContextIndex, \
+    CONTEXT_FIELDS, iter_cells, cell_columns
+
+__author__ = ["Giulio Rossetti", "Letizia Milli", "Salvatore Citraro"]
+__license__ = "BSD-2-Clause"
+
+FORMAT_VERSION = 1
+
+CONTEXTS = ['households', 'census', 'workplaces', 'schools']
+
+
+def _as_list(filenames):
+    if filenames is None:
+        return []
+    if isinstance(filenames, str):
+        return [filenames]
+    return list(filenames)
+
+
+def _read_rows(filename, gz):
+    opener = gzip.open if gz else open
+    with opener(filename) as f:
+        for row in f:
+            yield json.loads(row)
+
+
+def compile_population(path, agents, census, households, workplaces=None, schools=None, activeness=None, gz=True):
+    """
+    Compile a population from its JSON sources into a columnar store
+
+    :param path: output directory
+    :param agents: agents file (one JSON object per row)
+    :param census: census cells file
+    :param households: households file
+    :param workplaces: (optional) workplaces file, or list of files to merge (e.g., private and public sector)
+    :param schools: (optional) schools file, or list of files to merge (e.g., schools and universities)
+    :param activeness: (optional) activeness file, copied as is
+    :param gz: whether the sources are gzipped
+    :return: the compiled PopulationStore
+    """
+    sources = {
+        'households': _as_list(households),
+        'census': _as_list(census),
+        'workplaces': _as_list(workplaces),
+        'schools': _as_list(schools)
+    }
+
+    os.makedirs(os.path.join(path, 'agents'), exist_ok=True)
+
+    agents = AgentList.from_rows(_read_rows(agents, gz))
+    meta = {'format': FORMAT_VERSION, 'agents': agents.number_of_nodes(), 'genders': agents.genders, 'ages': agents.ages,
+            'contexts': {}}
+
+    for name in CONTEXTS:
+        context = ColumnarSocialContext.from_columns([cell_columns(iter_cells(f, gz)) for f in sources[name]])
+        context.bind_agents(agents)
+
+        arrays = {
+            'ids': context.ids,
+            'offsets': context.offsets,
+            'members': context.members,
+            'category': context.category,
+            'parent': context.parent,
+            'child_offsets': context.child_offsets,
+            'children': context.children
+        }
+        os.makedirs(os.path.join(path, name), exist_ok=True)
+        for k, v in arrays.items():
+            np.save(os.path.join(path, name, f"{k}.npy"), v)
+        meta['contexts'][name] = {'cells': len(context.ids), 'categories': context.categories,
+                                  'parent_list': context.parent_list}
+
+        agents.rebind(CONTEXT_FIELDS[name], context.index)
+        del context
+
+    for k, v in agents.columns.items():
+        np.save(os.path.join(path, 'agents', f"{k}.npy"), v)
+
+    if activeness is not None:
+        shutil.copyfile(activeness, os.path.join(path, 'activeness.json'))
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return PopulationStore(path)
+
+
+def compile_region(region, data_dir="italy_data", path=None):
+    """
+    Compile an italy_data region into a columnar store
+
+    :param region: a Regions value (or its numeric code)
+    :param data_dir: root of the JSON data
+    :param path: (optional) output directory, default <data_dir>/store/region_<code>
+    :return: the compiled PopulationStore
+    """
+    r = getattr(region, 'value', region)
+    if path is None:
+        path = os.path.join(data_dir, 'store', f"region_{r}")
+
+    return compile_population(
+        path,
+        agents=os.path.join(data_dir, 'agents', f"agents_{r}.json.gz"),
+        census=os.path.join(data_dir, 'census', f"census_{r}.json.gz"),
+        households=os.path.join(data_dir, 'households', f"households_{r}.json.gz"),
+        workplaces=[os.path.join(data_dir, 'private_sector', f"private_sector_{r}.json.gz"),
+                    os.path.join(data_dir, 'public_sector', f"public_sector_{r}.json.gz")],
+        schools=[os.path.join(data_dir, 'schools', f"schools_{r}.json.gz"),
+                 os.path.join(data_dir, 'universities', f"universities_{r}.json.gz")],
+        activeness=os.path.join(data_dir, 'activeness.json'),
+        gz=True)
+
+
+class PopulationStore(object):
+
+    def __init__(self, path, mmap=True):
+        """
+        Open a compiled population
+
+        :param path: store directory
+        :param mmap: whether to memory-map the arrays (default) or read them in memory
+        """
+        self.path = path
+        self.mmap_mode = 'r' if mmap else None
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported store format {self.meta['format']} (expected {FORMAT_VERSION})")
+
+    def array(self, *name):
+        return np.load(os.path.join(self.path, *name[:-1], f"{name[-1]}.npy"), mmap_mode=self.mmap_mode)
+
+    def get_context(self, name):
+        meta = self.meta['contexts'][name]
+        return ColumnarSocialContext(
+            self.array(name, 'ids'), self.array(name, 'offsets'), self.array(name, 'members'),
+            self.array(name, 'category'), meta['categories'], self.array(name, 'parent'),
+            self.array(name, 'child_offsets'), self.array(name, 'children'),
+            agent_ids=self.array('agents', 'aid'), parent_list=meta['parent_list'])
+
+    def get_agents(self, contexts=None):
+        """
+        Open the agents
+
+        :param contexts: (optional) Contexts to share the context indexes with
+        :return: an AgentList
+        """
+        columns = {c: self.array('agents', c) for c in ['aid', 'age', 'gender'] + list(CONTEXT_FIELDS.values())}
+        if contexts is not None:
+            context_index = {f: contexts.contexts[name].index for name, f in CONTEXT_FIELDS.items()}
+        else:
+            context_index = {f: ContextIndex(self.array(name, 'ids')) for name, f in CONTEXT_FIELDS.items()}
+        return AgentList(columns=columns, genders=self.meta['genders'], ages=self.meta['ages'],
+                         context_index=context_index)
+
+    def get_activeness(self):
+        filename = os.path.join(self.path, 'activeness.json')
+        if os.path.exists(filename):
+            return SocialActiveness(filename=filename)
+        return SocialActiveness()
+
+    def load(self):
+        """
+        Open the whole population
+
+        :return: the Contexts and the AgentList of the population
+        """
+        ctx = Contexts(self.get_context('households'), self.get_context('census'), self.get_context('workplaces'),
+                       self.get_context('schools'), self.get_activeness())
+        return ctx, self.get_agents(ctx)
+
+
+def load_store(path, mmap=True):
+    """
+    Open a compiled population
+
+    :param path: store directory
+    :param mmap: whether to memory-map the arrays
+    :return: the Contexts and the AgentList of the population
+    """
+    return PopulationStore(path, mmap).load()
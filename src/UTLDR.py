@@ -1,8 +1,12 @@
 from .DiffusionModel import DiffusionModel
-from .AgentData import ContactHistory
+from .AgentData import ContactHistory, AgentView
+from .ModelState import StatusArray, FlagArray, SocialityArray, ModelParameters, EventCalendar, SusceptibleIndex, \
+    AliasTable
 import numpy as np
 from .Entities import Weekdays, Sociality
+from . import Kernels
 from collections import defaultdict
+import warnings
 import tqdm
 
 
@@ -12,29 +16,87 @@ __license__ = "BSD-2-Clause"
 
 class UTLDR3(DiffusionModel):
 
-    def __init__(self, agents, contexts, seed=None):
+    def __init__(self, agents, contexts, seed=None, engine='loop', sampling='contacts', leap=None):
         """
 
         :param agents:
         :param contexts:
         :param seed:
+        :param engine: 'loop' (evolve one agent at a time), 'vectorized' (draw the transitions of each
+                       compartment in bulk) or 'scheduled' (draw the dwell time and outcome of each agent when it
+                       enters a compartment, and only visit it when its transition is due) or 'compiled' (the
+                       vectorized engine, with the transitions and the contact sampling compiled into Numba kernels,
+                       see Kernels; without Numba it falls back to the vectorized engine)
+        :param sampling: 'contacts' (sample every contact, then try to infect it) or 'binomial' (draw the number
+                         of infections in census cells, workplaces and schools, then pick the infected agents) or
+                         'susceptible' (sample census, workplace and school contacts among the susceptible members
+                         only, see SusceptibleIndex) or 'layers' (the attendance of census cells, workplaces and
+                         schools is drawn once a day and shared by all the agents meeting there: the expected
+                         contacts are the ones of 'contacts' sampling, but not their variance, see ActivityLayer)
+                         or 'pressure' (infect the susceptible agents given the force of infection of their cells,
+                         computed over sparse agent x cell matrices); all but 'contacts' require the vectorized,
+                         scheduled or compiled engine (the compiled engine only runs contact sampling without
+                         leaping in Kernels.infect, the other infections are drawn as in the vectorized engine)
+        :param leap: (optional) prevalence (fraction of infectious agents) from which census, workplace and school
+                     infections are drawn per cell rather than per contact (tau-leaping, see __leap_infections);
+                     the iterations below it are exact. Requires the vectorized, scheduled or compiled engine (the
+                     compiled engine draws the leaps as the vectorized one, outside of Kernels.infect). The
+                     iterations then report the "leap_error" of the step: the largest expected fraction of the
+                     susceptible members of a cell infected in the leap, i.e. the relative change of its infection
+                     propensity ignored by drawing the whole day at once (0 for the exact iterations)
         """
+        if engine not in ['loop', 'vectorized', 'scheduled', 'compiled']:
+            raise ValueError(f"Unknown engine {engine}")
+        if sampling not in ['contacts', 'binomial', 'susceptible', 'layers', 'pressure']:
+            raise ValueError(f"Unknown sampling {sampling}")
+        if sampling != 'contacts' and engine == 'loop':
+            raise ValueError(f"{sampling.capitalize()} sampling requires the vectorized, scheduled or compiled engine")
+        if leap is not None and engine == 'loop':
+            raise ValueError("Tau-leaping requires the vectorized, scheduled or compiled engine")
+
+        if engine == 'compiled' and not Kernels.AVAILABLE:
+            warnings.warn("Numba not available: falling back to the vectorized engine")
+            engine = 'vectorized'
 
         super(self.__class__, self).__init__(agents, contexts, seed)
+        if engine == 'compiled' and seed is not None:
+            Kernels.seed(seed)
+        self.contexts.bind(self.agents)
         self.graph = self.agents
-        self.status = {n: 0 for n in self.agents.population}
+        # per-agent state, indexed by agent row (dict-like: aid -> value)
+        self.status = StatusArray(self.agents)
         self.c_history = ContactHistory()
+        # agents found positive during the day, with whether they were exposed (see __contact_tracing_testing)
+        self.traced = []
 
-        self.params['nodes']['tested'] = {n: False for n in self.agents.population}
-        self.params['nodes']['ICU'] = {n: False for n in self.agents.population}
-        self.params['nodes']['filtered'] = {n: Sociality.Normal for n in self.agents.population}
+        self.params['nodes']['tested'] = FlagArray(self.agents)
+        self.params['nodes']['ICU'] = FlagArray(self.agents)
+        self.params['nodes']['filtered'] = SocialityArray(self.agents)
         self.current_active = {}
         self.active = None
         self.icu_b = self.agents.number_of_nodes()
         self.current_day = Weekdays.Monday
         self.identified_cases = 0
         self.mobility_limits = None
+        # alias tables of the long range contacts, rebuilt when p_mobility or the mobility limits change
+        self.mobility = None
         self.r = defaultdict(int)
+        self.engine = engine
+        self.sampling = sampling
+        # per-context susceptible members and daily attendance layers, built on first use
+        self.susceptible = None
+        self.layers = None
+        # per-context agent x cell incidence matrices and cell sizes, household members: built on first use
+        self.incidence = None
+        self.households = None
+        # CSR contexts and agent columns of the compiled kernels, built on first use
+        self.kernel_data = None
+        # tau-leaping threshold, whether the last infections were drawn per cell, and the error of the last leap
+        self.leap = leap
+        self.leaping = False
+        self.leap_error = 0.0
+        # per-stratum thresholds, compiled on first use
+        self.thresholds = ModelParameters(self.agents, self.params['model'])
 
         self.name = "UTLDR"
 
@@ -53,7 +115,33 @@ class UTLDR3(DiffusionModel):
             "Dead": 11
         }
 
-        self.parameters = {
+        # competing daily events of each compartment, in the order they are drawn: (outcome, parameter)
+        st = self.available_statuses
+        self.events = {
+            st['Exposed']: [('test', 'phi_e'), (st['Infected'], 'sigma')],
+            st['Infected']: [('test', 'phi_i'), (st['Recovered'], 'gamma'), (st['Dead'], 'omega')],
+            st['Identified_Exposed']: [('hospital', 'sigma')],
+            st['Hospitalized_mild']: [(st['Recovered'], 'gamma'), (st['Dead'], 'omega')],
+            st['Hospitalized_severe']: [(st['Recovered'], 'gamma_f'), (st['Dead'], 'omega_f')],
+            st['Hospitalized_severe_ICU']: [(st['Recovered'], 'gamma_t'), (st['Dead'], 'omega_t')],
+            st['Lockdown_Susceptible']: [(st['Susceptible'], 'mu')],
+            st['Lockdown_Exposed']: [('test', 'phi_e'), (st['Exposed'], 'mu'), (st['Lockdown_Infected'], 'sigma')],
+            st['Lockdown_Infected']: [('test', 'phi_i'), (st['Infected'], 'mu'), (st['Dead'], 'omega'),
+                                      (st['Recovered'], 'gamma')]
+        }
+        self.calendar = EventCalendar(self.agents.number_of_nodes())
+
+        self.parameters = self.model_parameters(self.agents.number_of_nodes())
+
+    @staticmethod
+    def model_parameters(size):
+        """
+        Parameters of the model, shared with the metapopulation model (see MetaUTLDR3)
+
+        :param size: number of agents (default ICU beds)
+        :return: the parameters description (model, nodes and edges)
+        """
+        return {
             "model": {
                 "sigma": {
                     "descr": "Incubation rate (1/expected iterations)",
@@ -146,7 +234,7 @@ class UTLDR3(DiffusionModel):
                     "descr": "Beds availability in ICU (absolute value)",
                     "range": [0, np.infty],
                     "optional": True,
-                    "default": self.agents.number_of_nodes()
+                    "default": size
                 },
                 "iota": {
                     "descr": "Severe case probability (needing ICU treatments)",
@@ -177,6 +265,10 @@ class UTLDR3(DiffusionModel):
             "edges": dict(),
         }
 
+    def status_count(self):
+        # kept up to date as the statuses are written
+        return self.status.counts()
+
     def update_model_parameter(self, name, value):
         """
 
@@ -187,6 +279,22 @@ class UTLDR3(DiffusionModel):
 
         if name in self.params['model']:
             self.params['model'][name] = value
+            self.thresholds.invalidate(name)
+            if name == 'p_mobility':
+                self.mobility = None
+            elif name == 'tracing_days':
+                self.c_history.resize(value)
+
+            # dwell times are memoryless: the pending events depending on the parameter are drawn anew
+            compartments = [s for s, events in self.events.items() if name in [p for _, p in events]]
+            self.calendar.invalidate(np.flatnonzero(np.isin(self.status.array, compartments)))
+
+    def set_initial_status(self, configuration):
+        super(self.__class__, self).set_initial_status(configuration)
+        self.thresholds.invalidate()
+        self.mobility = None
+        # only the days considered by contact tracing are kept
+        self.c_history.resize(self.params['model']['tracing_days'])
 
     def iteration(self, node_status=True):
         """
@@ -204,7 +312,8 @@ class UTLDR3(DiffusionModel):
             self.icu_b = self.params['model']['icu_b']
             self.current_day = (self.params['model']['start_day'] % len(Weekdays)) + 1
 
-            self.active = [node for node in self.status if self.status[node] == self.available_statuses['Infected']]
+            infected = self.status.array == self.available_statuses['Infected']
+            self.active = self.agents.columns['aid'][infected].tolist()
 
             self.actual_iteration += 1
             delta, node_count, status_delta = self.status_delta(actual_status)
@@ -220,6 +329,47 @@ class UTLDR3(DiffusionModel):
                         "node_count": node_count, "status_delta": status_delta, "identified_cases": self.identified_cases,
                         "Rt": r0}
 
+        if self.engine == 'vectorized':
+            actual_status = self.__iterate_compartments(actual_status)
+        elif self.engine == 'scheduled':
+            actual_status = self.__iterate_events(actual_status)
+        elif self.engine == 'compiled':
+            actual_status = self.__iterate_kernels(actual_status)
+        else:
+            actual_status = self.__iterate_agents(actual_status)
+
+        if len(self.traced) > 0:
+            actual_status = self.__contact_tracing_testing(actual_status)
+
+        delta, node_count, status_delta = self.status_delta(actual_status)
+
+        for k, v in actual_status.items():
+            self.status[k] = v
+
+        self.active = self.current_active
+        self.actual_iteration += 1
+
+        rt = 0 if len(self.r) == 0 else sum(list(self.r.values()))/len(self.r)
+        if node_status:
+            result = {"iteration": self.actual_iteration - 1, "status": delta,
+                      "node_count": node_count, "status_delta": status_delta, "identified_cases": self.identified_cases,
+                      "Rt": rt}
+        else:
+            result = {"iteration": self.actual_iteration - 1, "status": {},
+                      "node_count": node_count, "status_delta": status_delta, "identified_cases": self.identified_cases,
+                      "Rt": rt}
+        if self.leap is not None:
+            result["leap_error"] = self.leap_error
+        return result
+
+    def __iterate_agents(self, actual_status):
+        """
+        Loop engine: agents are evolved one at a time
+
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+
         # iterate over active agents
         for aid in tqdm.tqdm(self.active):
 
@@ -367,7 +517,7 @@ class UTLDR3(DiffusionModel):
                     exit_flag = np.random.random_sample()
 
                     if 0 < exit_flag < self.__get_threshold(ag, 'mu'):
-                        actual_status[0] = self.available_statuses['Infected']
+                        actual_status[u] = self.available_statuses['Infected']
                         self.__ripristinate_social_contacts(u)
 
                     else:
@@ -400,23 +550,380 @@ class UTLDR3(DiffusionModel):
                 if u not in actual_status or actual_status[u] == self.status[u] or actual_status[u] not in tst:
                     self.current_active[u] = None
 
-        delta, node_count, status_delta = self.status_delta(actual_status)
+        return actual_status
 
-        for k, v in actual_status.items():
-            self.status[k] = v
+    def __iterate_compartments(self, actual_status):
+        """
+        Vectorized engine: active agents are partitioned by compartment and their transitions drawn in bulk.
+        Infections are then resolved in a single batch (see __infect_contacts) and tests one agent at a time;
+        ICU beds released during the iteration are available to the patients admitted in it.
 
-        self.active = self.current_active
-        self.actual_iteration += 1
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+        st = self.available_statuses
+        aids = np.fromiter(self.active, dtype=np.int64)
+        rows = self.agents.rows_of(aids)
+        status = self.status.array[rows]
+        new = status.copy()
+        tested = self.params['nodes']['tested'].get_rows(rows)
+
+        def members(name):
+            return np.flatnonzero(status == st[name])
+
+        def draw(idx, parameter, strict=False):
+            # bulk version of np.random.random_sample() < threshold(agent)
+            x = np.random.random_sample(len(idx))
+            hit = x < self.__get_thresholds(rows[idx], parameter)
+            return hit & (x > 0) if strict else hit
+
+        def resolve(idx, gamma, omega, dead_first=False):
+            # recovery or death
+            if dead_first:
+                dead = draw(idx, omega)
+                new[idx[dead]] = st['Dead']
+                recovered = draw(idx[~dead], gamma)
+                new[idx[~dead][recovered]] = st['Recovered']
+                return idx[dead], idx[~dead][recovered]
+            recovered = draw(idx, gamma)
+            new[idx[recovered]] = st['Recovered']
+            dead = draw(idx[~recovered], omega)
+            new[idx[~recovered][dead]] = st['Dead']
+            return idx[recovered], idx[~recovered][dead]
+
+        def select_tests(idx, parameter):
+            # agents selected for testing, the others go on with their transitions
+            selected = draw(idx, parameter) & ~tested[idx]
+            return idx[selected], idx[~selected]
+
+        restored = []
+        resolved = []
+
+        # Undetected compartments
+        test_e, idx = select_tests(members('Exposed'), 'phi_e')
+        new[idx[draw(idx, 'sigma')]] = st['Infected']
+
+        test_i, idx = select_tests(members('Infected'), 'phi_i')
+        resolved.extend(resolve(idx, 'gamma', 'omega'))
+
+        # Quarantined compartments: beds are released before being assigned
+        recovered, dead = resolve(members('Hospitalized_severe_ICU'), 'gamma_t', 'omega_t')
+        self.icu_b += len(recovered) + len(dead)
+        resolved.extend([recovered, dead])
+
+        resolved.extend(resolve(members('Hospitalized_mild'), 'gamma', 'omega'))
+        resolved.extend(resolve(members('Hospitalized_severe'), 'gamma_f', 'omega_f'))
+
+        idx = members('Identified_Exposed')
+        idx = idx[draw(idx, 'sigma')]
+        severe = draw(idx, 'iota')
+        new[idx[~severe]] = st['Hospitalized_mild']
+        severe = idx[severe]
+        new[severe] = st['Hospitalized_severe']
+        eligible = severe[~self.params['nodes']['ICU'].get_rows(rows[severe])]
+        icu = eligible[:max(0, min(self.icu_b, len(eligible)))]
+        new[icu] = st['Hospitalized_severe_ICU']
+        self.icu_b -= len(icu)
+        self.params['nodes']['ICU'].set_rows(rows[idx], True)
+
+        # Lockdown compartments
+        idx = members('Lockdown_Susceptible')
+        exit_flag = draw(idx, 'mu', strict=True)
+        new[idx[exit_flag]] = st['Susceptible']
+        restored.append(idx[exit_flag])
+
+        test_le, idx = select_tests(members('Lockdown_Exposed'), 'phi_e')
+        exit_flag = draw(idx, 'mu', strict=True)
+        new[idx[exit_flag]] = st['Exposed']
+        restored.append(idx[exit_flag])
+        idx = idx[~exit_flag]
+        new[idx[draw(idx, 'sigma')]] = st['Lockdown_Infected']
+
+        test_li, idx = select_tests(members('Lockdown_Infected'), 'phi_i')
+        exit_flag = draw(idx, 'mu', strict=True)
+        new[idx[exit_flag]] = st['Infected']
+        restored.append(idx[exit_flag])
+        resolved.extend(resolve(idx[~exit_flag], 'gamma', 'omega', dead_first=True))
+
+        restored = np.concatenate(restored)
+        self.params['nodes']['filtered'].set_rows(rows[restored], Sociality.Normal)
+        for u in aids[np.concatenate(resolved)].tolist():
+            if u in self.r:
+                del self.r[u]
+
+        # Resolved compartments
+        for u in aids[(status == st['Recovered']) | (status == st['Dead'])].tolist():
+            self.c_history.delete(u)
+
+        changed = np.flatnonzero(new != status)
+        for u, s in zip(aids[changed].tolist(), new[changed].tolist()):
+            actual_status[u] = s
+
+        # infections, all at once
+        spreading = [st['Infected'], st['Lockdown_Exposed'], st['Lockdown_Infected']]
+        if self.params['model']['beta_e'] > 0:
+            spreading.append(st['Exposed'])
+        actual_status = self.__infect_contacts(rows[np.isin(status, spreading)], actual_status)
+
+        # tests, in the order of the active agents
+        tests = sorted([(i, exposed) for idx, exposed in [(test_e, True), (test_le, True), (test_i, False),
+                                                          (test_li, False)] for i in idx.tolist()])
+        for i, exposed in tqdm.tqdm(tests):
+            ag = self.agents.get_agent_at(int(rows[i]))
+            if exposed:
+                actual_status = self.__test_exposition(ag, actual_status)
+            else:
+                actual_status = self.__test_infection(ag, actual_status)
 
-        rt = 0 if len(self.r) == 0 else sum(list(self.r.values()))/len(self.r)
-        if node_status:
-            return {"iteration": self.actual_iteration - 1, "status": delta,
-                    "node_count": node_count, "status_delta": status_delta, "identified_cases": self.identified_cases,
-                    "Rt": rt}
+        tst = {st['Susceptible']: None, st['Dead']: None, st['Recovered']: None}
+        for u, s in zip(aids.tolist(), status.tolist()):
+            if s not in tst:
+                a = actual_status.get(u, s)
+                if a == s or a not in tst:
+                    self.current_active[u] = None
+
+        return actual_status
+
+    def __schedule(self, rows):
+        """
+        Draw the next event of each agent: the daily events of its compartment compete, thus the dwell time is
+        geometric and the outcome is the first event of the day it leaves the compartment
+
+        :param rows: agent rows
+        """
+        day = self.actual_iteration
+        status = self.status.array[rows]
+        tested = self.params['nodes']['tested'].get_rows(rows)
+        due = np.full(len(rows), -1, dtype=np.int64)
+        outcome = np.full(len(rows), -1, dtype=np.int8)
+
+        for compartment, events in self.events.items():
+            idx = np.flatnonzero(status == compartment)
+            if len(idx) == 0:
+                continue
+
+            # daily probability of each event, given the previous ones did not happen
+            p = np.stack([self.__get_thresholds(rows[idx], parameter) * (~tested[idx] if target == 'test' else 1)
+                          for target, parameter in events])
+            p = np.clip(p, 0, 1)
+            stay = np.cumprod(1 - p, axis=0)
+            first = p * np.vstack([np.ones((1, len(idx))), stay[:-1]])
+            leave = 1 - stay[-1]
+
+            moving = leave > 0
+            dwell = np.random.geometric(np.maximum(leave, np.finfo(np.float64).tiny))
+            due[idx[moving]] = day + dwell[moving] - 1
+
+            x = np.random.random_sample(len(idx)) * leave
+            outcome[idx] = np.minimum(np.sum(np.cumsum(first, axis=0) <= x, axis=0), len(events) - 1)
+
+        self.calendar.schedule(rows, status, due, outcome)
+
+    def __iterate_events(self, actual_status):
+        """
+        Scheduled engine: the transitions of each agent are drawn when it enters a compartment (see __schedule),
+        and the iteration only visits the agents whose transition is due, together with the infectious ones
+        (see __infect_contacts). Statistically equivalent to the daily draws of the vectorized engine.
+
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+        st = self.available_statuses
+        status_array = self.status.array
+        aids = self.agents.columns['aid']
+
+        # as for the other engines, only the active agents evolve: the ones infected (or met) in the previous
+        # iteration join them, susceptible, recovered and dead agents leave them
+        rows = self.agents.rows_of(np.fromiter(self.active, dtype=np.int64))
+        self.calendar.activate(rows[rows >= 0])
+        self.calendar.deactivate(np.flatnonzero(np.isin(status_array, [st['Susceptible'], st['Recovered'],
+                                                                       st['Dead']])))
+
+        # agents that entered a compartment since their event was drawn
+        self.__schedule(self.calendar.stale(status_array))
+
+        rows, outcome = self.calendar.pop(self.actual_iteration, status_array)
+        status = status_array[rows]
+        new = status.copy()
+        tests, restored, resolved, hospital = [], [], [], []
+
+        for compartment, events in self.events.items():
+            for i, (target, parameter) in enumerate(events):
+                idx = np.flatnonzero((status == compartment) & (outcome == i))
+                if target == 'test':
+                    tests.extend((j, parameter == 'phi_e') for j in idx.tolist())
+                elif target == 'hospital':
+                    hospital.append(idx)
+                else:
+                    new[idx] = target
+                    if target in [st['Recovered'], st['Dead']]:
+                        resolved.append(idx)
+                        if compartment == st['Hospitalized_severe_ICU']:
+                            self.icu_b += len(idx)
+                    elif target in [st['Susceptible'], st['Exposed'], st['Infected']] and \
+                            compartment in [st['Lockdown_Susceptible'], st['Lockdown_Exposed'],
+                                            st['Lockdown_Infected']]:
+                        # lockdown exit
+                        restored.append(idx)
+
+        # beds released today are available to today's patients
+        idx = np.concatenate([np.asarray([], dtype=np.int64)] + hospital)
+        severe = np.random.random_sample(len(idx)) < self.__get_thresholds(rows[idx], 'iota')
+        new[idx[~severe]] = st['Hospitalized_mild']
+        severe = idx[severe]
+        new[severe] = st['Hospitalized_severe']
+        eligible = severe[~self.params['nodes']['ICU'].get_rows(rows[severe])]
+        icu = eligible[:max(0, min(self.icu_b, len(eligible)))]
+        new[icu] = st['Hospitalized_severe_ICU']
+        self.icu_b -= len(icu)
+        self.params['nodes']['ICU'].set_rows(rows[idx], True)
+
+        self.params['nodes']['filtered'].set_rows(rows[np.concatenate([np.asarray([], dtype=np.int64)] + restored)],
+                                                  Sociality.Normal)
+        for u in aids[rows[np.concatenate([np.asarray([], dtype=np.int64)] + resolved)]].tolist():
+            if u in self.r:
+                del self.r[u]
+            self.c_history.delete(u)
+
+        changed = np.flatnonzero(new != status)
+        for u, s in zip(aids[rows[changed]].tolist(), new[changed].tolist()):
+            actual_status[u] = s
+
+        # infections, all at once
+        spreading = [st['Infected'], st['Lockdown_Exposed'], st['Lockdown_Infected']]
+        if self.params['model']['beta_e'] > 0:
+            spreading.append(st['Exposed'])
+        actual_status = self.__infect_contacts(np.flatnonzero(np.isin(status_array, spreading)), actual_status)
+
+        # tests (whatever their result, the next event is drawn anew)
+        self.calendar.invalidate(rows[[j for j, _ in tests]])
+        for j, exposed in tqdm.tqdm(tests):
+            ag = self.agents.get_agent_at(int(rows[j]))
+            if exposed:
+                actual_status = self.__test_exposition(ag, actual_status)
+            else:
+                actual_status = self.__test_infection(ag, actual_status)
+
+        return actual_status
+
+    def __iterate_kernels(self, actual_status):
+        """
+        Compiled engine: the vectorized engine, with the daily transitions of the active agents and (with contact
+        sampling) the infections drawn one agent at a time by compiled kernels (see Kernels). Tests and contact
+        tracing are then run as in the vectorized engine.
+
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+        st = self.available_statuses
+        aids = np.fromiter(self.active, dtype=np.int64)
+        rows = self.agents.rows_of(aids)
+        status = self.status.array[rows]
+        thresholds = np.stack([self.__get_thresholds(rows, parameter) for parameter in Kernels.PARAMETERS])
+
+        new, test, flags, self.icu_b = Kernels.transitions(status, self.params['nodes']['tested'].get_rows(rows),
+                                                           self.params['nodes']['ICU'].get_rows(rows), thresholds,
+                                                           int(self.icu_b), self.__kernel_codes())
+        self.params['nodes']['ICU'].set_rows(rows[(flags & Kernels.HOSPITALIZED) > 0], True)
+        self.params['nodes']['filtered'].set_rows(rows[(flags & Kernels.RESTORED) > 0], Sociality.Normal)
+        for u in aids[(flags & Kernels.RESOLVED) > 0].tolist():
+            if u in self.r:
+                del self.r[u]
+
+        # Resolved compartments
+        for u in aids[(status == st['Recovered']) | (status == st['Dead'])].tolist():
+            self.c_history.delete(u)
+
+        changed = np.flatnonzero(new != status)
+        for u, s in zip(aids[changed].tolist(), new[changed].tolist()):
+            actual_status[u] = s
+
+        # infections, all at once
+        spreading = [st['Infected'], st['Lockdown_Exposed'], st['Lockdown_Infected']]
+        if self.params['model']['beta_e'] > 0:
+            spreading.append(st['Exposed'])
+        infectors = rows[np.isin(status, spreading)]
+        if self.sampling == 'contacts' and self.leap is None:
+            actual_status = self.__kernel_infections(infectors, actual_status)
         else:
-            return {"iteration": self.actual_iteration - 1, "status": {},
-                    "node_count": node_count, "status_delta": status_delta, "identified_cases": self.identified_cases,
-                    "Rt": rt}
+            actual_status = self.__infect_contacts(infectors, actual_status)
+
+        # tests, in the order of the active agents
+        for i in np.flatnonzero(test).tolist():
+            ag = self.agents.get_agent_at(int(rows[i]))
+            if test[i] == Kernels.TEST_EXPOSITION:
+                actual_status = self.__test_exposition(ag, actual_status)
+            else:
+                actual_status = self.__test_infection(ag, actual_status)
+
+        tst = {st['Susceptible']: None, st['Dead']: None, st['Recovered']: None}
+        for u, s in zip(aids.tolist(), status.tolist()):
+            if s not in tst:
+                a = actual_status.get(u, s)
+                if a == s or a not in tst:
+                    self.current_active[u] = None
+
+        return actual_status
+
+    def __kernel_infections(self, infectors, actual_status):
+        """
+        Compiled counterpart of __infect_contacts with contact sampling (see Kernels.infect)
+
+        :param infectors: agent rows of today's infectious agents
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+        st = self.available_statuses
+        status = self.status.array
+        filtered = self.params['nodes']['filtered'].array
+        n = self.agents.number_of_nodes()
+
+        if self.kernel_data is None:
+            offsets, members, activity = [], [], [np.ones(n)]
+            activeness = self.contexts.activeness
+            for name, category in [('households', None), ('census', 'census'), ('workplaces', 'work'),
+                                   ('schools', 'school')]:
+                context = self.contexts.contexts[name]
+                if context is None:
+                    offsets.append(np.zeros(1, dtype=np.int64))
+                    members.append(np.asarray([], dtype=np.int64))
+                else:
+                    bounds, rows = context.membership()
+                    offsets.append(np.asarray(bounds, dtype=np.int64))
+                    members.append(np.asarray(rows, dtype=np.int64))
+                if category is not None:
+                    activity.append(np.ones(n) if activeness is None else
+                                    activeness.get_values(np.arange(n), category).astype(np.float64))
+            cells = np.stack([self.agents.columns[field].astype(np.int64)
+                              for field in ['household', 'census', 'work', 'school']])
+            self.kernel_data = (tuple(offsets), tuple(members), cells, np.stack(activity))
+
+        infectors = np.asarray(infectors, dtype=np.int64)
+        lockdown = np.isin(status[infectors], [st['Lockdown_Exposed'], st['Lockdown_Infected']])
+        exposed = np.isin(status[infectors], [st['Exposed'], st['Lockdown_Exposed']])
+        weekend = self.current_day in [Weekdays.Saturday, Weekdays.Sunday]  # checking for work related activities
+
+        # long range contacts due to user mobility
+        targets = np.full(len(infectors), -1, dtype=np.int64)
+        idx = np.flatnonzero(~lockdown)
+        targets[idx] = self.__get_mobilities(infectors[idx])
+
+        everyone = np.arange(n)
+        beta = self.__get_thresholds(everyone, 'beta')
+        beta_e = self.__get_thresholds(everyone, 'beta_e') if np.any(exposed) else beta
+        owner, contact = Kernels.infect(infectors, filtered[infectors].astype(np.int64), lockdown, exposed, targets,
+                                        weekend, *self.kernel_data, status, filtered, beta, beta_e,
+                                        self.__kernel_codes())
+        return self.__record_infections(infectors, owner, contact, actual_status)
+
+    def __kernel_codes(self):
+        """
+        Statuses and sociality values, as passed to the compiled kernels
+
+        :return: the code of each entry of Kernels.STATUSES and Kernels.SOCIALITY
+        """
+        return np.asarray([self.available_statuses[s] for s in Kernels.STATUSES] +
+                          [Sociality[s].value for s in Kernels.SOCIALITY], dtype=np.int64)
 
     ###################################################################################################################
 
@@ -591,6 +1098,542 @@ class UTLDR3(DiffusionModel):
 
         return actual_status
 
+    def __infect_contacts(self, infectors, actual_status):
+        """
+        Batched infection step: the contacts of all the infectious agents are sampled at once, filtered by
+        status and sociality, and each of them is infected with a single Bernoulli draw
+
+        :param infectors: agent rows of today's infectious agents
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+        st = self.available_statuses
+        status = self.status.array
+        filtered = self.params['nodes']['filtered'].array
+        household = self.agents.columns['household']
+
+        infectors = np.asarray(infectors, dtype=np.int64)
+        lockdown = np.isin(status[infectors], [st['Lockdown_Exposed'], st['Lockdown_Infected']])
+        exposed = np.isin(status[infectors], [st['Exposed'], st['Lockdown_Exposed']])
+        sociality = filtered[infectors]
+        weekend = self.current_day in [Weekdays.Saturday, Weekdays.Sunday]  # checking for work related activities
+
+        # at high prevalence census, work and school infections are drawn per cell (see __leap_infections)
+        self.leaping = self.leap is not None and len(infectors) >= self.leap * self.agents.number_of_nodes()
+        self.leap_error = 0.0
+        # with binomial sampling census, work and school infections are drawn at once (see __sample_infections)
+        binomial = self.sampling == 'binomial' and not self.leaping
+        samplers = None
+        if self.sampling == 'susceptible':
+            samplers = self.__susceptible_index()
+        elif self.sampling == 'layers':
+            samplers = self.__activity_layers()
+        # with the force of infection only the visited cells are recorded
+        pressure = self.sampling == 'pressure' and not self.leaping
+        owners, contacts, visits, homes = [], [], [], []
+
+        def add(idx, restrictions=False, **kwargs):
+            visits.append((idx, dict(restrictions=restrictions, **kwargs)))
+            if pressure:
+                return
+            # household contacts are resolved in closed form (see __household_infections)
+            homes.append((idx, restrictions))
+            if restrictions or binomial or self.leaping:
+                return
+            owner, contact = self.contexts.sample_contacts(infectors[idx], samplers=samplers, households=False,
+                                                           **kwargs)
+            owners.append(idx[owner])
+            contacts.append(contact)
+
+        normal = np.flatnonzero(sociality == Sociality.Normal.value)
+        add(normal, weekend=weekend)
+        add(np.flatnonzero(sociality == Sociality.Lockdown.value), restrictions=True)
+
+        # long range contacts due to user mobility
+        idx = np.flatnonzero(~lockdown)
+        census = self.__get_mobilities(infectors[idx])
+        mobile, census = idx[census >= 0], census[census >= 0]
+        add(mobile, weekend=True, census=census)
+
+        if pressure:
+            owner, contact = self.__pressure_infections(infectors, lockdown, exposed, visits)
+        else:
+            owner = np.concatenate(owners + [np.asarray([], dtype=np.int64)])
+            contact = np.concatenate(contacts + [np.asarray([], dtype=np.int64)])
+
+            # filter out contacts in quarantine or in lockdown (except household members)
+            s, f = status[contact], filtered[contact]
+            free = (s == st['Susceptible']) & (f == Sociality.Normal.value) | \
+                   (f == Sociality.Lockdown.value) & (household[contact] == household[infectors[owner]])
+            keep = np.where(lockdown[owner], (s == st['Susceptible']) | (s == st['Lockdown_Susceptible']), free)
+            owner, contact = owner[keep], contact[keep]
+
+            # one draw per contact, with the proper beta for the contact
+            beta = self.__get_thresholds(contact, 'beta')
+            if np.any(exposed[owner]):
+                beta = np.where(exposed[owner], self.__get_thresholds(contact, 'beta_e'), beta)
+            hit = np.random.random_sample(len(contact)) < beta
+            owner, contact = self.__household_infections(infectors, lockdown, exposed, homes, owner[hit], contact[hit],
+                                                          met=(owner, contact))
+
+        if binomial:
+            owner, contact = self.__sample_infections(infectors, exposed, normal, mobile, census, weekend,
+                                                      owner, contact)
+        elif self.leaping:
+            owner, contact = self.__leap_infections(infectors, exposed, visits, owner, contact)
+
+        return self.__record_infections(infectors, owner, contact, actual_status)
+
+    def __record_infections(self, infectors, owner, contact, actual_status):
+        """
+        Infect the contacts, keeping track of the reproduction number and of the contact history
+
+        :param infectors: agent rows of today's infectious agents
+        :param owner: position in infectors of the agent infecting each contact
+        :param contact: agent rows of the contacts infected
+        :param actual_status: status updates of the iteration
+        :return: the status updates
+        """
+        st = self.available_statuses
+        aids = self.agents.columns['aid']
+        infected = defaultdict(list)
+        for u, v in zip(aids[infectors[owner]].tolist(), aids[contact].tolist()):
+            if self.status[v] == st['Lockdown_Susceptible']:
+                actual_status[v] = st['Lockdown_Exposed']
+                self.r[v] = 0
+                self.r[u] += 1
+            elif self.status[v] == st['Susceptible']:
+                actual_status[v] = st['Exposed']
+                self.r[v] = 0
+                self.r[u] += 1
+
+            self.current_active[v] = None
+            infected[u].append((v, self.actual_iteration))
+
+        for u, contacts in infected.items():
+            self.c_history.add_to_queue(u, contacts)
+
+        return actual_status
+
+    def __household_infections(self, infectors, lockdown, exposed, homes, owner, contact, met=None):
+        """
+        Closed-form household transmission: rather than sampling the household contacts, each member of a visited
+        household is tried once. An infector drawing n contacts in a household of n members meets each of them
+        with probability 1 - (1 - 1/n)^n, and infects it with probability beta times that; the contacts of agents
+        restricted to their household are not deduplicated, each draw being a trial: 1 - (1 - beta/n)^n.
+
+        As in Contexts.sample_contacts, the contacts of an infector are the union of its contexts: a member already
+        met in census, work or school had its trial there, and is not tried again. Binomial sampling and leaping
+        draw the other contexts independently, so a member can still fail both trials: the difference is of the
+        order of beta^2.
+
+        :param infectors: agent rows of today's infectious agents
+        :param lockdown: whether each infector is in lockdown
+        :param exposed: whether each infector is exposed
+        :param homes: (positions in infectors, whether restricted to the household) of the household visits
+        :param owner: infectors positions of the other infections
+        :param contact: agent rows of the other infections
+        :param met: (infectors positions, agent rows) of the contacts tried in the other contexts
+        :return: (owner, contact) of all the infections
+        """
+        st = self.available_statuses
+        status = self.status.array
+        filtered = self.params['nodes']['filtered'].array
+        nodes = self.agents.number_of_nodes()
+
+        if self.households is None:
+            context = self.contexts.contexts['households']
+            self.households = context.members_of(np.arange(len(context.index)))
+        offsets, members = self.households
+
+        idx = np.concatenate([h[0] for h in homes])
+        restricted = np.concatenate([np.full(len(h[0]), h[1]) for h in homes])
+        cells = self.agents.columns['household'][infectors[idx]].astype(np.int64)
+        idx, restricted, cells = idx[cells >= 0], restricted[cells >= 0], cells[cells >= 0]
+
+        # every (infector, member) pair of the visited households
+        sizes = offsets[cells + 1] - offsets[cells]
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        visit = np.repeat(np.arange(len(idx)), sizes)
+        member = members[np.repeat(offsets[cells] - bounds[:-1], sizes) + np.arange(bounds[-1])]
+
+        # filter out members in quarantine (and the ones in lockdown, for the agents not in lockdown themselves)
+        s, f = status[member], filtered[member]
+        free = (s == st['Susceptible']) & (f == Sociality.Normal.value) | (f == Sociality.Lockdown.value)
+        keep = np.where(lockdown[idx[visit]], (s == st['Susceptible']) | (s == st['Lockdown_Susceptible']), free)
+        if met is not None and len(met[0]) > 0:
+            keep &= ~np.isin(idx[visit] * nodes + member, met[0] * nodes + met[1])
+        visit, member = visit[keep], member[keep]
+
+        beta = self.__get_thresholds(member, 'beta')
+        if np.any(exposed[idx[visit]]):
+            beta = np.where(exposed[idx[visit]], self.__get_thresholds(member, 'beta_e'), beta)
+        n = sizes[visit]
+        p = np.where(restricted[visit], -np.expm1(n * np.log1p(-beta / n)), beta * -np.expm1(n * np.log1p(-1 / n)))
+        hit = np.random.random_sample(len(member)) < p
+        return np.concatenate([owner, idx[visit[hit]]]), np.concatenate([contact, member[hit]])
+
+    def __pressure_infections(self, infectors, lockdown, exposed, visits):
+        """
+        Force of infection counterpart of the contact sampling. An infector drawing k contacts (see
+        Contexts.sample_contacts) in a cell of n members meets each of them with probability 1 - (1 - 1/n)^k,
+        and fails to infect it with probability 1 - beta * met (or (1 - beta/n)^k for the contacts of agents
+        restricted to their household, which are not deduplicated). A susceptible agent escapes infection with
+        the product of these probabilities over the infectors of its cells: one sparse mat-vec for each context.
+        Each infection is then ascribed to one of the infectors met, in proportion to its pressure.
+
+        :param infectors: agent rows of today's infectious agents
+        :param lockdown: whether each infector is in lockdown
+        :param exposed: whether each infector is exposed
+        :param visits: (positions in infectors, keyword arguments of Contexts.sample_contacts) of the visits
+        :return: (owner, contact) of the infections
+        """
+        st = self.available_statuses
+        status = self.status.array
+        filtered = self.params['nodes']['filtered'].array
+        columns = self.agents.columns
+
+        if self.incidence is None:
+            self.incidence = {}
+            for name in ['households', 'census', 'workplaces', 'schools']:
+                if self.contexts.contexts[name] is not None:
+                    matrix = self.contexts.incidence(name)
+                    self.incidence[name] = (matrix, np.asarray(matrix.sum(axis=0)).ravel().astype(np.int64))
+
+        entries = self.__visited_cells(infectors, visits, {name: sizes for name, (_, sizes) in self.incidence.items()})
+
+        # susceptible agents, by their pair of (beta, beta_e)
+        candidates = np.flatnonzero((status == st['Susceptible']) | (status == st['Lockdown_Susceptible']))
+        normal = (status[candidates] == st['Susceptible']) & (filtered[candidates] == Sociality.Normal.value)
+        locked = np.flatnonzero(filtered[candidates] == Sociality.Lockdown.value)
+        household = normal.copy()
+        household[locked] = True
+        beta = self.__get_thresholds(candidates, 'beta')
+        beta_e = self.__get_thresholds(candidates, 'beta_e') if np.any(exposed) else beta
+        pairs, group = np.unique(np.stack([beta, beta_e]), axis=1, return_inverse=True)
+        group = group.ravel()
+
+        log_escape = np.zeros(len(candidates))
+        pressure = {}
+        for name, (idx, cells, draws, dedup) in entries.items():
+            matrix, sizes = self.incidence[name]
+            # the contacts of each visit are drawn (and tried) independently of the other visits
+            size = sizes[cells]
+            met = np.where(dedup, 1 - (1 - 1 / np.maximum(size, 1)) ** draws, 0)
+            repeats = np.where(dedup, 0, draws)
+            members = matrix[candidates]
+
+            # agents in lockdown reach any susceptible, the others not the ones in quarantine or lockdown
+            for flag, reached in [(False, household if name == 'households' else normal), (True, None)]:
+                selected = np.flatnonzero(lockdown[idx] == flag)
+                if len(selected) == 0:
+                    continue
+                visit = (idx[selected], cells[selected], met[selected], repeats[selected], size[selected])
+                value = np.zeros(len(candidates))
+                for k in range(pairs.shape[1]):
+                    rows = np.flatnonzero(group == k) if reached is None else np.flatnonzero(reached & (group == k))
+                    if len(rows) == 0:
+                        continue
+                    b = np.where(exposed[visit[0]], pairs[1, k], pairs[0, k])
+                    value[rows] = members[rows] @ np.bincount(visit[1], weights=self.__escape(b, *visit[2:]),
+                                                              minlength=matrix.shape[1])
+                if name != 'households' and not flag:
+                    value += self.__household_pressure(candidates, locked, group, pairs, members, exposed,
+                                                       infectors, visit)
+                order = np.argsort(visit[1], kind='stable')
+                pressure[(name, flag)] = (value, tuple(x[order] for x in visit))
+                log_escape += value
+
+        def choose(weights):
+            cumulative = np.cumsum(weights)
+            return min(int(np.searchsorted(cumulative, np.random.random_sample() * cumulative[-1], side='right')),
+                       len(weights) - 1)
+
+        # ascribe each infection to an infector met
+        owner, contact = [], []
+        keys = list(pressure)
+        for p in np.flatnonzero(np.random.random_sample(len(candidates)) < -np.expm1(log_escape)).tolist():
+            name, flag = keys[choose([-pressure[key][0][p] for key in keys])]
+            idx, cells, met, repeats, size = pressure[(name, flag)][1]
+            matrix = self.incidence[name][0]
+            met_cells = matrix.indices[matrix.indptr[candidates[p]]:matrix.indptr[candidates[p] + 1]]
+            met_entries = np.concatenate([np.arange(np.searchsorted(cells, c), np.searchsorted(cells, c, 'right'))
+                                          for c in met_cells.tolist()] + [np.asarray([], dtype=np.int64)])
+            if name != 'households' and not flag and not normal[p]:
+                # only met by the members of its household
+                met_entries = met_entries[columns['household'][infectors[idx[met_entries]]] ==
+                                          columns['household'][candidates[p]]]
+            b = np.where(exposed[idx[met_entries]], pairs[1, group[p]], pairs[0, group[p]])
+            weights = -self.__escape(b, met[met_entries], repeats[met_entries], size[met_entries])
+            owner.append(idx[met_entries[choose(weights)]])
+            contact.append(candidates[p])
+
+        return np.asarray(owner, dtype=np.int64), np.asarray(contact, dtype=np.int64)
+
+    def __leap_infections(self, infectors, exposed, visits, owner, contact):
+        """
+        Tau-leaping counterpart of the census, workplace and school contacts. The pressure of each visited cell is
+        computed as in __pressure_infections, and the number of its susceptible members infected is drawn at once
+        from a binomial, with the highest beta of the strata; the infected members are picked from the cell
+        susceptible index (see SusceptibleIndex), thinned down to their own beta and ascribed to one of the
+        infectors of the cell. The cost grows with the cells visited and the infections, not with the members.
+
+        Each cell is drawn independently, which is exact given the pressures; the approximations are the ones of
+        the force of infection (contacts of several cells met by the same infector are tried once per cell) and
+        the agents in lockdown, only reached by their household. The leap itself keeps the pressures fixed over
+        the day: the largest expected fraction of the susceptible members of a cell infected, 1 - exp(-pressure),
+        bounds the relative change of the cell propensity it ignores, and is kept in leap_error.
+
+        :param infectors: agent rows of today's infectious agents
+        :param exposed: whether each infector is exposed
+        :param visits: (positions in infectors, keyword arguments of Contexts.sample_contacts) of the visits
+        :param owner: infectors positions of the household infections
+        :param contact: agent rows of the household infections
+        :return: (owner, contact) of all the infections
+        """
+        index = self.__susceptible_index()
+        entries = self.__visited_cells(infectors, visits, {name: np.diff(x.offsets) for name, x in index.items()})
+
+        # the highest beta of the strata, for the infectors and the exposed ones
+        top = {}
+        for parameter in ['beta', 'beta_e']:
+            table = self.thresholds.table(parameter)
+            top[parameter] = float(np.nanmax(table)) if np.ndim(table) > 0 else float(table)
+
+        owners, contacts = [owner], [contact]
+        for name, (idx, cells, draws, _) in entries.items():
+            if len(cells) == 0:
+                continue
+            susceptible = index[name]
+            sizes = np.diff(susceptible.offsets)
+            met = 1 - (1 - 1 / np.maximum(sizes[cells], 1)) ** draws
+            escape = np.log1p(-np.minimum(np.where(exposed[idx], top['beta_e'], top['beta']) * met, 1 - 1e-12))
+
+            # visits sorted by cell, with the cumulative pressure to ascribe the infections
+            order = np.argsort(cells, kind='stable')
+            idx, cells, met, escape = idx[order], cells[order], met[order], escape[order]
+            cumulative = np.cumsum(-escape)
+            visited, start = np.unique(cells, return_index=True)
+            stop = np.append(start[1:], len(cells))
+            pressure = cumulative[stop - 1] - np.where(start > 0, cumulative[start - 1], 0)
+            self.leap_error = max(self.leap_error, float(-np.expm1(-pressure.max())))
+
+            infected = np.random.binomial(susceptible.count[visited], -np.expm1(-pressure))
+            for c in np.flatnonzero(infected).tolist():
+                first = susceptible.offsets[visited[c]]
+                members = susceptible.rows[first + self.__choose_distinct(susceptible.count[visited[c]], infected[c])]
+                members = members[self.__thin(members, exposed, idx[start[c]:stop[c]], met[start[c]:stop[c]], top)]
+                u = cumulative[start[c]] + escape[start[c]] + np.random.random_sample(len(members)) * pressure[c]
+                owners.append(idx[np.minimum(np.searchsorted(cumulative, u, side='right'), stop[c] - 1)])
+                contacts.append(members)
+
+        return np.concatenate(owners), np.concatenate(contacts)
+
+    def __thin(self, members, exposed, idx, met, top):
+        """
+        Members infected with the highest beta of the strata kept with their own infection probability
+
+        :param members: agent rows of the members
+        :param exposed: whether each infector is exposed
+        :param idx: infector positions of the visits of the cell
+        :param met: probability of meeting each member, for each visit
+        :param top: parameter -> highest beta of the strata
+        :return: whether each member is kept
+        """
+        if all(np.ndim(self.thresholds.table(parameter)) == 0 for parameter in top):
+            return np.ones(len(members), dtype=bool)
+
+        beta = self.__get_thresholds(members, 'beta')
+        beta_e = self.__get_thresholds(members, 'beta_e')
+        exposed = exposed[idx]
+
+        def infection(b, b_e):
+            b = np.where(exposed[None, :], np.asarray(b_e)[..., None], np.asarray(b)[..., None])
+            return -np.expm1(np.log1p(-np.minimum(b * met[None, :], 1 - 1e-12)).sum(axis=1))
+
+        own = infection(beta, beta_e)
+        highest = infection([top['beta']], [top['beta_e']])
+        return np.random.random_sample(len(members)) * highest < own
+
+    @staticmethod
+    def __choose_distinct(n, k):
+        """
+        k distinct positions out of n
+
+        :param n: number of positions
+        :param k: number of positions to choose
+        :return: array of positions
+        """
+        if 4 * k > n:
+            return np.random.permutation(n)[:k]
+        chosen = np.unique(np.random.randint(0, n, 2 * k))
+        while len(chosen) < k:
+            chosen = np.unique(np.concatenate([chosen, np.random.randint(0, n, k)]))
+        return np.random.permutation(chosen)[:k]
+
+    def __visited_cells(self, infectors, visits, sizes):
+        """
+        Cells visited by the infectors, following Contexts.sample_contacts
+
+        :param infectors: agent rows of today's infectious agents
+        :param visits: (positions in infectors, keyword arguments of Contexts.sample_contacts) of the visits
+        :param sizes: context name -> size of each cell, for the contexts to consider
+        :return: context name -> (infector position, cell, number of draws, whether the contacts are deduplicated)
+                 of each visit
+        """
+        columns = self.agents.columns
+        activeness = self.contexts.activeness
+
+        entries = defaultdict(list)
+        for idx, kwargs in visits:
+            rows = infectors[idx]
+            restrictions = kwargs.get('restrictions', False)
+            names = [('households', 'household', None)]
+            if not restrictions:
+                names.append(('census', 'census', 'census'))
+                if not kwargs.get('weekend', False):
+                    names += [('workplaces', 'work', 'work'), ('schools', 'school', 'school')]
+            for name, field, category in names:
+                if name not in sizes or len(sizes[name]) == 0:
+                    continue
+                cells = kwargs['census'] if name == 'census' and 'census' in kwargs else columns[field][rows]
+                cells = np.asarray(cells, dtype=np.int64)
+                activity = 1 if category is None or activeness is None else activeness.get_values(rows, category)
+                draws = (sizes[name][np.maximum(cells, 0)] * activity).astype(np.int64)
+                valid = cells >= 0
+                entries[name].append((idx[valid], cells[valid], draws[valid], np.full(valid.sum(), not restrictions)))
+        return {name: tuple(np.concatenate(x) for x in zip(*parts)) for name, parts in entries.items()}
+
+    @staticmethod
+    def __escape(beta, met, repeats, size):
+        """
+        Log of the probability of escaping infection in the visits of a cell
+
+        :param beta: infection probability
+        :param met: probability of meeting each member of the cell
+        :param repeats: contacts drawn without deduplication
+        :param size: cell size
+        :return: the log probability for each visit
+        """
+        return np.log1p(-np.minimum(beta * met, 1 - 1e-12)) + \
+            repeats * np.log1p(-np.minimum(beta / np.maximum(size, 1), 1 - 1e-12))
+
+    def __household_pressure(self, candidates, locked, group, pairs, members, exposed, infectors, visit):
+        """
+        Pressure put by the infectors visiting a census cell, workplace or school on the agents in lockdown of
+        their own household met there
+
+        :param candidates: agent rows of the susceptible agents
+        :param locked: positions in candidates of the agents in lockdown
+        :param group: (beta, beta_e) pair of each candidate
+        :param pairs: the (beta, beta_e) pairs
+        :param members: incidence matrix of the candidates
+        :param exposed: whether each infector is exposed
+        :param infectors: agent rows of today's infectious agents
+        :param visit: (infector position, cell, met, repeats, cell size) of each visit
+        :return: the pressure on each candidate
+        """
+        household = self.agents.columns['household']
+        value = np.zeros(len(candidates))
+        if len(locked) == 0:
+            return value
+
+        # (household, cell) of the visits and of the agents in lockdown
+        idx, cells = visit[0], visit[1]
+        n = members.shape[1]
+        key = household[infectors[idx]].astype(np.int64) * n + cells
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        cells_of = members[locked]
+        owner = np.repeat(locked, np.diff(cells_of.indptr))
+        wanted = household[candidates[owner]].astype(np.int64) * n + cells_of.indices
+
+        start, stop = np.searchsorted(key, wanted), np.searchsorted(key, wanted, side='right')
+        owner = np.repeat(owner, stop - start)
+        bounds = np.concatenate([[0], np.cumsum(stop - start)])
+        found = order[np.repeat(start - bounds[:-1], stop - start) + np.arange(bounds[-1])]
+        b = np.where(exposed[idx[found]], pairs[1, group[owner]], pairs[0, group[owner]])
+        np.add.at(value, owner, self.__escape(b, *(x[found] for x in visit[2:])))
+        return value
+
+    def __susceptible_index(self):
+        """
+        Susceptible members of the census cells, workplaces and schools, aligned with the current status
+
+        :return: context name -> SusceptibleIndex
+        """
+        status, filtered = self.status, self.params['nodes']['filtered']
+
+        if self.susceptible is None:
+            # from now on, only the agents whose status or sociality is written are checked again
+            status.track()
+            filtered.track()
+            susceptible = (status.array == self.available_statuses['Susceptible']) & \
+                          (filtered.array == Sociality.Normal.value)
+            self.susceptible = {}
+            for name in ['census', 'workplaces', 'schools']:
+                context = self.contexts.contexts[name]
+                if context is not None:
+                    offsets, members = context.members_of(np.arange(len(context.index)))
+                    self.susceptible[name] = SusceptibleIndex(offsets, members, self.agents.number_of_nodes(),
+                                                              susceptible)
+        else:
+            rows = np.union1d(status.written_rows(), filtered.written_rows())
+            susceptible = (status.array[rows] == self.available_statuses['Susceptible']) & \
+                          (filtered.array[rows] == Sociality.Normal.value)
+            for index in self.susceptible.values():
+                index.update(susceptible, rows)
+        return self.susceptible
+
+    def __activity_layers(self):
+        """
+        Attendance layers of the census cells, workplaces and schools, drawn anew every iteration
+
+        :return: context name -> ActivityLayer
+        """
+        if self.layers is None:
+            self.layers = (None, self.contexts.activity_layers())
+        if self.layers[0] != self.actual_iteration:
+            for layer in self.layers[1].values():
+                layer.reset()
+            self.layers = (self.actual_iteration, self.layers[1])
+        return self.layers[1]
+
+    def __sample_infections(self, infectors, exposed, normal, mobile, census, weekend, owner, contact):
+        """
+        Infections in census cells, workplaces and schools drawn from binomials over the susceptible agents
+        (see Contexts.sample_infections). Agents in lockdown are only reached by their household contacts.
+
+        :param infectors: agent rows of today's infectious agents
+        :param exposed: whether each infector is exposed
+        :param normal: positions of the infectors with normal sociality
+        :param mobile: positions of the moving infectors
+        :param census: census cell visited by each moving infector
+        :param weekend: whether to skip work and school contacts
+        :param owner: infectors positions of the household infections
+        :param contact: agent rows of the household infections
+        :return: (owner, contact) of all the infections
+        """
+        st = self.available_statuses
+        susceptible = np.flatnonzero((self.status.array == st['Susceptible']) &
+                                     (self.params['nodes']['filtered'].array == Sociality.Normal.value))
+
+        owners, contacts = [owner], [contact]
+        for flag, parameter in [(False, 'beta'), (True, 'beta_e')]:
+            if not np.any(exposed == flag):
+                continue
+            weights = np.zeros(self.agents.number_of_nodes(), dtype=np.float64)
+            weights[susceptible] = self.__get_thresholds(susceptible, parameter)
+            for idx, kwargs in [(normal, {'weekend': weekend}), (mobile, {'weekend': True, 'census': census})]:
+                selected = exposed[idx] == flag
+                if 'census' in kwargs:
+                    kwargs['census'] = kwargs['census'][selected]
+                o, c = self.contexts.sample_infections(infectors[idx[selected]], weights, **kwargs)
+                owners.append(idx[selected][o])
+                contacts.append(c)
+
+        return np.concatenate(owners), np.concatenate(contacts)
+
     def __get_threshold(self, ag, parameter):
         """
 
@@ -598,20 +1641,18 @@ class UTLDR3(DiffusionModel):
         :param parameter:
         :return:
         """
-        # stratified population scenario
-        if isinstance(self.params['model'][parameter], dict):
+        row = ag.row if isinstance(ag, AgentView) else self.agents.row_of(ag.aid)
+        return self.thresholds.get_at(row, parameter)
 
-            if ag.gender in self.params['model'][parameter]:
-                nclass = ag.gender
-            elif str(ag.age) in self.params['model'][parameter]:
-                nclass = str(ag.age)
-            else:
-                raise ValueError(f"Parameter {parameter} not specified for {ag}")
+    def __get_thresholds(self, rows, parameter):
+        """
+        Vectorized __get_threshold
 
-            return self.params['model'][parameter][nclass]
-        # base scenario, single value
-        else:
-            return self.params['model'][parameter]
+        :param rows: agent rows
+        :param parameter: model parameter
+        :return: the threshold of each agent
+        """
+        return self.thresholds.get_rows(rows, parameter)
 
     def __get_neighbors(self, ag, lockdown=False):
         u = ag.aid
@@ -632,15 +1673,22 @@ class UTLDR3(DiffusionModel):
             long_range = self.__get_mobility(ag)
             neighbors.extend(long_range)
 
-            neighbors = [n for n in neighbors if self.status[n] == self.available_statuses['Susceptible'] and
-                         self.params['nodes']['filtered'][n] == Sociality.Normal or
-                         (self.params['nodes']['filtered'][n] == Sociality.Lockdown and
-                          ag.household == self.agents.get_agent(n).household)]
+        neighbors = np.asarray(neighbors, dtype=np.int64)
+        rows = self.agents.rows_of(neighbors)
+        if np.any(rows < 0):
+            raise KeyError(neighbors[rows < 0][0])
+        status = self.status.array[rows]
+
+        if not lockdown:
+            filtered = self.params['nodes']['filtered'].array[rows]
+            household = self.agents.columns['household']
+            keep = (status == self.available_statuses['Susceptible']) & (filtered == Sociality.Normal.value) | \
+                   (filtered == Sociality.Lockdown.value) & (household[rows] == household[ag.row])
         else:
-            neighbors = [n for n in neighbors if self.status[n] in
-                         [self.available_statuses['Susceptible'], self.available_statuses['Lockdown_Susceptible']]]
+            keep = (status == self.available_statuses['Susceptible']) | \
+                   (status == self.available_statuses['Lockdown_Susceptible'])
 
-        return neighbors
+        return neighbors[keep].tolist()
 
     def __test_infection(self, ag, actual_status):
         u = ag.aid
@@ -651,11 +1699,9 @@ class UTLDR3(DiffusionModel):
 
             self.__limit_social_contacts(ag, 'Tested')
 
-            # contact tracing
+            # contact tracing, at the end of the day (see __contact_tracing_testing)
             if self.params['model']['tracing_days'] > 0:
-                contacts = self.c_history.get_contacts(u, self.actual_iteration, self.params['model']['tracing_days'])
-                actual_status = self.__contact_tracing_testing(contacts, actual_status)
-                self.c_history.delete(u)
+                self.traced.append((u, False))
 
             icup = np.random.random_sample()  # probability of severe case needing ICU
             if icup < self.__get_threshold(ag, 'iota'):
@@ -679,84 +1725,152 @@ class UTLDR3(DiffusionModel):
 
             self.__limit_social_contacts(ag, 'Tested')
 
-            # contact tracing
+            # contact tracing, at the end of the day (see __contact_tracing_testing)
             if self.params['model']['tracing_days'] > 0:
-                contacts = self.c_history.get_contacts(u, self.actual_iteration, self.params['model']['tracing_days'])
-                actual_status = self.__contact_tracing_testing(contacts, actual_status, testing=True)
-                self.c_history.delete(u)
+                self.traced.append((u, True))
 
             actual_status[u] = self.available_statuses['Identified_Exposed']
         self.params['nodes']['tested'][u] = True
         return actual_status
 
-    def __contact_tracing_testing(self, agents, actual_status, testing=False):
-
-        target_statuses = {self.available_statuses['Susceptible']: None,
-                           self.available_statuses['Lockdown_Susceptible']: None}
-
-        for u in agents:
-            if self.status[u] in target_statuses:
-                ag = self.agents[u]
-                res = np.random.random_sample()  # probability of false negative result
-
-                if testing:
-                    if res > self.__get_threshold(ag, 'kappa_e'):
-                        self.__limit_social_contacts(ag, 'Tested')
-
-                        actual_status[u] = self.available_statuses['Identified_Exposed']
-                    self.params['nodes']['tested'][u] = True
-
-                else:
-                    if res > self.__get_threshold(ag, 'kappa_i'):
-                        self.__limit_social_contacts(ag, 'Tested')
-
-                        icup = np.random.random_sample()  # probability of severe case needing ICU
-                        if icup < self.__get_threshold(ag, 'iota'):
-
-                            if self.icu_b > 0 and not self.params['nodes']['ICU'][u]:
-                                actual_status[u] = self.available_statuses['Hospitalized_severe_ICU']
-                                self.icu_b -= 1
-                            else:
-                                actual_status[u] = self.available_statuses['Hospitalized_severe']
-                        else:
-                            actual_status[u] = self.available_statuses['Hospitalized_mild']
-                    self.params['nodes']['tested'][u] = True
+    def __contact_tracing_testing(self, actual_status):
+        """
+        Contact tracing of the agents found positive during the day, in a single batch: the contacts of all of
+        them are gathered at once and each contact is tested once, the first positive agent that met it deciding
+        the test (exposition or infection). Susceptible contacts are tested, even if tested on an earlier day; the
+        positive ones are quarantined and identified as exposed, or hospitalized (ICU beds are assigned in the
+        order of the positive agents, as the contacts were met). Unlike the original model, the positive contacts
+        become active, so that they progress out of these statuses on the following days
+
+        :param actual_status: status changes of the day
+        :return: the status changes, with the ones of the traced contacts
+        """
+        st = self.available_statuses
+        traced, self.traced = self.traced, []
+        positives = np.asarray([u for u, _ in traced], dtype=np.int64)
+        exposition = np.asarray([e for _, e in traced], dtype=bool)
+
+        owner, contacts = self.c_history.get_contacts_of(positives, self.actual_iteration,
+                                                         self.params['model']['tracing_days'])
+        for u in positives.tolist():
+            self.c_history.delete(u)
+
+        # first occurrence of each contact, following the positive agents, then the contacts of each of them
+        order = np.argsort(owner, kind='stable')
+        owner, contacts = owner[order], contacts[order]
+        _, first = np.unique(contacts, return_index=True)
+        first = np.sort(first)
+        owner, contacts = owner[first], contacts[first]
+
+        rows = self.agents.rows_of(contacts)
+        known = rows >= 0
+        owner, contacts, rows = owner[known], contacts[known], rows[known]
+        status = self.status.get_rows(rows)
+        keep = (status == st['Susceptible']) | (status == st['Lockdown_Susceptible'])
+        owner, contacts, rows = owner[keep], contacts[keep], rows[keep]
+        self.params['nodes']['tested'].set_rows(rows, True)
+
+        # probability of false negative result
+        testing = exposition[owner]
+        kappa = np.where(testing, self.__get_thresholds(rows, 'kappa_e'), self.__get_thresholds(rows, 'kappa_i'))
+        positive = np.random.random_sample(len(rows)) > kappa
+        self.params['nodes']['filtered'].set_rows(rows[positive], Sociality.Quarantine)
+
+        new = np.full(len(rows), st['Identified_Exposed'], dtype=np.int64)
+        idx = np.flatnonzero(positive & ~testing)
+        severe = np.random.random_sample(len(idx)) < self.__get_thresholds(rows[idx], 'iota')
+        new[idx[~severe]] = st['Hospitalized_mild']
+        severe = idx[severe]
+        new[severe] = st['Hospitalized_severe']
+        eligible = severe[~self.params['nodes']['ICU'].get_rows(rows[severe])]
+        icu = eligible[:max(0, min(self.icu_b, len(eligible)))]
+        new[icu] = st['Hospitalized_severe_ICU']
+        self.icu_b -= len(icu)
+
+        for u, v in zip(contacts[positive].tolist(), new[positive].tolist()):
+            actual_status[u] = v
+            self.current_active[u] = None
 
         return actual_status
 
     def __get_mobility(self, ag):
-        agent_municipality = self.contexts.contexts['census'].cells[str(ag.census)]['parent'][0]
-        agent_province = self.contexts.contexts['census'].cells[str(agent_municipality)]['parent'][0]
-        region = self.contexts.contexts['census'].cells[str(agent_province)]['parent'][0]
-        provinces = self.contexts.contexts['census'].cells[str(region)]['child']
-        provinces = list(set(provinces) - set([agent_province]))
+        row = ag.row if isinstance(ag, AgentView) else self.agents.row_of(ag.aid)
+        selected_census = self.__get_mobilities(np.asarray([row]))[0]
+        if selected_census >= 0:
+            neighbors = self.contexts.get_neighbors(ag, weekend=True, other_census=selected_census)
+            return neighbors
 
-        # @todo: tune probability from data
-        p_weights = [self.params['model']['p_mobility']/(len(provinces))]*(len(provinces))
-        p_weights.append(1-self.params['model']['p_mobility'])
-        provinces.append(agent_province)
+        return []
 
-        if self.mobility_limits == 'province':
-            selected_province = agent_province
-        else:
-            selected_province = np.random.choice(provinces, 1, p=p_weights)[0]
+    def __get_mobilities(self, rows):
+        """
+        Vectorized __get_mobility: the census cell visited by each agent. The agent moves to a different
+        province of its region with probability p_mobility, otherwise stays in its own, then visits a random
+        municipality of the province and a random census cell of the municipality: the municipality is drawn
+        from the alias table of the province of the agent (see __mobility_table).
+
+        :param rows: agent rows
+        :return: census positions, -1 for agents not moving anywhere
+        """
+        census = self.contexts.contexts['census']
+        cells = self.agents.columns['census'][rows]
 
         if self.mobility_limits == 'municipality':
-            selected_municipality = agent_municipality
+            selected_municipality = census.municipality_of(cells)
         else:
-            municipalities_selected_province = self.contexts.contexts['census'].cells[str(selected_province)]['child']
-            selected_municipality = np.random.choice(municipalities_selected_province, 1)[0]
-
-        census_selected_municipality = self.contexts.contexts['census'].cells[str(selected_municipality)]['child']
-        if census_selected_municipality is not None:
-            selected_census = np.random.choice(census_selected_municipality, 1)[0]
-            neighbors = self.contexts.get_neighbors(ag, weekend=True, other_census=selected_census)
-            return neighbors
+            if self.mobility is None:
+                self.mobility = self.__mobility_table()
+            provinces, table = self.mobility
+            agent_province = census.province_of(cells)
+            group = np.searchsorted(provinces, agent_province)
+            known = group < len(provinces)
+            known[known] = provinces[group[known]] == agent_province[known]
+            selected_municipality = table.sample(np.where(known, group, -1))
+
+        return census.sample_children(selected_municipality)
+
+    def __mobility_table(self):
+        """
+        Distribution of the municipality visited by the agents of each province, given p_mobility and the
+        mobility limits: (1 - p_mobility) / #municipalities to the ones of the province, p_mobility / #provinces
+        / #municipalities to the ones of each other province of the region (-1 for provinces without any)
 
-        return []
+        :return: (provinces, table): sorted positions of the provinces of the agents, and their AliasTable
+        """
+        census = self.contexts.contexts['census']
+        # @todo: tune probability from data
+        p = self.params['model']['p_mobility']
+        provinces = np.unique(census.province_of(self.agents.columns['census']))
+        provinces = provinces[provinces >= 0]
+
+        sizes, weights, values = [], [], []
+        for province in provinces.tolist():
+            targets = [(province, 1)]
+            region = census.parent_of(province)
+            if self.mobility_limits != 'province' and region >= 0:
+                others = census.children_of(int(region))
+                others = others[others != province]
+                if len(others) > 0:
+                    targets = [(province, 1 - p)] + [(q, p / len(others)) for q in others.tolist()]
+
+            n = 0
+            for q, w in targets:
+                municipalities = census.children_of(q)
+                if len(municipalities) == 0:
+                    municipalities = np.asarray([-1])
+                values.append(municipalities)
+                weights.append(np.full(len(municipalities), w / len(municipalities)))
+                n += len(municipalities)
+            sizes.append(n)
+
+        offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+        return provinces, AliasTable(offsets, np.concatenate(weights + [np.zeros(0)]),
+                                     np.concatenate(values + [np.zeros(0, dtype=np.int64)]).astype(np.int64))
 
     def set_mobility_limits(self, value):
         self.mobility_limits = value
+        self.mobility = None
 
     def unset_mobility_limits(self):
         self.mobility_limits = None
+        self.mobility = None
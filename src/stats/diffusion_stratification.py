@@ -1,4 +1,5 @@
 import json
+import numpy as np
 from collections import defaultdict
 import tqdm
 
@@ -12,6 +13,7 @@ class Stratifier(object):
             self.iterations = []
         self.agents = agents
         self.contexts = contexts
+        self.contexts.bind(self.agents)
 
         self.available_statuses = {
             "Susceptible": 0,
@@ -49,16 +51,18 @@ class Stratifier(object):
                 'census': defaultdict(int)
             }
 
-            for aid in nodes:
-                if nodes[aid] in statuses:
-                    aid = int(aid)
-                    ag = self.agents.get_agent(aid)
-                    agent_municipality = self.contexts.contexts['census'].cells[str(ag.census)]['parent'][0]
-                    agent_province = self.contexts.contexts['census'].cells[str(agent_municipality)]['parent'][0]
+            census = self.contexts.contexts['census']
 
-                    stratification['province'][agent_province] += 1
-                    stratification['municipality'][agent_municipality] += 1
-                    stratification['census'][ag.census] += 1
+            rows = self.agents.rows_of([int(aid) for aid in nodes if nodes[aid] in statuses])
+            cells = self.agents.columns['census'][rows[rows >= 0]].astype(np.int64)
+            levels = {
+                'province': census.province_of(cells),
+                'municipality': census.municipality_of(cells),
+                'census': cells
+            }
+            for level, positions in levels.items():
+                for p, count in zip(*np.unique(positions, return_counts=True)):
+                    stratification[level][census.index.id_of(p)] += int(count)
 
             results.append({'iteration': iid, 'stratification': stratification})
 
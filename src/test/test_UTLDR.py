@@ -1,9 +1,15 @@
 from __future__ import absolute_import
 
 import unittest
+import json
+import os
+import shutil
+import tempfile
 
 import ndlib.models.ModelConfig as mc
 from src.UTLDR import UTLDR3
+from src import Kernels
+from src.Entities import Sociality
 from src.AgentData import *
 
 __author__ = 'Giulio Rossetti'
@@ -94,6 +100,335 @@ class UTLDRTest(unittest.TestCase):
         #viz.plot(filename="test_r0.pdf")
 
 
+    def test_vectorized_engine(self):
+        self.assertRaises(ValueError, UTLDR3, None, None, None, 'unknown')
+        self.assertRaises(ValueError, UTLDR3, None, None, None, 'loop', 'binomial')
+        self.assertRaises(ValueError, UTLDR3, None, None, None, 'loop', 'susceptible')
+        self.assertRaises(ValueError, UTLDR3, None, None, None, 'vectorized', 'unknown')
+        self.assertRaises(ValueError, UTLDR3, None, None, None, 'loop', 'contacts', 0.1)
+
+        stratified = {"M": 0.4, "F": 0.2}
+        # tau-leaping from 10% of infectious agents: the iterations switch back to exact ones as the epidemic fades
+        for engine, beta, sampling, leap in [('vectorized', 0.4, 'contacts', None),
+                                             ('vectorized', stratified, 'contacts', None),
+                                             ('vectorized', 0.4, 'binomial', None),
+                                             ('vectorized', stratified, 'binomial', None),
+                                             ('vectorized', 0.4, 'susceptible', None),
+                                             ('scheduled', 0.4, 'contacts', None),
+                                             ('scheduled', stratified, 'binomial', None),
+                                             ('scheduled', 0.4, 'susceptible', None),
+                                             ('vectorized', stratified, 'layers', None),
+                                             ('vectorized', stratified, 'pressure', None),
+                                             ('scheduled', 0.4, 'pressure', None),
+                                             ('vectorized', stratified, 'contacts', 0.1),
+                                             ('scheduled', 0.4, 'contacts', 0.1),
+                                             ('compiled', stratified, 'contacts', None),
+                                             ('compiled', 0.4, 'binomial', None)]:
+            activeness = SocialActiveness(filename="../../data_sample/activeness.json", gz=False)
+            households = SocialContext(filename="../../data_sample/households.json", gz=False)
+            workplaces = SocialContext(filename="../../data_sample/workplaces.json", gz=False)
+            schools = SocialContext(filename="../../data_sample/schools.json", gz=False)
+            census = SocialContext(filename="../../data_sample/census.json", gz=False)
+            agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+            ctx = Contexts(households, census, workplaces, schools, activeness)
+
+            model = UTLDR3(agents=agents, contexts=ctx, seed=3, engine=engine, sampling=sampling, leap=leap)
+            config = mc.Configuration()
+            for k, v in dict(fraction_infected=0.3, tracing_days=1, start_day=2, sigma=0.3, beta_e=0.2,
+                             gamma=0.1, omega=0.05, phi_e=0.1, phi_i=0.2, kappa_e=0.03, kappa_i=0.1, gamma_t=0.2,
+                             gamma_f=0.1, omega_t=0.01, omega_f=0.08, icu_b=2, iota=0.5, mu=0.1).items():
+                config.add_model_parameter(k, v)
+            config.add_model_parameter("lambda", 0.8)
+            config.add_model_parameter("beta", 0.4)
+            model.set_initial_status(config)
+            iterations = [model.iteration()]
+            model.update_model_parameter('beta', beta)
+
+            iterations += model.iteration_bunch(9)
+            model.set_lockdown()
+            iterations += model.iteration_bunch(10)
+            model.unset_lockdown()
+            model.update_model_parameter('gamma', 0.3)
+            iterations += model.iteration_bunch(10)
+            self.assertEqual(len(iterations), 30)
+
+            for it in iterations[1:]:
+                self.assertEqual(sum(it['node_count'].values()), agents.number_of_nodes())
+            icu = sum(1 for s in model.status.values() if s == model.available_statuses['Hospitalized_severe_ICU'])
+            self.assertEqual(model.icu_b + icu, 2)
+
+    def test_susceptible_index(self):
+        activeness = SocialActiveness(filename="../../data_sample/activeness.json", gz=False)
+        households = SocialContext(filename="../../data_sample/households.json", gz=False)
+        workplaces = SocialContext(filename="../../data_sample/workplaces.json", gz=False)
+        schools = SocialContext(filename="../../data_sample/schools.json", gz=False)
+        census = SocialContext(filename="../../data_sample/census.json", gz=False)
+        agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+        ctx = Contexts(households, census, workplaces, schools, activeness)
+
+        model = UTLDR3(agents=agents, contexts=ctx, seed=1, engine='vectorized', sampling='susceptible')
+        config = mc.Configuration()
+        for k, v in dict(fraction_infected=0.2, tracing_days=2, sigma=0.3, beta=0.3, gamma=0.1, phi_e=0.2,
+                         phi_i=0.2, kappa_e=0.3, kappa_i=0.3, mu=0.2).items():
+            config.add_model_parameter(k, v)
+        config.add_model_parameter("lambda", 0.8)
+        model.set_initial_status(config)
+        model.iteration_bunch(5)
+        model.set_lockdown()
+        model.iteration_bunch(5)
+        model.unset_lockdown()
+        model.iteration_bunch(5)
+
+        # the index follows the writes to the status and sociality of the agents
+        susceptible = (model.status.array == model.available_statuses['Susceptible']) & \
+                      (model.params['nodes']['filtered'].array == Sociality.Normal.value)
+        for name, index in model._UTLDR3__susceptible_index().items():
+            self.assertEqual(index.state.tolist(), susceptible.tolist())
+            self.assertEqual(index.count.tolist(),
+                             np.bincount(index.owner[susceptible[ctx.contexts[name].members_of(
+                                 np.arange(len(index.count)))[1]]], minlength=len(index.count)).tolist())
+
+    def test_empty_context(self):
+        schools = SocialContext(cells={})
+        offsets, sample = schools.sample_agents([-1, -1], 1)
+        self.assertEqual(offsets.tolist(), [0, 0, 0])
+        self.assertEqual(len(sample), 0)
+
+        for engine, sampling in [('vectorized', 'contacts'), ('scheduled', 'contacts'), ('vectorized', 'susceptible'),
+                                 ('vectorized', 'layers'), ('vectorized', 'pressure')]:
+            activeness = SocialActiveness(filename="../../data_sample/activeness.json", gz=False)
+            households = SocialContext(filename="../../data_sample/households.json", gz=False)
+            workplaces = SocialContext(filename="../../data_sample/workplaces.json", gz=False)
+            census = SocialContext(filename="../../data_sample/census.json", gz=False)
+            agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+            ctx = Contexts(households, census, workplaces, SocialContext(cells={}), activeness)
+
+            model = UTLDR3(agents=agents, contexts=ctx, seed=0, engine=engine, sampling=sampling)
+            config = mc.Configuration()
+            for k, v in dict(fraction_infected=0.3, sigma=0.3, beta=0.4, gamma=0.1).items():
+                config.add_model_parameter(k, v)
+            model.set_initial_status(config)
+            iterations = model.iteration_bunch(3)
+            self.assertEqual(sum(iterations[-1]['node_count'].values()), agents.number_of_nodes())
+
+    def test_household_union(self):
+        households = SocialContext(filename="../../data_sample/households.json", gz=False)
+        census = SocialContext(filename="../../data_sample/census.json", gz=False)
+        agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+        model = UTLDR3(agents=agents, contexts=Contexts(households, census), seed=0, engine='vectorized')
+        config = mc.Configuration()
+        for k, v in dict(fraction_infected=0, sigma=0.3, beta=0.4, gamma=0.1).items():
+            config.add_model_parameter(k, v)
+        model.set_initial_status(config)
+
+        # an infector and a member of its household, visited many times
+        offsets, members = households.members_of(np.arange(len(households.index)))
+        cell = np.flatnonzero(np.diff(offsets) >= 2)[0]
+        a, b = members[offsets[cell]:offsets[cell] + 2].tolist()
+        n, trials = offsets[cell + 1] - offsets[cell], 20000
+        infectors, visits = np.full(trials, a), np.arange(trials)
+        lockdown = exposed = np.zeros(trials, dtype=bool)
+        empty = np.asarray([], dtype=np.int64)
+
+        # the member already met in the other contexts is not tried again in the household
+        met = visits[visits % 2 == 0]
+        owner, contact = model._UTLDR3__household_infections(infectors, lockdown, exposed, [(visits, False)],
+                                                             empty, empty, met=(met, np.full(len(met), b)))
+        owner = owner[contact == b]
+        self.assertTrue(np.all(owner % 2 == 1))
+        self.assertAlmostEqual(len(owner) / (trials / 2), 0.4 * (1 - (1 - 1 / n) ** n), delta=0.02)
+
+    def test_leap_error(self):
+        errors = {}
+        for beta, leap in [(0.01, 0), (0.4, 0), (0.4, 1), (0.4, None)]:
+            activeness = SocialActiveness(filename="../../data_sample/activeness.json", gz=False)
+            households = SocialContext(filename="../../data_sample/households.json", gz=False)
+            workplaces = SocialContext(filename="../../data_sample/workplaces.json", gz=False)
+            census = SocialContext(filename="../../data_sample/census.json", gz=False)
+            agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+            ctx = Contexts(households, census, workplaces, None, activeness)
+
+            model = UTLDR3(agents=agents, contexts=ctx, seed=0, engine='vectorized', leap=leap)
+            config = mc.Configuration()
+            for k, v in dict(fraction_infected=0.3, sigma=0.3, beta=beta, gamma=0.1).items():
+                config.add_model_parameter(k, v)
+            model.set_initial_status(config)
+            iterations = model.iteration_bunch(2)
+            if leap is None:
+                self.assertNotIn('leap_error', iterations[-1])
+            else:
+                errors[beta, leap] = iterations[-1]['leap_error']
+                self.assertEqual(errors[beta, leap], model.leap_error)
+
+        # the error grows with the pressure of the cells, and is zero for the exact iterations
+        self.assertTrue(0 < errors[0.01, 0] < errors[0.4, 0] <= 1)
+        self.assertEqual(errors[0.4, 1], 0)
+
+    def test_mobility(self):
+        households = SocialContext(filename="../../data_sample/households.json", gz=False)
+        census = SocialContext(filename="../../data_sample/census.json", gz=False)
+        agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+        model = UTLDR3(agents=agents, contexts=Contexts(households, census), seed=0, engine='vectorized')
+        model.params['model']['p_mobility'] = 1
+
+        rows = np.repeat(np.arange(agents.number_of_nodes()), 20)
+        cells = agents.columns['census'][rows]
+        has_others = np.asarray([len(census.children_of(r)) > 1 for r in census.region_of(cells).tolist()])
+        for limits, level in [(None, None), ('province', census.province_of),
+                              ('municipality', census.municipality_of)]:
+            model.set_mobility_limits(limits)
+            targets = model._UTLDR3__get_mobilities(rows)
+            visited = targets >= 0
+            self.assertTrue(np.all(census.region_of(targets[visited]) == census.region_of(cells[visited])))
+            if level is None:
+                # the agents always leave their province, if their region has others
+                moved = census.province_of(targets) != census.province_of(cells)
+                self.assertTrue(np.all(moved[visited & has_others]))
+            else:
+                self.assertTrue(np.all(level(targets[visited]) == level(cells[visited])))
+
+        # the tables follow p_mobility
+        model.unset_mobility_limits()
+        model.update_model_parameter('p_mobility', 0)
+        targets = model._UTLDR3__get_mobilities(rows)
+        visited = targets >= 0
+        self.assertTrue(np.all(census.province_of(targets[visited]) == census.province_of(cells[visited])))
+
+    def test_kernels(self):
+        # without Numba the kernels run as plain Python
+        self.assertKernels(getattr(Kernels.transitions, 'py_func', Kernels.transitions),
+                           getattr(Kernels.infect, 'py_func', Kernels.infect))
+
+    @unittest.skipUnless(Kernels.AVAILABLE, "Numba not available")
+    def test_compiled_kernels(self):
+        self.assertKernels(Kernels.transitions, Kernels.infect)
+
+        # the compiled engine, with the codes of UTLDR3
+        activeness = SocialActiveness(filename="../../data_sample/activeness.json", gz=False)
+        households = SocialContext(filename="../../data_sample/households.json", gz=False)
+        workplaces = SocialContext(filename="../../data_sample/workplaces.json", gz=False)
+        schools = SocialContext(filename="../../data_sample/schools.json", gz=False)
+        census = SocialContext(filename="../../data_sample/census.json", gz=False)
+        agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+        ctx = Contexts(households, census, workplaces, schools, activeness)
+
+        model = UTLDR3(agents=agents, contexts=ctx, seed=0, engine='compiled')
+        self.assertEqual(model.engine, 'compiled')
+        config = mc.Configuration()
+        for k, v in dict(fraction_infected=0.3, sigma=0.3, beta=0.4, gamma=0.1, phi_e=0.1, phi_i=0.2, iota=0.5,
+                         icu_b=2, mu=0.1).items():
+            config.add_model_parameter(k, v)
+        model.set_initial_status(config)
+        iterations = model.iteration_bunch(5)
+        model.set_lockdown()
+        iterations += model.iteration_bunch(5)
+        for it in iterations[1:]:
+            self.assertEqual(sum(it['node_count'].values()), agents.number_of_nodes())
+        self.assertLess(iterations[-1]['node_count'].get(model.available_statuses['Susceptible'], 0),
+                        agents.number_of_nodes())
+
+    def assertKernels(self, transitions, infect):
+        # the codes of the statuses and sociality values are the caller's, here not the ones of UTLDR3
+        names = ['S', 'I', 'E', 'R', 'IE', 'HM', 'ICU', 'HS', 'LS', 'LE', 'LI', 'D']
+        st = {s: 20 - i for i, s in enumerate(names)}
+        normal, quarantine, lockdown = 3, 4, 5
+        codes = np.asarray([st[s] for s in names] + [normal, lockdown])
+        self.assertEqual(len(codes), len(Kernels.STATUSES) + len(Kernels.SOCIALITY))
+
+        status = np.asarray([st['E'], st['E'], st['I'], st['ICU'], st['IE'], st['IE'], st['LS'], st['LI']],
+                            dtype=np.int8)
+        tested = np.asarray([False, True, False, False, False, False, False, True])
+        icu = np.zeros(len(status), dtype=bool)
+        p = np.zeros((len(Kernels.PARAMETERS), len(status)))
+        for name in ['phi_e', 'sigma', 'gamma_t', 'iota', 'mu']:
+            p[Kernels.PARAMETERS.index(name)] = 1
+        new, test, flags, icu_b = transitions(status, tested, icu, p, 0, codes)
+        self.assertEqual(new.tolist(), [st['E'], st['I'], st['I'], st['R'], st['ICU'], st['HS'], st['S'],
+                                        st['I']])
+        self.assertEqual(test.tolist(), [Kernels.TEST_EXPOSITION] + [0] * 7)
+        self.assertEqual(icu_b, 0)
+        self.assertEqual(((flags & Kernels.HOSPITALIZED) > 0).tolist(), [False] * 4 + [True] * 2 + [False] * 2)
+        self.assertEqual(((flags & Kernels.RESTORED) > 0).tolist(), [False] * 6 + [True] * 2)
+
+        # two households {0, 1, 2} and {3, 4}, a single census cell
+        offsets = (np.asarray([0, 3, 5]), np.asarray([0, 5]), np.zeros(1, dtype=np.int64),
+                   np.zeros(1, dtype=np.int64))
+        members = (np.arange(5), np.arange(5), np.asarray([], dtype=np.int64), np.asarray([], dtype=np.int64))
+        cells = np.stack([np.asarray([0, 0, 0, 1, 1]), np.zeros(5, dtype=np.int64), -np.ones(5, dtype=np.int64),
+                          -np.ones(5, dtype=np.int64)])
+        activity = np.full((4, 5), 10.0)
+        status = np.asarray([st['I'], st['S'], st['LS'], st['S'], st['LS']], dtype=np.int8)
+        filtered = np.asarray([normal, normal, lockdown, normal, lockdown], dtype=np.int8)
+        ones = np.ones(5)
+
+        # a free infector reaches the free agents and the ones in lockdown of its household
+        owner, contact = infect(np.asarray([0]), np.asarray([normal]), np.asarray([False]), np.asarray([False]),
+                                np.asarray([-1]), False, offsets, members, cells, activity, status, filtered, ones,
+                                ones, codes)
+        self.assertEqual(set(contact.tolist()), {1, 2, 3})
+        self.assertTrue(np.all(owner == 0))
+        # each visit is a set: the household and the census cell visited through mobility
+        owner, contact = infect(np.asarray([0]), np.asarray([quarantine]), np.asarray([False]),
+                                np.asarray([False]), np.asarray([0]), False, offsets, members, cells, activity,
+                                status, filtered, ones, ones, codes)
+        self.assertEqual(sorted(contact.tolist()), [1, 2, 3])
+        # an infector in lockdown only meets its household, with repetitions
+        status[4] = st['LE']
+        reached = set()
+        for _ in range(20):
+            owner, contact = infect(np.asarray([4]), np.asarray([lockdown]), np.asarray([True]),
+                                    np.asarray([True]), np.asarray([-1]), False, offsets, members, cells,
+                                    activity, status, filtered, np.zeros(5), ones, codes)
+            reached |= set(contact.tolist())
+        self.assertEqual(reached, {3})
+        owner, contact = infect(np.asarray([4]), np.asarray([lockdown]), np.asarray([True]), np.asarray([True]),
+                                np.asarray([-1]), False, offsets, members, cells, activity, status, filtered,
+                                ones, np.zeros(5), codes)
+        self.assertEqual(len(contact), 0)
+
+    def test_contact_tracing(self):
+        households = SocialContext(filename="../../data_sample/households.json", gz=False)
+        census = SocialContext(filename="../../data_sample/census.json", gz=False)
+        agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+        model = UTLDR3(agents=agents, contexts=Contexts(households, census), seed=0, engine='vectorized')
+        config = mc.Configuration()
+        for k, v in dict(fraction_infected=0, tracing_days=2, sigma=0.2, beta=0.1, gamma=0.1, kappa_e=0,
+                         kappa_i=0, iota=1, icu_b=1).items():
+            config.add_model_parameter(k, v)
+        model.set_initial_status(config)
+        model.iteration()
+        st = model.available_statuses
+
+        a, b, c, d, e, f = agents.columns['aid'][:6].tolist()
+        for u in [c, d, e]:
+            model.status[u] = st['Susceptible']
+        model.status[f] = st['Recovered']
+        model.c_history.add_to_queue(a, [(c, 0), (d, 1)])
+        model.c_history.add_to_queue(b, [(d, 1), (e, 1), (f, 1)])
+        model.traced = [(a, True), (b, False)]
+        # c was tested on an earlier day, and is tested again
+        model.params['nodes']['tested'][c] = True
+        actual_status = model._UTLDR3__contact_tracing_testing({})
+
+        # d is traced through a (first), f is not susceptible; the single ICU bed goes to e
+        self.assertEqual(actual_status, {c: st['Identified_Exposed'], d: st['Identified_Exposed'],
+                                         e: st['Hospitalized_severe_ICU']})
+        self.assertEqual(model.icu_b, 0)
+        self.assertEqual([model.params['nodes']['tested'][u] for u in [c, d, e, f]], [True, True, True, False])
+        self.assertEqual(model.params['nodes']['filtered'][d], Sociality.Quarantine)
+        self.assertEqual(model.traced, [])
+        self.assertEqual(model.c_history.get_contacts(b, 1, 2), [])
+
+        # the traced contacts are active from the next day: c leaves Identified_Exposed
+        for u, s in actual_status.items():
+            model.status[u] = s
+        model.active = model.current_active
+        model.update_model_parameter('sigma', 1)
+        model.iteration()
+        self.assertNotEqual(model.status[c], st['Identified_Exposed'])
+
+
+
 class AgentDataTest(unittest.TestCase):
 
     def test_SocialActiveness(self):
@@ -125,6 +460,254 @@ class AgentDataTest(unittest.TestCase):
         self.assertIsInstance(ctx.get_school_sample("S1", activity=1), np.ndarray)
         self.assertIsInstance(ctx.get_workplace_sample("W1", activity=1), np.ndarray)
 
+    def test_iter_cells(self):
+        for name in ['households', 'census', 'workplaces', 'schools']:
+            with open(f"../../data_sample/{name}.json") as f:
+                cells = json.load(f)
+            self.assertEqual(dict(iter_cells(f"../../data_sample/{name}.json")), cells)
+
+    def test_load_region(self):
+        data_dir = tempfile.mkdtemp()
+        sources = {'agents': 'agents', 'census': 'census', 'households': 'households',
+                   'private_sector': 'workplaces', 'public_sector': None, 'schools': 'schools', 'universities': None}
+        for name, sample in sources.items():
+            os.makedirs(os.path.join(data_dir, name))
+            if sample is None:
+                with open(os.path.join(data_dir, name, f"{name}_9.json"), 'w') as f:
+                    f.write("{}")
+            else:
+                shutil.copyfile(f"../../data_sample/{sample}.json", os.path.join(data_dir, name, f"{name}_9.json"))
+        shutil.copyfile("../../data_sample/activeness.json", os.path.join(data_dir, "activeness.json"))
+
+        ctx, agents, report = load_region(9, data_dir=data_dir, processes=2, gz=False)
+        shutil.rmtree(data_dir)
+
+        self.assertEqual(len(report), len(sources))
+        self.assertEqual(agents.number_of_nodes(), 14)
+        census = SocialContext(filename="../../data_sample/census.json")
+        for c in census.get_contexts(leaf=False):
+            self.assertEqual(ctx.contexts['census'].cells[c]['agents'], census.cells[c]['agents'] or [])
+        for ag in agents.population.values():
+            self.assertIsInstance(ctx.get_neighbors(ag), list)
+
+    def test_context_positions(self):
+        households = SocialContext(filename="../../data_sample/households.json")
+        workplaces = SocialContext(filename="../../data_sample/workplaces.json")
+        census = SocialContext(filename="../../data_sample/census.json")
+        agents = AgentList(filename="../../data_sample/agents.json")
+
+        ctx = Contexts(households, census, workplaces)
+        # the agents hold their own positions until bound: lookups resolve their ids
+        self.assertIsNot(agents.context_index['census'], census.index)
+        for bound in [False, True]:
+            if bound:
+                ctx.bind(agents)
+                self.assertIs(agents.context_index['census'], census.index)
+            for ag in agents.population.values():
+                self.assertIn(ag.aid, census.cells[ag.census]['agents'])
+                self.assertIn(ag.aid, households.cells[ag.household]['agents'])
+                self.assertEqual(census.index.id_of(ctx.cell_of(ag, 'census')), ag.census)
+                self.assertEqual(households.index.id_of(ctx.cell_of(ag, 'households')), ag.household)
+                if ag.work is not None:
+                    self.assertEqual(workplaces.index.id_of(ctx.cell_of(ag, 'workplaces')), ag.work)
+                self.assertTrue(set(ctx.get_neighbors(ag, restrictions=True)) <=
+                                set(households.cells[ag.household]['agents']))
+
+        # numeric ids are ids, not positions
+        agents = AgentList()
+        agents.add_agent(Agent(1, 'H1', 12345, 'M', 30))
+        self.assertEqual(agents.get_agent(1).census, '12345')
+        self.assertEqual(ctx.cell_of(agents.get_agent(1), 'census'), -1)
+
+    def test_activeness_vectors(self):
+        reference = SocialActiveness(filename="../../data_sample/activeness.json")
+        activeness = SocialActiveness(filename="../../data_sample/activeness.json")
+        agents = AgentList(filename="../../data_sample/agents.json")
+        with open("../../data_sample/agents.json") as f:
+            rows = AgentList.from_rows(json.loads(row) for row in f)
+
+        for population in [agents, rows]:
+            activeness.bind(population)
+            for ag in population.population.values():
+                row = population.row_of(ag.aid)
+                for category in ['census', 'work', 'school']:
+                    self.assertEqual(activeness.get_value(ag, category), reference.get_value(ag, category))
+                    self.assertEqual(activeness.get_values(np.asarray([row]), category)[0],
+                                     np.float64(reference.get_value(ag, category)))
+                self.assertEqual(activeness.get_value(ag), 1)
+
+    def test_agent_columns(self):
+        agents = AgentList()
+        agents.add_agent(Agent(7, 'h1', 'c1', 'M', 30, None, 's1'))
+        agents.add_agent(Agent(3, 'h2', 'c1', 'F', "80+"))
+        self.assertEqual(agents.number_of_nodes(), 2)
+        self.assertEqual(agents.get_agent(3), Agent(3, 'h2', 'c1', 'F', "80+"))
+        self.assertEqual(agents.get_agent(7).to_agent(), Agent(7, 'h1', 'c1', 'M', 30, None, 's1'))
+
+        # replacing an agent keeps its row
+        agents.add_agent(Agent(7, 'h2', 'c2', 'M', 31))
+        agents.add_agent(Agent(10**9, 'h3', 'c2', 'F', 31))
+        self.assertEqual(list(agents.population), [7, 3, 10**9])
+        self.assertEqual(agents.row_of(7), 0)
+        self.assertEqual(agents.get_agent(7), Agent(7, 'h2', 'c2', 'M', 31))
+        self.assertEqual(agents.rows_of([10**9, 3, 5]).tolist(), [2, 1, -1])
+        self.assertEqual(agents.columns['age'].dtype, np.int16)
+        self.assertNotIn(5, agents.population)
+        self.assertRaises(KeyError, agents.get_agent, 5)
+
+    def test_sample_agents(self):
+        census = SocialContext(filename="../../data_sample/census.json")
+        agents = AgentList(filename="../../data_sample/agents.json")
+        leaves = np.asarray([census.position(c) for c in census.get_contexts()] + [-1])
+
+        offsets, sample = census.sample_agents(leaves, 0.5)
+        self.assertEqual(len(offsets), len(leaves) + 1)
+        for i, c in enumerate(leaves[:-1]):
+            members = census.rows[c]['agents'] or []
+            self.assertEqual(offsets[i + 1] - offsets[i], int(len(members) * 0.5))
+            self.assertTrue(set(sample[offsets[i]:offsets[i + 1]]) <= set(members))
+        self.assertEqual(offsets[-1], offsets[-2])
+        self.assertRaises(ValueError, census.sample_agents, leaves, 1, True)
+
+        census.bind_agents(agents)
+        offsets, rows = census.sample_agents(leaves, np.ones(len(leaves)), rows=True)
+        self.assertEqual(offsets[-1], sum(len(census.rows[c]['agents'] or []) for c in leaves[:-1]))
+        self.assertTrue(set(agents.columns['aid'][rows]) <= set(agents.population))
+        self.assertEqual(list(census.get_sample_agents(None)), [])
+        self.assertEqual(list(census.get_sample_agents('unknown')), [])
+
+        # binomial sampling: only agents with positive weight are hit, every member of a fully active cell is met
+        weights = np.ones(agents.number_of_nodes())
+        offsets, hits = census.sample_successes(leaves, 0, weights)
+        self.assertEqual(len(hits), 0)
+        offsets, hits = census.sample_successes(leaves, 1, weights)
+        for i, c in enumerate(leaves[:-1]):
+            self.assertLessEqual(offsets[i + 1] - offsets[i], len(census.get_agents_at(c)))
+            self.assertTrue(set(agents.columns['aid'][hits[offsets[i]:offsets[i + 1]]]) <=
+                            set(census.get_agents_at(c)))
+        weights[:] = 0
+        weights[rows[:3]] = 0.5
+        offsets, hits = census.sample_successes(leaves, 1, weights)
+        self.assertTrue(set(hits) <= set(rows[:3]))
+
+    def test_census_hierarchy(self):
+        census = SocialContext(filename="../../data_sample/census.json")
+        with open("../../data_sample/census.json") as f:
+            columnar = ColumnarSocialContext.from_cells(json.load(f).items())
+
+        for sc in [census, columnar]:
+            leaves = list(sc.get_contexts())
+            positions = np.asarray([sc.position(c) for c in leaves])
+            municipalities = sc.municipality_of(positions)
+            provinces = sc.province_of(positions)
+            for c, m, p in zip(leaves, municipalities, provinces):
+                self.assertEqual(sc.index.id_of(m), census.get_parent(c)[0])
+                self.assertEqual(sc.index.id_of(p), census.get_parent(census.get_parent(c)[0])[0])
+                self.assertEqual(sc.municipality_of(c), m)
+                self.assertIn(c, [sc.index.id_of(x) for x in sc.children_of(m)])
+            self.assertEqual(len(sc.children_of(leaves[0])), 0)
+
+            children = sc.sample_children(municipalities)
+            self.assertTrue(np.all(sc.municipality_of(children) == municipalities))
+            self.assertTrue(np.all(sc.sample_children(positions) == -1))
+            others = sc.sample_children(municipalities, exclude=positions)
+            for c, m, o in zip(positions, municipalities, others):
+                self.assertNotEqual(c, o)
+                self.assertEqual(o < 0, len(sc.children_of(m)) == 1)
+
+    def test_sample_contacts(self):
+        activeness = SocialActiveness(filename="../../data_sample/activeness.json")
+        households = SocialContext(filename="../../data_sample/households.json")
+        workplaces = SocialContext(filename="../../data_sample/workplaces.json")
+        schools = SocialContext(filename="../../data_sample/schools.json")
+        census = SocialContext(filename="../../data_sample/census.json")
+        agents = AgentList(filename="../../data_sample/agents.json")
+        ctx = Contexts(households, census, workplaces, schools, activeness)
+        ctx.bind(agents)
+
+        rows = np.arange(agents.number_of_nodes())
+        owner, contacts = ctx.sample_contacts(rows)
+        self.assertEqual(len(owner), len(set(zip(owner.tolist(), contacts.tolist()))))
+        for i, c in zip(owner.tolist(), contacts.tolist()):
+            ag = agents.get_agent_at(i)
+            met = set()
+            for sc, cell in [(households, ag.household), (census, ag.census), (workplaces, ag.work),
+                             (schools, ag.school)]:
+                if cell is not None:
+                    met |= set(sc.get_agents_at(sc.find(cell)).tolist())
+            self.assertIn(agents.columns['aid'][c], met)
+
+        owner, contacts = ctx.sample_contacts(rows, restrictions=True)
+        household = agents.columns['household']
+        self.assertTrue(np.all(household[owner] == household[contacts]))
+        self.assertEqual(len(contacts), sum(len(households.get_agents_at(household[i])) for i in rows))
+        self.assertEqual(len(ctx.sample_contacts(rows, restrictions=True, households=False)[0]), 0)
+
+        # co-workers share the same attendance during a day, drawn anew the next one
+        layers = ctx.activity_layers()
+        work = agents.columns['work']
+        owner, contacts = ctx.sample_contacts(rows, samplers=layers)
+        offsets, present = layers['workplaces'].sample(work[rows])
+        for i in np.flatnonzero(work[rows] >= 0).tolist():
+            self.assertEqual(present[offsets[i]:offsets[i + 1]].tolist(),
+                             layers['workplaces'].sample(work[[i]])[1].tolist())
+            self.assertTrue(set(present[offsets[i]:offsets[i + 1]].tolist()) <= set(contacts[owner == i].tolist()))
+        layers['workplaces'].reset()
+        self.assertTrue(np.all(layers['workplaces'].start < 0))
+
+        # agent x cell incidence: the members of each household
+        matrix = ctx.incidence('households')
+        self.assertEqual(matrix.shape, (agents.number_of_nodes(), len(households.index)))
+        for i in rows.tolist():
+            self.assertEqual(matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]].tolist(), [household[i]])
+
+    def test_activity_layers(self):
+        agents = AgentList.from_rows({'aid': aid, 'household': 'h', 'census': 'c', 'age': 30, 'gender': 'F',
+                                      'work': 'w', 'school': None} for aid in range(200))
+        for activity in [0.05, 0.3, 1]:
+            workplaces = SocialContext(cells={'w': {'category': 'A', 'parent': None, 'child': None,
+                                                    'agents': list(range(200))}})
+            workplaces.bind_agents(agents)
+            layer = ActivityLayer(workplaces, activity)
+
+            # every agent meets today's attendance: as many members as the distinct contacts it would draw
+            attendance = []
+            for _ in range(500):
+                layer.reset()
+                attendance.append(len(layer.sample(np.asarray([0]))[1]))
+            offsets, sample = workplaces.sample_agents(np.zeros(500, dtype=np.int64), activity, rows=True)
+            contacts = [len(set(sample[offsets[i]:offsets[i + 1]].tolist())) for i in range(500)]
+            self.assertAlmostEqual(np.mean(attendance) / np.mean(contacts), 1, delta=0.03)
+
+    def test_contact_history(self):
+        history = ContactHistory(days=2)
+        for t in range(5):
+            history.add_to_queue(1, [(10 + t, t), (20 + t, t)])
+            history.add_to_queue(2, [(30 + t, t)])
+        # only the last two days are kept
+        self.assertEqual(history.get_contacts(1, 4, 2), [13, 23, 14, 24])
+        self.assertEqual(history.get_contacts(1, 4, 1), [14, 24])
+        self.assertEqual(history.get_contacts(2, 4, 10), [33, 34])
+        self.assertEqual(history.get_contacts(1, 2, 2), [])
+        self.assertEqual(sum(len(x) for x in history.owners), 6)
+
+        # deleting forgets the contacts recorded so far, not the later ones
+        history.delete(1)
+        history.add_to_queue(1, [(50, 4)])
+        history.add_to_queue(1, [(60, 5)])
+        self.assertEqual(history.get_contacts(1, 5, 2), [50, 60])
+        self.assertEqual(history.get_contacts(2, 5, 2), [34])
+
+        # batched: the position of the agent for each contact, oldest first
+        owner, contacts = history.get_contacts_of([2, 1, 3], 5, 2)
+        self.assertEqual(list(zip(owner.tolist(), contacts.tolist())), [(0, 34), (1, 50), (1, 60)])
+
+        history.resize(3)
+        self.assertEqual(history.get_contacts(1, 5, 3), [50, 60])
+        history.resize(0)
+        history.add_to_queue(1, [(70, 6)])
+        self.assertEqual(history.get_contacts(1, 6, 3), [])
+
     def test_agents(self):
         activeness = SocialActiveness(filename="../../data_sample/activeness.json")
         households = SocialContext(filename="../../data_sample/households.json")
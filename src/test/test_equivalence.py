@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import warnings
+
+import ndlib.models.ModelConfig as mc
+from src.UTLDR import UTLDR3
+from src.AgentData import *
+
+__author__ = 'Giulio Rossetti'
+__license__ = "BSD-2-Clause"
+__email__ = "giulio.rossetti@gmail.com"
+
+
+def synthetic_population(n, seed=0):
+    """
+    Synthetic population: households of 1-5 members spread over the census cells of a small region, with
+    workplaces and schools
+
+    :param n: number of agents
+    :param seed: seed of the generator
+    :return: (agents rows, context name -> cells, activeness table)
+    """
+    rng = np.random.RandomState(seed)
+    census = {'R1': {'category': 'Region', 'parent': None, 'child': [], 'agents': None}}
+    leaves = []
+    for p in range(2):
+        census['R1']['child'].append(f'P{p}')
+        census[f'P{p}'] = {'category': 'Province', 'parent': ['R1'], 'child': [], 'agents': None}
+        for m in range(2):
+            census[f'P{p}']['child'].append(f'M{p}{m}')
+            census[f'M{p}{m}'] = {'category': 'Municipality', 'parent': [f'P{p}'], 'child': [], 'agents': None}
+            for c in range(3):
+                census[f'M{p}{m}']['child'].append(f'C{p}{m}{c}')
+                census[f'C{p}{m}{c}'] = {'category': 'Census', 'parent': [f'M{p}{m}'], 'child': None, 'agents': []}
+                leaves.append(f'C{p}{m}{c}')
+
+    contexts = {'households': {}, 'census': census, 'workplaces': {}, 'schools': {}}
+    rows = []
+    while len(rows) < n:
+        cell, home = leaves[rng.randint(len(leaves))], f'H{len(contexts["households"])}'
+        contexts['households'][home] = {'category': None, 'parent': None, 'child': None, 'agents': []}
+        for _ in range(rng.randint(1, 6)):
+            aid, age = len(rows) + 1, int(rng.choice([5, 15, 25, 35, 45, 55, 65, 75]))
+            work = f'W{rng.randint(20)}' if 20 <= age < 65 and rng.rand() < 0.7 else None
+            school = f'S{rng.randint(5)}' if age < 20 else None
+            rows.append({'aid': aid, 'household': home, 'census': cell, 'age': age,
+                         'gender': 'M' if rng.rand() < 0.5 else 'F', 'work': work, 'school': school})
+            contexts['households'][home]['agents'].append(aid)
+            census[cell]['agents'].append(aid)
+            for name, cid, category in [('workplaces', work, 'Q' if work and int(work[1:]) < 5 else 'C'),
+                                        ('schools', school, 'P')]:
+                if cid is not None:
+                    contexts[name].setdefault(cid, {'category': category, 'parent': None, 'child': None,
+                                                    'agents': []})['agents'].append(aid)
+
+    activeness = {'age': {str(a): {'census': 0.05, 'work': 0.2, 'school': 0.3}
+                          for a in [5, 15, 25, 35, 45, 55, 65, 75]}}
+    return rows, contexts, activeness
+
+
+class EquivalenceTest(unittest.TestCase):
+    """
+    The engines and samplings are statistically equivalent to the vectorized engine with contact sampling: the
+    mean final compartments over a fixed set of seeds must agree within their standard errors.
+    """
+
+    seeds = 20
+    days = 30
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        cls.rows, cls.cells, activeness = synthetic_population(1500)
+        cls.activeness = os.path.join(cls.path, 'activeness.json')
+        with open(cls.activeness, 'w') as f:
+            json.dump(activeness, f)
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    def simulate(self, **kwargs):
+        """
+        :param kwargs: UTLDR3 arguments
+        :return: final (susceptible, recovered, identified cases) of each seed
+        """
+        key = tuple(sorted(kwargs.items()))
+        if key not in self.results:
+            finals = []
+            for seed in range(self.seeds):
+                ctx = Contexts(*[SocialContext(cells=json.loads(json.dumps(self.cells[name])))
+                                 for name in ['households', 'census', 'workplaces', 'schools']],
+                               SocialActiveness(filename=self.activeness))
+                model = UTLDR3(agents=AgentList.from_rows(self.rows), contexts=ctx, seed=seed, **kwargs)
+                config = mc.Configuration()
+                for k, v in dict(fraction_infected=0.05, tracing_days=2, start_day=1, sigma=0.2, beta=0.012,
+                                 beta_e=0.01, gamma=0.1, omega=0.01, phi_e=0.05, phi_i=0.1, kappa_e=0.3,
+                                 kappa_i=0.2, gamma_t=0.08, gamma_f=0.1, omega_t=0.02, omega_f=0.03, icu_b=5,
+                                 iota=0.3, mu=0.05).items():
+                    config.add_model_parameter(k, v)
+                config.add_model_parameter("lambda", 0.8)
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    model.set_initial_status(config)
+                    iterations = model.iteration_bunch(self.days)
+                count = iterations[-1]['node_count']
+                finals.append([count.get(model.available_statuses['Susceptible'], 0),
+                               count.get(model.available_statuses['Recovered'], 0),
+                               iterations[-1]['identified_cases']])
+            self.results[key] = np.asarray(finals, dtype=np.float64)
+        return self.results[key]
+
+    def assertEquivalent(self, **kwargs):
+        reference = self.simulate(engine='vectorized')
+        finals = self.simulate(**kwargs)
+        error = np.sqrt((reference.var(axis=0) + finals.var(axis=0)) / self.seeds)
+        difference = np.abs(finals.mean(axis=0) - reference.mean(axis=0))
+        # a difference of four standard errors is not due to chance
+        self.assertTrue(np.all(difference <= 4 * error + 1), (kwargs, finals.mean(axis=0), reference.mean(axis=0)))
+
+    def test_scheduled_engine(self):
+        self.assertEquivalent(engine='scheduled')
+
+    def test_binomial_sampling(self):
+        self.assertEquivalent(engine='vectorized', sampling='binomial')
+
+    def test_susceptible_sampling(self):
+        self.assertEquivalent(engine='vectorized', sampling='susceptible')
+
+    def test_pressure_sampling(self):
+        self.assertEquivalent(engine='vectorized', sampling='pressure')
+
+    def test_leaping(self):
+        self.assertEquivalent(engine='vectorized', leap=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
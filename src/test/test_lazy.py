@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import unittest
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from src.AgentData import *
+from src.LazyContext import *
+
+__author__ = 'Giulio Rossetti'
+__license__ = "BSD-2-Clause"
+__email__ = "giulio.rossetti@gmail.com"
+
+
+class LazyContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_lazy_context(self):
+        for name in ['households', 'census', 'workplaces', 'schools']:
+            source = f"../../data_sample/{name}.json"
+            filename = build_cell_index(source, os.path.join(self.path, f"{name}.json.gz"), gz=False,
+                                        block_size=256)
+            reference = SocialContext(filename=source)
+
+            # still a regular gzipped context file
+            with gzip.open(filename) as f:
+                self.assertEqual(json.load(f), reference.cells)
+
+            sc = LazySocialContext(filename, cache_size=4)
+            self.assertEqual(sc.cache_info()['cells'], 0)
+            self.assertEqual(len(sc.cells), len(reference.cells))
+            for c in reference.get_contexts(leaf=False):
+                self.assertEqual(sc.get_parent(c), reference.get_parent(c))
+                self.assertEqual(sc.get_child(c), reference.get_child(c))
+                if name in ['workplaces', 'schools']:
+                    self.assertEqual(sc.get_category(c), reference.get_category(c))
+                self.assertEqual(sc.cells[c]['agents'], reference.cells[c]['agents'] or [])
+                sample = sc.get_sample_agents(c, 0.5)
+                self.assertTrue(set(sample) <= set(reference.cells[c]['agents'] or []))
+                self.assertLessEqual(sc.cache_info()['cells'], 4)
+
+    def test_merge(self):
+        a = os.path.join(self.path, "a.json")
+        b = os.path.join(self.path, "b.json")
+        with open(a, 'w') as f:
+            json.dump({"1": {"agents": [1, 2], "category": "x", "parent": None, "child": None},
+                       "2": {"agents": [3], "category": "x", "parent": None, "child": None}}, f)
+        with open(b, 'w') as f:
+            json.dump({"2": {"agents": [4, 5], "category": "y", "parent": None, "child": None}}, f)
+
+        filename = build_cell_index([a, b], os.path.join(self.path, "ab.json.gz"), gz=False)
+        sc = LazySocialContext(filename)
+        self.assertEqual(list(sc.cells), ["1", "2"])
+        self.assertEqual(sc.cells["2"]['agents'], [4, 5])
+        self.assertEqual(sc.get_category("2"), "y")
+        self.assertEqual(len(sc.get_sample_agents("1", 0.1)), 0)
+        self.assertEqual(sc.cache_info()['misses'], 1)
+
+        offsets, sample = sc.sample_agents([0, -1, 1], [1, 1, 0.5])
+        self.assertEqual(offsets.tolist(), [0, 2, 2, 3])
+        self.assertTrue(set(sample[:2]) <= {1, 2})
+        self.assertIn(sample[2], [4, 5])
+
+        # as rows, the members missing from the population are dropped
+        agents = AgentList()
+        agents.add_agent(Agent(4, 'h1', 'c1'))
+        sc.bind_agents(agents)
+        offsets, sample = sc.sample_agents([0, 1], [1, 1], rows=True)
+        self.assertEqual(offsets[:2].tolist(), [0, 0])
+        self.assertTrue(np.all(sample == 0))
+        self.assertEqual(offsets[2], len(sample))
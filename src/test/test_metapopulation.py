@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import unittest
+
+import ndlib.models.ModelConfig as mc
+from src.Metapopulation import MetaUTLDR3
+from src.AgentData import *
+
+__author__ = 'Giulio Rossetti'
+__license__ = "BSD-2-Clause"
+__email__ = "giulio.rossetti@gmail.com"
+
+
+class MetaUTLDRTest(unittest.TestCase):
+
+    @staticmethod
+    def load():
+        activeness = SocialActiveness(filename="../../data_sample/activeness.json", gz=False)
+        households = SocialContext(filename="../../data_sample/households.json", gz=False)
+        workplaces = SocialContext(filename="../../data_sample/workplaces.json", gz=False)
+        schools = SocialContext(filename="../../data_sample/schools.json", gz=False)
+        census = SocialContext(filename="../../data_sample/census.json", gz=False)
+        agents = AgentList(filename="../../data_sample/agents.json", gz=False)
+        return agents, Contexts(households, census, workplaces, schools, activeness)
+
+    def test_meta_utldr3(self):
+        for level, stochastic in [('municipality', True), ('municipality', False), ('census', True)]:
+            agents, ctx = self.load()
+            model = MetaUTLDR3(agents=agents, contexts=ctx, seed=0, level=level, stochastic=stochastic)
+            config = mc.Configuration()
+
+            config.add_model_parameter("fraction_infected", 0.1)
+            config.add_model_parameter("sigma", 0.05)
+            config.add_model_parameter("beta", {"M": 0.4, "F": 0.2})
+            config.add_model_parameter("beta_e", 0.2)
+            config.add_model_parameter("gamma", 0.05)
+            config.add_model_parameter("omega", 0.01)
+            config.add_model_parameter("phi_e", 0.03)
+            config.add_model_parameter("phi_i", 0.1)
+            config.add_model_parameter("gamma_t", 0.08)
+            config.add_model_parameter("gamma_f", 0.1)
+            config.add_model_parameter("omega_t", 0.01)
+            config.add_model_parameter("omega_f", 0.08)
+            config.add_model_parameter("icu_b", 10)
+            config.add_model_parameter("iota", 0.20)
+            config.add_model_parameter("lambda", 0.8)
+            config.add_model_parameter("mu", 0.05)
+
+            model.set_initial_status(config)
+            n = agents.number_of_nodes()
+            iterations = model.iteration_bunch(10)
+            self.assertEqual(len(iterations), 10)
+            self.assertEqual(iterations[0]['node_count'][1], int(0.1 * n))
+
+            model.set_lockdown(to_keep=['Q'])
+            iterations += model.iteration_bunch(10)
+            model.unset_lockdown()
+            model.set_mobility_limits('province')
+            model.update_model_parameter('beta', 0.1)
+            iterations += model.iteration_bunch(10)
+
+            for it in iterations:
+                self.assertAlmostEqual(sum(it['node_count'].values()), n, places=6)
+                self.assertTrue(all(v >= -1e-9 for v in it['node_count'].values()))
+            self.assertGreater(iterations[-1]['node_count'].get(3, 0), 0)
+            self.assertGreaterEqual(model.icu_b, 0)
+            self.assertEqual(len(model.build_trends(iterations)[0]['trends']['node_count'][0]), 30)
+
+        with self.assertRaises(ValueError):
+            MetaUTLDR3(*self.load(), level='province')
+
+    def test_contact_matrices(self):
+        agents, ctx = self.load()
+        model = MetaUTLDR3(agents=agents, contexts=ctx, level='census')
+        self.assertEqual(model.size.sum(), agents.number_of_nodes())
+
+        # a household of n members meets n - 1 others
+        households = ctx.incidence('households')
+        n = np.asarray(households.sum(axis=0)).ravel()
+        expected = np.bincount(model.patch, weights=households @ (n - 1), minlength=len(model.size)) / model.size
+        self.assertTrue(np.allclose(np.asarray(model.contacts['restricted'].sum(axis=1)).ravel(), expected))
+        for name, matrix in model.contacts.items():
+            self.assertTrue(np.all(matrix.toarray() >= -1e-12), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
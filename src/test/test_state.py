@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+
+import unittest
+
+from src.AgentData import *
+from src.ModelState import *
+from src.Entities import Sociality
+
+__author__ = 'Giulio Rossetti'
+__license__ = "BSD-2-Clause"
+__email__ = "giulio.rossetti@gmail.com"
+
+
+class ModelStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agents = AgentList(filename="../../data_sample/agents.json")
+        self.aids = list(self.agents.population)
+
+    def test_status(self):
+        status = StatusArray(self.agents)
+        self.assertEqual(status.array.dtype, np.int8)
+        status[self.aids[3]] = 2
+        self.assertEqual(status[self.aids[3]], 2)
+        self.assertEqual(status.copy(), {aid: 2 if aid == self.aids[3] else 0 for aid in self.aids})
+        self.assertEqual(list(status), self.aids)
+        self.assertNotIn(-5, status)
+        self.assertRaises(KeyError, status.__getitem__, -5)
+
+        status.set_rows(np.asarray([0, 1]), 11)
+        self.assertEqual(status.counts(), {0: len(self.aids) - 3, 2: 1, 11: 2})
+        status.set_rows(np.asarray([4, 4, 5]), np.asarray([3, 5, 3]))
+        self.assertEqual(status.counts(), {0: len(self.aids) - 5, 2: 1, 11: 2, 3: 1, 5: 1})
+        status.recount()
+        self.assertEqual(status.counts(), {0: len(self.aids) - 5, 2: 1, 11: 2, 3: 1, 5: 1})
+        # writes through the adapter are recorded once tracked
+        status.track()
+        status[self.aids[6]] = 3
+        status.set_rows(np.asarray([7, 6]), 3)
+        self.assertEqual(status.written_rows().tolist(), [6, 7])
+        self.assertEqual(len(status.written_rows()), 0)
+
+        status.array[:] = 1
+        status.recount()
+        self.assertEqual(status.counts(), {1: len(self.aids)})
+
+    def test_flags(self):
+        flags = FlagArray(self.agents)
+        self.assertEqual(len(flags.array), (len(self.aids) + 7) // 8)
+        flags[self.aids[9]] = True
+        flags[self.aids[2]] = True
+        flags[self.aids[2]] = False
+        self.assertTrue(flags[self.aids[9]])
+        self.assertFalse(flags[self.aids[2]])
+        self.assertEqual([aid for aid, f in flags.items() if f], [self.aids[9]])
+
+        flags.set_rows(np.asarray([0, 1, 1]), True)
+        self.assertEqual(flags.get_rows(np.asarray([0, 1, 2, 9])).tolist(), [True, True, False, True])
+        flags.set_rows(np.asarray([1]), False)
+        self.assertEqual(sum(flags.values()), 2)
+
+    def test_sociality(self):
+        filtered = SocialityArray(self.agents)
+        filtered[self.aids[0]] = Sociality.Quarantine
+        self.assertIs(filtered[self.aids[0]], Sociality.Quarantine)
+        self.assertEqual(filtered.values().count(Sociality.Normal), len(self.aids) - 1)
+        self.assertEqual(filtered.array[0], Sociality.Quarantine.value)
+
+    def test_parameters(self):
+        params = {'beta': 0.4, 'sigma': {'M': 0.1, '30': 0.5}}
+        parameters = ModelParameters(self.agents, params)
+        rows = np.arange(len(self.aids))
+
+        self.assertEqual(parameters.get_at(0, 'beta'), 0.4)
+        self.assertTrue(np.all(parameters.get_rows(rows, 'beta') == 0.4))
+
+        params['beta'] = {'M': 0.2, 'F': 0.3}
+        self.assertEqual(parameters.get_at(0, 'beta'), 0.4)
+        parameters.invalidate('beta')
+        for row, ag in enumerate(self.agents.population.values()):
+            self.assertEqual(parameters.get_at(row, 'beta'), params['beta'][ag.gender])
+            if ag.gender == 'M':
+                self.assertEqual(parameters.get_at(row, 'sigma'), 0.1)
+            elif ag.age == 30:
+                self.assertEqual(parameters.get_at(row, 'sigma'), 0.5)
+            else:
+                self.assertRaises(ValueError, parameters.get_at, row, 'sigma')
+        self.assertRaises(ValueError, parameters.get_rows, rows, 'sigma')
+
+    def test_calendar(self):
+        calendar = EventCalendar(len(self.aids))
+        status = np.zeros(len(self.aids), dtype=np.int8)
+        status[:4] = 2
+        self.assertEqual(len(calendar.stale(status)), 0)
+        calendar.activate(np.arange(6))
+        self.assertEqual(calendar.stale(status).tolist(), list(range(6)))
+
+        rows = np.arange(4)
+        calendar.schedule(rows, status[rows], np.asarray([3, 1, 3, -1]), np.asarray([0, 1, 0, 0]))
+        self.assertEqual(calendar.stale(status).tolist(), [4, 5])
+        self.assertEqual(calendar.pop(1, status)[0].tolist(), [1])
+
+        # agents leaving their compartment or rescheduled drop their pending event
+        status[0] = 1
+        calendar.schedule(np.asarray([2]), status[[2]], np.asarray([5]), np.asarray([1]))
+        self.assertEqual(calendar.pop(3, status)[0].tolist(), [])
+        rows, outcome = calendar.pop(5, status)
+        self.assertEqual((rows.tolist(), outcome.tolist()), ([2], [1]))
+
+        calendar.invalidate(np.asarray([3]))
+        self.assertIn(3, calendar.stale(status))
+        calendar.deactivate(np.asarray([3]))
+        self.assertNotIn(3, calendar.stale(status))
+
+    def test_susceptible_index(self):
+        # two cells, the first one with an agent in both
+        offsets, members = np.asarray([0, 3, 5]), np.asarray([0, 1, 2, 3, 0])
+        susceptible = np.asarray([True, False, True, True, False])
+        index = SusceptibleIndex(offsets, members, 5, susceptible)
+        self.assertEqual(index.count.tolist(), [2, 2])
+        self.assertEqual(sorted(index.rows[0:2].tolist()), [0, 2])
+
+        index.update(np.asarray([False, True, True, True, False]))
+        self.assertEqual(index.count.tolist(), [2, 1])
+        self.assertEqual(sorted(index.rows[0:2].tolist()), [1, 2])
+        self.assertEqual(index.rows[3:4].tolist(), [3])
+        self.assertEqual(sorted(index.rows.tolist()), sorted(members.tolist()))
+
+        # only susceptible members are drawn, none from empty or missing cells
+        offsets, sample = index.sample(np.asarray([0, 1, -1]), np.asarray([20, 20, 20]))
+        self.assertTrue(set(sample[:offsets[1]].tolist()) <= {1, 2})
+        self.assertTrue(set(sample[offsets[1]:offsets[2]].tolist()) <= {3})
+        self.assertEqual(offsets[3], offsets[2])
+        index.update(np.zeros(5, dtype=bool))
+        self.assertEqual(len(index.sample(np.asarray([0, 1]), 20)[1]), 0)
+
+        # only the given rows are checked
+        index.update(np.asarray([True, True]), np.asarray([4, 3]))
+        self.assertEqual(index.count.tolist(), [0, 1])
+        self.assertEqual(index.state.tolist(), [False, False, False, True, True])
+
+    def test_alias_table(self):
+        np.random.seed(0)
+        # three distributions, the last one empty, and a missing one
+        table = AliasTable(np.asarray([0, 3, 4, 4]), np.asarray([1, 2, 5, 3]), np.asarray([10, 20, 30, 40]))
+        values = table.sample(np.repeat([0, 1, 2, -1], 20000))
+        first = values[:20000]
+        self.assertEqual(set(first.tolist()), {10, 20, 30})
+        for value, p in [(10, 1 / 8), (20, 2 / 8), (30, 5 / 8)]:
+            self.assertAlmostEqual(np.mean(first == value), p, delta=0.01)
+        self.assertTrue(np.all(values[20000:40000] == 40))
+        self.assertTrue(np.all(values[40000:] == -1))
+
+        # outcomes without weight are never drawn
+        table = AliasTable(np.asarray([0, 2]), np.asarray([0, 1]), np.asarray([1, 2]))
+        self.assertTrue(np.all(table.sample(np.zeros(1000, dtype=np.int64)) == 2))
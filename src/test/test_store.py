@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+
+import unittest
+import shutil
+import tempfile
+
+from src.AgentData import *
+from src.PopulationStore import *
+from src.UTLDR import UTLDR3
+
+__author__ = 'Giulio Rossetti'
+__license__ = "BSD-2-Clause"
+__email__ = "giulio.rossetti@gmail.com"
+
+
+class PopulationStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = compile_population(self.path, agents="../../data_sample/agents.json",
+                                        census="../../data_sample/census.json",
+                                        households="../../data_sample/households.json",
+                                        workplaces=["../../data_sample/workplaces.json"],
+                                        schools="../../data_sample/schools.json",
+                                        activeness="../../data_sample/activeness.json", gz=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_agents(self):
+        reference = AgentList(filename="../../data_sample/agents.json")
+        ctx, agents = load_store(self.path)
+
+        self.assertEqual(agents.number_of_nodes(), reference.number_of_nodes())
+        self.assertIsInstance(agents.columns['aid'], np.memmap)
+        for aid, ag in reference.population.items():
+            self.assertEqual(agents.get_agent(aid), ag)
+        self.assertEqual(sorted(agents.population), sorted(reference.population))
+
+    def test_shared_members(self):
+        ctx, agents = load_store(self.path)
+        members = {name: ctx.contexts[name].members for name in ['households', 'census', 'workplaces', 'schools']}
+        UTLDR3(agents=agents, contexts=ctx, seed=0, engine='vectorized')
+
+        # binding the model does not copy the memory-mapped membership
+        for name, before in members.items():
+            self.assertIsInstance(ctx.contexts[name].members, np.memmap)
+            self.assertIs(ctx.contexts[name].members, before)
+
+    def test_contexts(self):
+        ctx, agents = load_store(self.path)
+
+        for name in ['households', 'census', 'workplaces', 'schools']:
+            reference = SocialContext(filename=f"../../data_sample/{name}.json")
+            sc = ctx.contexts[name]
+            self.assertEqual(len(sc.cells), len(reference.cells))
+            self.assertEqual(sorted(sc.get_contexts(leaf=False)), sorted(reference.get_contexts(leaf=False)))
+            for c in reference.get_contexts(leaf=False):
+                self.assertEqual(sc.cells[c]['agents'], reference.cells[c]['agents'] or [])
+                self.assertEqual(sc.get_parent(c), reference.get_parent(c))
+                self.assertEqual(sc.get_child(c), reference.get_child(c))
+                if name in ['workplaces', 'schools']:
+                    self.assertEqual(sc.get_category(c), reference.get_category(c))
+
+                sample = sc.get_sample_agents(c, 0.5)
+                self.assertTrue(set(sample) <= set(reference.cells[c]['agents'] or []))
+
+        for ag in agents.population.values():
+            self.assertIsInstance(ctx.get_neighbors(ag), list)